@@ -36,6 +36,10 @@ class Config:
     def resource(resource: str) -> str:
         return f'{Config.script_path}/resources/{resource}'
 
+    @staticmethod
+    def excludes_file() -> str:
+        return Config.resource('macos-excludes.txt')
+
     @staticmethod
     def config() -> dict:
         with open(f'{Config.app_folder_path()}/config.yaml', 'r') as stream:
@@ -97,6 +101,46 @@ class Config:
 
         return to_named_tuple_dict(Config.config()['push-files'], Config.PushFiles)
 
+    @staticmethod
+    def io_profiles_config() -> dict:
+        return Config.config().get('io-profiles', None) or {}
+
+    @staticmethod
+    def io_profile_mounts_config() -> dict:
+        mounts = Config.config().get('io-profile-mounts', None) or {}
+        return {(path if path.startswith('/') else f'{Config.home_folder()}/{path}'): profile for path, profile in mounts.items()}
+
+    @staticmethod
+    def database_profile_config() -> str:
+        return Config.config().get('database-profile', None)
+
+    @staticmethod
+    def database_profiles_config() -> dict:
+        return Config.config().get('database-profiles', None) or {}
+
+    @staticmethod
+    def database_operation_profiles_config() -> dict:
+        return Config.config().get('database-operation-profiles', None) or {}
+
+    ATTRIBUTE_TIMESTAMPS_POLICIES = ['eager', 'deferred', 'never']
+
+    @staticmethod
+    def attribute_timestamps_config() -> str:
+        policy = Config.config().get('attribute-timestamps', None) or 'deferred'
+
+        if policy not in Config.ATTRIBUTE_TIMESTAMPS_POLICIES:
+            raise ValueError(f'attribute-timestamps must be one of {Config.ATTRIBUTE_TIMESTAMPS_POLICIES}, found: {policy}')
+
+        return policy
+
+    @staticmethod
+    def write_behind_config() -> bool:
+        return bool(Config.config().get('write-behind', False))
+
+    @staticmethod
+    def packed_attributes_config() -> bool:
+        return bool(Config.config().get('packed-attributes', False))
+
     @staticmethod
     def encrypted_backup_key_file() -> str:
         return Config.config()['backup']['keyfile']
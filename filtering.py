@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import re
+
+from config import Config
+
+MATCH_ALL = '.*'
+MANIFEST_FILE = '.solidblue-manifest'
+STANDARD_EXCLUDES = [f'{MANIFEST_FILE}*']  # manifests of attributes and their temporary copies
+
+
+#
+# A compiled include/exclude filter for file enumeration. Include rules (a regular expression applied to the lowercase
+# file name and/or a set of extensions) are only applied to files; exclude rules follow the rsync --exclude syntax and
+# are applied to both files and folders, so that excluded folders can be pruned before they are descended into.
+# All the rules are compiled once into a few regular expressions.
+#
+class FileFilter:
+    #
+    # Constructor.
+    #
+    def __init__(self, include: str = MATCH_ALL, extensions: [str] = None, excludes: [str] = None, excludes_file: str = None):
+        self.include = include if include else MATCH_ALL
+        self.extensions = frozenset(extension.lower().lstrip('.') for extension in extensions) if extensions else None
+        self.excludes = list(excludes) if excludes else []
+        self.excludes_file = excludes_file
+        self.__include_regex = re.compile(self.include) if self.include != MATCH_ALL else None
+        patterns = self.excludes + (self.read_excludes(excludes_file) if excludes_file else [])
+        self.__exclude_regex, self.__exclude_folder_regex = self.__compile_excludes(patterns)
+
+    #
+    # Returns a filter with the given include rule and the standard excludes shared with rsync.
+    #
+    @staticmethod
+    def with_standard_excludes(include: str = MATCH_ALL, extensions: [str] = None) -> 'FileFilter':
+        return FileFilter(include=include, extensions=extensions, excludes=STANDARD_EXCLUDES, excludes_file=Config.excludes_file())
+
+    #
+    # Returns the given object as a FileFilter; a string is interpreted as the include regular expression.
+    #
+    @staticmethod
+    def of(file_filter) -> 'FileFilter':
+        if isinstance(file_filter, FileFilter):
+            return file_filter
+
+        return FileFilter(include=file_filter)
+
+    #
+    # Returns True if the file with the given name and path (relative to the enumeration root, starting with '/')
+    # must be enumerated.
+    #
+    def accepts_file(self, relative_path: str, name: str) -> bool:
+        if self.__exclude_regex and self.__exclude_regex.search(relative_path):
+            return False
+
+        if self.extensions is not None and name.rpartition('.')[2].lower() not in self.extensions:
+            return False
+
+        return self.__include_regex is None or self.__include_regex.search(name.lower()) is not None
+
+    #
+    # Returns True if the folder with the given path (relative to the enumeration root, starting with '/') must be
+    # descended into.
+    #
+    def accepts_folder(self, relative_path: str) -> bool:
+        return not (self.__exclude_folder_regex and self.__exclude_folder_regex.search(relative_path))
+
+    #
+    # Returns the rsync flags that apply the same excludes.
+    #
+    def rsync_flags(self) -> [str]:
+        flags = [f'--exclude-from={self.excludes_file}'] if self.excludes_file else []
+        return flags + [f'--exclude={pattern}' for pattern in self.excludes]
+
+    #
+    # Reads exclude patterns from a file in the rsync --exclude-from format.
+    #
+    @staticmethod
+    def read_excludes(path: str) -> [str]:
+        with open(path, 'rt') as file:
+            lines = [line.rstrip('\n') for line in file]
+
+        return [line for line in lines if line.strip() and not line.startswith(('#', ';'))]
+
+    #
+    # Compiles rsync exclude patterns into two regular expressions: the first one for files, the second one for folders.
+    #
+    @staticmethod
+    def __compile_excludes(patterns: [str]) -> (re.Pattern, re.Pattern):
+        file_regexes = []
+        folder_regexes = []
+
+        for pattern in patterns:
+            folder_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+
+            if not pattern:
+                continue
+
+            # Anchored patterns match from the enumeration root, the others match the tail of the path.
+            if pattern.startswith('/'):
+                regex = '^/' + FileFilter.__glob_to_regex(pattern[1:]) + '$'
+            else:
+                regex = '/' + FileFilter.__glob_to_regex(pattern) + '$'
+
+            folder_regexes += [regex]
+
+            if not folder_only:
+                file_regexes += [regex]
+
+        def compiled(regexes: [str]):
+            return re.compile('|'.join(f'(?:{regex})' for regex in regexes)) if regexes else None
+
+        return compiled(file_regexes), compiled(folder_regexes)
+
+    #
+    # Translates an rsync glob into a regular expression: '*' doesn't match a '/', while '**' does.
+    #
+    @staticmethod
+    def __glob_to_regex(glob: str) -> str:
+        regex = ''
+        i = 0
+
+        while i < len(glob):
+            c = glob[i]
+
+            if glob.startswith('**', i):
+                regex += '.*'
+                i += 1
+            elif c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[':
+                end = glob.find(']', i + 1)
+
+                if end < 0:
+                    regex += re.escape(c)
+                else:
+                    char_class = glob[i + 1:end].replace('\\', '\\\\')
+                    regex += '[' + ('^' + char_class[1:] if char_class.startswith('!') else char_class) + ']'
+                    i = end
+            else:
+                regex += re.escape(c)
+
+            i += 1
+
+        return regex
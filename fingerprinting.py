@@ -12,16 +12,25 @@
 #  __email__ = "fabrizio.giudici@tidalwave.it"
 #  __status__ = "Prototype"
 
+import calendar
+import errno
 import hashlib
+import json
 import os
-import re
+import queue
 import shutil
 import sqlite3
 import subprocess
 import sys
+import threading
 import time
-from collections import namedtuple
-from datetime import datetime
+import weakref
+from array import array
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 
 import mmap
@@ -30,139 +39,1050 @@ import xattr
 import utilities
 from config import Config
 from executor import Executor
+from filtering import FileFilter, MATCH_ALL, MANIFEST_FILE
+from ioprofiles import IOProfiles, IOProfile, MB
 from utilities import format_bytes, generate_id, extract, veracrypt_mount_image, veracrypt_unmount_image
 
+XATTR_PREFIX = 'it.tidalwave.datamanager.'
 XATTR_ID = 'it.tidalwave.datamanager.id'
 XATTR_FINGERPRINT = 'it.tidalwave.datamanager.fingerprint.md5'
 XATTR_FINGERPRINT_TIMESTAMP = 'it.tidalwave.datamanager.fingerprint.md5.timestamp'
+XATTR_RECORD = 'it.tidalwave.datamanager.record'
+XATTR_LEGACY = [XATTR_ID, XATTR_FINGERPRINT, XATTR_FINGERPRINT_TIMESTAMP]
 CHARSET = 'utf-8'
-MMAP_THRESHOLD = 128 * 1024 * 1024
+DEFERRED_TIMESTAMP_MAX_AGE = timedelta(days=30)
+REBUILD_BATCH = 10000
+RESTORE_BATCH = 1000
+INGEST_BATCH_ROWS = 5000
+INGEST_BATCH_SECONDS = 5.0
+WRITE_BEHIND_QUEUE_BATCHES = 4
+MANIFEST_CACHE_SIZE = 64
+XATTR_UNSUPPORTED_ERRNOS = {errno.ENOTSUP, errno.EOPNOTSUPP}
+SCHEMA_VERSION = 7
+MIGRATION_BATCH = 50000
+NAME_LOOKUP_BATCH = 500
+EPOCH = datetime(1970, 1, 1)
+BACKUP_COLUMNS = 'uuid AS id, base_path, label, volume_id, encrypted, creation_date, registration_date, latest_check_date'
+TIMESTAMP_COLUMNS = {'timestamp', 'creation_date', 'registration_date', 'latest_check_date'}
+
+#
+# The attributes of a file; legacy contains the names of the legacy attributes found on the file, packed tells whether
+# the file has got the packed record (or, for attributes to write, whether it should get it).
+#
+FileAttributes = namedtuple('FileAttributes', 'file_id, fingerprint, timestamp, legacy, packed', defaults=[False])
+
+#
+# The SQLite settings of a database connection: journal_mode is persistent in the database file, the others are per
+# connection; cache_size is in KiB, mmap_size in bytes. 'default' are the SQLite defaults. Since the journal mode can't
+# be changed while other connections are open, profiles meant to be switched per operation should share it.
+#
+DatabaseProfile = namedtuple('DatabaseProfile', 'name, journal_mode, synchronous, cache_size, mmap_size, temp_store')
+
+DATABASE_PROFILES = {
+    'default': DatabaseProfile('default', journal_mode='delete', synchronous='full', cache_size=2000, mmap_size=0, temp_store='default'),
+    'safe': DatabaseProfile('safe', journal_mode='wal', synchronous='full', cache_size=16 * 1024, mmap_size=0, temp_store='default'),
+    'balanced': DatabaseProfile('balanced', journal_mode='wal', synchronous='normal', cache_size=64 * 1024, mmap_size=256 * MB, temp_store='memory'),
+    'bulk': DatabaseProfile('bulk', journal_mode='wal', synchronous='off', cache_size=256 * 1024, mmap_size=1024 * MB, temp_store='memory')
+}
+
+DEFAULT_DATABASE_PROFILE = 'default'  # WAL and the other profiles are opted in with database-profile in config.yaml
+# Operations use the configured profile; faster but less safe ones, such as 'bulk' for 'rebuild-database' (which can be
+# re-run after a crash), must be opted in with database-operation-profiles in config.yaml.
+DEFAULT_DATABASE_OPERATION_PROFILES = {}
+DATABASE_PRAGMA_VALUES = {
+    'journal_mode': {'delete', 'truncate', 'persist', 'memory', 'wal', 'off'},
+    'synchronous': {'off', 'normal', 'full', 'extra'},
+    'temp_store': {'default', 'file', 'memory'}
+}
+
+
+#
+# The record that packs the id, the fingerprint and its timestamp of a file into the single XATTR_RECORD attribute,
+# as '1;<id>;<fingerprint>;<timestamp>' where 1 is the version, missing values are empty and the timestamp is in the
+# YYYYMMDDTHHMMSS format. Files with the legacy layout (one attribute for each value) are read transparently.
+#
+class PackedAttributes:
+    VERSION = '1'
+    SEPARATOR = ';'
+    TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+    PACKED_TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S'
+
+    #
+    # Returns the record for the given values; the timestamp is in the '%Y-%m-%d %H:%M:%S' format.
+    #
+    @staticmethod
+    def pack(file_id: str, fingerprint: str, timestamp: str) -> str:
+        if timestamp:
+            timestamp = datetime.strptime(timestamp, PackedAttributes.TIMESTAMP_FORMAT).strftime(PackedAttributes.PACKED_TIMESTAMP_FORMAT)
+
+        return PackedAttributes.SEPARATOR.join([PackedAttributes.VERSION, file_id or '', fingerprint or '', timestamp or ''])
+
+    #
+    # Returns (file_id, fingerprint, timestamp) from a record; raises ValueError if the record is not supported.
+    #
+    @staticmethod
+    def unpack(record: str) -> (str, str, str):
+        fields = record.split(PackedAttributes.SEPARATOR)
+
+        if fields[0] != PackedAttributes.VERSION or len(fields) != 4:
+            raise ValueError(f'Unsupported attribute record: {record}')
+
+        file_id, fingerprint, timestamp = [field if field else None for field in fields[1:]]
+
+        if timestamp:
+            timestamp = datetime.strptime(timestamp, PackedAttributes.PACKED_TIMESTAMP_FORMAT).strftime(PackedAttributes.TIMESTAMP_FORMAT)
+
+        return file_id, fingerprint, timestamp
+
+    #
+    # Returns the FileAttributes from the attributes of a file (as a dict name -> value), in either layout. If both are
+    # present, the packed record wins.
+    #
+    @staticmethod
+    def of(attributes: dict) -> FileAttributes:
+        legacy = [name for name in XATTR_LEGACY if name in attributes]
+        record = attributes.get(XATTR_RECORD)
+
+        if record:
+            try:
+                return FileAttributes(*PackedAttributes.unpack(record), legacy, True)
+            except ValueError:
+                pass
+
+        return FileAttributes(attributes.get(XATTR_ID), attributes.get(XATTR_FINGERPRINT), attributes.get(XATTR_FINGERPRINT_TIMESTAMP), legacy)
 
 
 #
 # Storage support for fingerprinting.
 #
 class FingerprintingStorage:
-    def __init__(self, database_folder: str, id_generator=None, debug_function=None):
+    __checked_database_files = set()
+    __schema_lock = threading.Lock()
+    __row_types = {}
+
+    #
+    # Constructor. profile is the name of the default database profile, profile_overrides maps a profile name to the
+    # fields to override (as for I/O profiles, a new profile can be derived from 'base'), operation_profiles maps an
+    # operation to the name of its profile; they default to what's in config.yaml.
+    #
+    def __init__(self, database_folder: str, id_generator=None, profile: str = None, profile_overrides: dict = None,
+                 operation_profiles: dict = None, debug_function=None):
         self.generate_id = id_generator if id_generator is not None else generate_id
         self.debug = debug_function
         self.database_file = f'{database_folder}/fingerprints.db'
-        self.conn = None
+        self.__profile_name = profile
+        self.__profile_overrides = profile_overrides
+        self.__operation_profiles = operation_profiles
+        self.__profiles = None
+        self.__local = threading.local()
+        self.__connections = {}  # connection -> weak reference to the thread that owns it
+        self.__connections_lock = threading.Lock()
 
     #
     # Destructor.
     #
     def __del__(self):
-        self.close()
+        self.close_all()
 
     #
-    # SQLlite can be used only from the thread that opened the connection; so we must open and close a connection every time.
+    # The connection of the current thread, or None. Within snapshot(), the read-only connection.
     #
-    def open(self):
-        self.debug(f'Opening db connection: {self.database_file} ...')
-        self.conn = sqlite3.connect(self.database_file)
+    @property
+    def conn(self) -> sqlite3.Connection:
+        snapshot_conn = getattr(self.__local, 'snapshot_conn', None)
 
-        cursor = self.conn.cursor()
-        cursor.execute("""CREATE TABLE IF NOT EXISTS files (
-                            id TEXT PRIMARY KEY,
-                            path TEXT NOT NULL
-                            );""")
-        cursor.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
-                            id TEXT PRIMARY KEY,
+        if snapshot_conn is not None:
+            return snapshot_conn
+
+        conn = getattr(self.__local, 'conn', None)
+        return conn if conn in self.__connections else None
+
+    #
+    # Makes sure that the current thread has got a connection. SQLite connections can be used only by the thread that
+    # created them, so each thread gets its own one, which is kept open across operations until the thread terminates
+    # (it's closed when another connection is opened, or by close_connection() and close_all()); the schema is checked only
+    # the first time the database is opened in the process. The connection is set up with the database profile of the
+    # given operation, or the default one.
+    #
+    def open(self, operation: str = None):
+        if self.__in_snapshot():
+            return
+
+        if self.conn is None:
+            self.debug(f'Opening db connection: {self.database_file} ...')
+            conn = sqlite3.connect(self.database_file, check_same_thread=False)  # so close_all() can be called by any thread
+            self.__local.conn = conn
+            self.__local.profile = None
+            self.__register_connection(conn)
+
+        profile = self.profile_for(operation)
+
+        if self.__local.profile != profile:
+            self.__apply_profile(profile)
+            self.__local.profile = profile
+
+        with FingerprintingStorage.__schema_lock:
+            if self.database_file not in FingerprintingStorage.__checked_database_files:
+                self.__create_schema()
+                FingerprintingStorage.__checked_database_files.add(self.database_file)
+
+    #
+    # Ends an operation. Uncommitted changes are rolled back, as closing the connection would do, but the connection is
+    # kept for the next operation.
+    #
+    def close(self):
+        if self.conn and not self.__in_snapshot():
+            self.conn.rollback()
+
+    #
+    # Runs the queries in the with block on a separate, read-only connection of the current thread, in a single read
+    # transaction: so they see a consistent snapshot of the database and, in WAL mode, they never wait for a writer,
+    # nor make it wait, even if the current thread is the writer. Snapshots can be nested; open() and close() do nothing
+    # within them, and writes fail.
+    #
+    @contextmanager
+    def snapshot(self):
+        if self.__in_snapshot():
+            yield
+            return
+
+        if self.database_file not in FingerprintingStorage.__checked_database_files:
+            self.open()
+
+        snapshot_conn = getattr(self.__local, 'read_conn', None)
+
+        if snapshot_conn not in self.__connections:
+            snapshot_conn = self.__open_read_connection()
+            self.__local.read_conn = snapshot_conn
+
+        snapshot_conn.execute('BEGIN')
+        self.__local.snapshot_conn = snapshot_conn
+
+        try:
+            yield
+        finally:
+            self.__local.snapshot_conn = None
+            snapshot_conn.execute('COMMIT')
+
+    #
+    # Opens a read-only connection, set up with the per-connection settings of the default profile. Transactions are
+    # handled explicitly.
+    #
+    def __open_read_connection(self) -> sqlite3.Connection:
+        self.debug(f'Opening read-only db connection: {self.database_file} ...')
+        conn = sqlite3.connect(f'{Path(self.database_file).resolve().as_uri()}?mode=ro', uri=True, isolation_level=None, check_same_thread=False)
+        profile = self.profile_for()
+        conn.execute(f'PRAGMA cache_size = {-int(profile.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size = {int(profile.mmap_size)}')
+        self.__register_connection(conn)
+        return conn
+
+    #
+    # Registers a new connection of the current thread. Connections of threads that have terminated (e.g. workers
+    # retired by a thread pool) are closed here, so they don't pile up.
+    #
+    def __register_connection(self, conn: sqlite3.Connection):
+        with self.__connections_lock:
+            dead_connections = [dead_conn for dead_conn, thread_ref in self.__connections.items()
+                                if thread_ref() is None or not thread_ref().is_alive()]
+
+            for dead_conn in dead_connections:
+                del self.__connections[dead_conn]
+
+            self.__connections[conn] = weakref.ref(threading.current_thread())
+
+        for dead_conn in dead_connections:
+            self.debug('Closing db connection of a terminated thread...')
+            dead_conn.close()
+
+    #
+    #
+    #
+    def __in_snapshot(self) -> bool:
+        return getattr(self.__local, 'snapshot_conn', None) is not None
+
+    #
+    # Closes the connection of the current thread, e.g. before the thread terminates.
+    #
+    def close_connection(self):
+        conn = self.conn
+
+        if conn:
+            with self.__connections_lock:
+                self.__connections.pop(conn, None)
+
+            self.debug('Closing db connection...')
+            conn.close()
+
+    #
+    # Returns the database profile for the given operation; if None or not configured, the default profile.
+    #
+    def profile_for(self, operation: str = None) -> DatabaseProfile:
+        if self.__profiles is None:
+            overrides = self.__profile_overrides if self.__profile_overrides is not None else Config.database_profiles_config()
+            operation_profiles = self.__operation_profiles if self.__operation_profiles is not None else Config.database_operation_profiles_config()
+            self.__profiles = self.__merge_profiles(overrides)
+            self.__operation_profiles = {**DEFAULT_DATABASE_OPERATION_PROFILES, **operation_profiles}
+            self.__profile_name = self.__profile_name or Config.database_profile_config() or DEFAULT_DATABASE_PROFILE
+
+        name = self.__operation_profiles.get(operation, self.__profile_name)
+
+        if name not in self.__profiles:
+            raise ValueError(f'Database profile must be one of {sorted(self.__profiles)}, found: {name}')
+
+        return self.__profiles[name]
+
+    #
+    # Closes the connections of all threads.
+    #
+    def close_all(self):
+        with self.__connections_lock:
+            connections = list(self.__connections)
+            self.__connections.clear()
+
+        for conn in connections:
+            self.debug('Closing db connection...')
+            conn.close()
+
+    #
+    # Sets the pragmas of the given profile on the connection of the current thread. Pragmas can't be parameterized, so
+    # values are validated before being put into the statement.
+    #
+    def __apply_profile(self, profile: DatabaseProfile):
+        self.debug(f'Applying database profile: {profile}')
+        pragmas = {'journal_mode': profile.journal_mode, 'synchronous': profile.synchronous, 'cache_size': -int(profile.cache_size),
+                   'mmap_size': int(profile.mmap_size), 'temp_store': profile.temp_store}
+
+        for pragma, value in pragmas.items():
+            if pragma in DATABASE_PRAGMA_VALUES and value not in DATABASE_PRAGMA_VALUES[pragma]:
+                raise ValueError(f'{pragma} must be one of {sorted(DATABASE_PRAGMA_VALUES[pragma])}, found: {value}')
+
+            result = self.conn.execute(f'PRAGMA {pragma} = {value}').fetchone()
+
+            if pragma == 'journal_mode' and result[0] != value:  # e.g. other connections are open
+                self.debug(f'Can\'t change journal_mode to {value}, still {result[0]}')
+
+    #
+    #
+    #
+    @staticmethod
+    def __merge_profiles(overrides: dict) -> dict:
+        profiles = dict(DATABASE_PROFILES)
+
+        for name, fields in overrides.items():
+            if not isinstance(fields, dict):
+                raise ValueError(f'Database profile {name} must be a mapping of fields, found: {fields}')
+
+            fields = dict(fields)
+            base_name = fields.pop('base', name if name in profiles else DEFAULT_DATABASE_PROFILE)
+
+            if base_name not in profiles:
+                raise ValueError(f'Base of database profile {name} must be one of {sorted(profiles)}, found: {base_name}')
+
+            for field, value in fields.items():
+                FingerprintingStorage.__validate_field(name, field, value)
+
+            profiles[name] = profiles[base_name]._replace(name=name, **fields)
+
+        return profiles
+
+    #
+    #
+    #
+    @staticmethod
+    def __validate_field(name: str, field: str, value):
+        fields = [field for field in DatabaseProfile._fields if field != 'name']
+
+        if field not in fields:
+            raise ValueError(f'Field of database profile {name} must be one of {fields}, found: {field}')
+
+        if field in DATABASE_PRAGMA_VALUES:
+            valid = value in DATABASE_PRAGMA_VALUES[field]
+        else:
+            valid = isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+        if not valid:
+            raise ValueError(f'Invalid value for {field} of database profile {name}: {value}')
+
+    #
+    # Creates the schema of a new database, or migrates an existing one to the current version. Databases created before
+    # versioning was introduced have no user_version and are at version 1; new databases are created at version 2 and
+    # then migrated as the others.
+    #
+    def __create_schema(self):
+        self.debug(f'Checking schema: {self.database_file} ...')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+        if version == 0 and self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone():
+            version = 1
+
+        if version == 0:
+            self.conn.execute('BEGIN')  # DDL statements don't start a transaction by themselves
+
+            for statement in self.__tables_v2() + self.__indexes_v2():
+                self.conn.execute(statement)
+
+            self.conn.execute('PRAGMA user_version = 2')
+            self.conn.commit()
+            version = 2
+
+        migrations = {1: self.__migrate_to_v2, 2: self.__migrate_to_v3, 3: self.__migrate_to_v4, 4: self.__migrate_to_v5, 5: self.__migrate_to_v6,
+                      6: self.__migrate_to_v7}
+
+        for from_version in range(version, SCHEMA_VERSION):
+            self.debug(f'Migrating schema from version {from_version}...')
+            migrations[from_version]()
+
+    #
+    # The tables of schema version 2. Rows have INTEGER keys, while UUIDs (files, backups and backup files are referred
+    # to by UUID out of the database) are a secondary attribute; files with an unknown path only have a UUID. Digests
+    # are BLOBs (errors are kept as TEXT) and timestamps are seconds since the epoch, UTC.
+    #
+    @staticmethod
+    def __tables_v2(suffix: str = '') -> [str]:
+        return [f"""CREATE TABLE IF NOT EXISTS files{suffix} (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            path TEXT
+                            );""",
+                f"""CREATE TABLE IF NOT EXISTS fingerprints{suffix} (
+                            id INTEGER PRIMARY KEY,
+                            file_id INTEGER NOT NULL,
                             name TEXT NOT NULL,
-                            file_id TEXT NOT NULL,
                             algorithm TEXT NOT NULL,
-                            fingerprint TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
                             timestamp INTEGER NOT NULL
-                            );""")
-        cursor.execute("""CREATE INDEX IF NOT EXISTS files__path ON files (path);""")
-        cursor.execute("""CREATE INDEX IF NOT EXISTS fingerprints__name ON fingerprints (name);""")
-        cursor.execute("""CREATE INDEX IF NOT EXISTS fingerprints__file_id ON fingerprints (file_id);""")
-        cursor.execute("""CREATE INDEX IF NOT EXISTS fingerprints__timestamp ON fingerprints (timestamp);""")
-
-        cursor.execute("""CREATE TABLE IF NOT EXISTS backups(
-                            id TEXT PRIMARY KEY,
+                            );""",
+                f"""CREATE TABLE IF NOT EXISTS backups{suffix} (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
                             base_path TEXT NOT NULL,
                             label TEXT NOT NULL UNIQUE,
                             volume_id TEXT NOT NULL UNIQUE,
                             encrypted INTEGER NOT NULL,
                             creation_date INTEGER NOT NULL,
                             registration_date INTEGER NOT NULL,
-                            latest_check_date
-                            );""")
-        cursor.execute("""CREATE INDEX IF NOT EXISTS backups__volume_id ON backups (volume_id);""")
-
-        cursor.execute("""CREATE TABLE IF NOT EXISTS backup_files(
-                            id TEXT PRIMARY KEY,
-                            backup_id TEXT NOT NULL,
-                            file_id TEXT NOT NULL,
+                            latest_check_date INTEGER
+                            );""",
+                f"""CREATE TABLE IF NOT EXISTS backup_files{suffix} (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            backup_id INTEGER NOT NULL,
+                            file_id INTEGER NOT NULL,
                             path TEXT NOT NULL
+                            );""",
+                f"""CREATE TABLE IF NOT EXISTS backup_fingerprints{suffix} (
+                            id INTEGER PRIMARY KEY,
+                            backup_file_id INTEGER NOT NULL,
+                            algorithm TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
+                            timestamp INTEGER NOT NULL
+                            );"""]
+
+    #
+    # The indexes of schema version 2, created after the tables have been populated.
+    #
+    @staticmethod
+    def __indexes_v2() -> [str]:
+        return ['CREATE INDEX IF NOT EXISTS files__path ON files (path);',
+                'CREATE INDEX IF NOT EXISTS fingerprints__name ON fingerprints (name);',
+                'CREATE INDEX IF NOT EXISTS fingerprints__file_id ON fingerprints (file_id);',
+                'CREATE INDEX IF NOT EXISTS fingerprints__timestamp ON fingerprints (timestamp);',
+                'CREATE INDEX IF NOT EXISTS backup_fingerprints__backup_file_id ON backup_fingerprints (backup_file_id);']
+
+    #
+    # Migrates from version 1 (UUID TEXT keys, hex digests, timestamps as strings). Rows are copied into new tables in
+    # chunks, each one committed together with the progress in the schema_migration table, so an interrupted migration
+    # resumes from the last committed chunk. Fingerprints of backup files, which shared the file_id column, are moved
+    # to backup_fingerprints. Then the old tables are replaced in a single transaction and the database is vacuumed.
+    #
+    def __migrate_to_v2(self):
+        conn = self.conn
+        conn.create_function('to_epoch', 1, self.__to_epoch, deterministic=True)
+        conn.create_function('pack_digest', 2, self.__pack_digest, deterministic=True)
+
+        for statement in self.__tables_v2('_v2'):
+            conn.execute(statement)
+
+        steps = [
+            ('files', ['INSERT INTO files_v2(uuid, path) SELECT id, path FROM files WHERE rowid > ? AND rowid <= ? ORDER BY rowid']),
+            ('backups', ['INSERT INTO backups_v2(uuid, base_path, label, volume_id, encrypted, creation_date, registration_date, latest_check_date) '
+                         'SELECT id, base_path, label, volume_id, encrypted, to_epoch(creation_date), to_epoch(registration_date), '
+                         'to_epoch(latest_check_date) FROM backups WHERE rowid > ? AND rowid <= ? ORDER BY rowid']),
+            ('backup_files', ['INSERT OR IGNORE INTO files_v2(uuid) SELECT file_id FROM backup_files WHERE rowid > ? AND rowid <= ?',
+                              'INSERT INTO backup_files_v2(uuid, backup_id, file_id, path) '
+                              'SELECT b.id, (SELECT id FROM backups_v2 WHERE uuid = b.backup_id), (SELECT id FROM files_v2 WHERE uuid = b.file_id), b.path '
+                              'FROM backup_files b WHERE b.rowid > ? AND b.rowid <= ? ORDER BY b.rowid']),
+            ('fingerprints', ['INSERT OR IGNORE INTO files_v2(uuid) SELECT file_id FROM fingerprints WHERE rowid > ? AND rowid <= ? '
+                              'AND file_id NOT IN (SELECT uuid FROM backup_files_v2)',
+                              'INSERT INTO fingerprints_v2(file_id, name, algorithm, fingerprint, timestamp) '
+                              'SELECT n.id, f.name, f.algorithm, pack_digest(f.algorithm, f.fingerprint), to_epoch(f.timestamp) '
+                              'FROM fingerprints f JOIN files_v2 n ON n.uuid = f.file_id WHERE f.rowid > ? AND f.rowid <= ? ORDER BY f.rowid',
+                              'INSERT INTO backup_fingerprints_v2(backup_file_id, algorithm, fingerprint, timestamp) '
+                              'SELECT b.id, f.algorithm, pack_digest(f.algorithm, f.fingerprint), to_epoch(f.timestamp) '
+                              'FROM fingerprints f JOIN backup_files_v2 b ON b.uuid = f.file_id WHERE f.rowid > ? AND f.rowid <= ? ORDER BY f.rowid'])
+        ]
+
+        self.__migrate_in_chunks(steps)
+        conn.execute('BEGIN')
+
+        for table in ['fingerprints', 'backup_files', 'backups', 'files']:
+            conn.execute(f'DROP TABLE {table}')
+
+        for table in ['files', 'fingerprints', 'backups', 'backup_files', 'backup_fingerprints']:
+            conn.execute(f'ALTER TABLE {table}_v2 RENAME TO {table}')
+
+        for statement in self.__indexes_v2():
+            conn.execute(statement)
+
+        conn.execute('DROP TABLE schema_migration')
+        conn.execute('PRAGMA user_version = 2')
+        conn.commit()
+        self.debug('Vacuuming...')
+        conn.execute('VACUUM')
+
+    #
+    # Runs the statements of each (table, statements) step for chunks of rows of the table, in rowid order; statements
+    # take the first (excluded) and the last rowid of the chunk. Each chunk is committed together with the progress in
+    # the schema_migration table, so an interrupted migration resumes from the last committed chunk. The caller drops
+    # schema_migration when the migration is complete. description is appended to the table name in progress messages.
+    #
+    def __migrate_in_chunks(self, steps: [(str, [str])], description: str = ''):
+        conn = self.conn
+        conn.execute('CREATE TABLE IF NOT EXISTS schema_migration (step TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL);')
+
+        for table, statements in steps:
+            row = conn.execute('SELECT last_rowid FROM schema_migration WHERE step = ?', (table,)).fetchone()
+            last_rowid = row[0] if row else 0
+
+            while True:
+                high_rowid = conn.execute(f'SELECT max(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)',
+                                          (last_rowid, MIGRATION_BATCH)).fetchone()[0]
+
+                if high_rowid is None:
+                    break
+
+                for statement in statements:
+                    conn.execute(statement, (last_rowid, high_rowid))
+
+                conn.execute('INSERT OR REPLACE INTO schema_migration(step, last_rowid) VALUES(?, ?)', (table, high_rowid))
+                conn.commit()
+                last_rowid = high_rowid
+                self.debug(f'Migrated {table}{description} up to row {last_rowid}')
+
+    #
+    # Migrates from version 2, adding the name of files (the last segment of the path), so they can be looked up by
+    # name with an index. Names are filled in chunks of rows, each one committed, starting from the first row without
+    # a name: so an interrupted migration resumes where it stopped.
+    #
+    def __migrate_to_v3(self):
+        conn = self.conn
+        conn.create_function('basename', 1, os.path.basename, deterministic=True)
+
+        if 'name' not in [row[1] for row in conn.execute('PRAGMA table_info(files)')]:
+            conn.execute('ALTER TABLE files ADD COLUMN name TEXT')
+
+        last_rowid = conn.execute('SELECT min(rowid) - 1 FROM files WHERE name IS NULL AND path IS NOT NULL').fetchone()[0]
+        max_rowid = conn.execute('SELECT max(rowid) FROM files').fetchone()[0]
+
+        while last_rowid is not None and last_rowid < max_rowid:
+            high_rowid = last_rowid + MIGRATION_BATCH
+            conn.execute('UPDATE files SET name = basename(path) WHERE rowid > ? AND rowid <= ? AND path IS NOT NULL', (last_rowid, high_rowid))
+            conn.commit()
+            last_rowid = high_rowid
+            self.debug(f'Migrated names of files up to row {min(last_rowid, max_rowid)}')
+
+        conn.execute('BEGIN')
+        conn.execute('CREATE INDEX IF NOT EXISTS files__name ON files (name);')
+        conn.execute('PRAGMA user_version = 3')
+        conn.commit()
+
+    #
+    # Migrates from version 3, adding the latest fingerprint of each file for each algorithm. The table is maintained by
+    # triggers, so it's always updated in the same transaction as fingerprints, whatever the statement that changes them.
+    # The backfill resumes from the last file id already present.
+    #
+    def __migrate_to_v4(self):
+        conn = self.conn
+        conn.execute('BEGIN')
+        conn.execute("""CREATE TABLE IF NOT EXISTS latest_fingerprints (
+                            file_id INTEGER NOT NULL,
+                            algorithm TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
+                            timestamp INTEGER NOT NULL,
+                            PRIMARY KEY (file_id, algorithm)
+                            ) WITHOUT ROWID;""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS fingerprints__insert AFTER INSERT ON fingerprints BEGIN
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                VALUES(new.file_id, new.algorithm, new.fingerprint, new.timestamp)
+                                ON CONFLICT(file_id, algorithm) DO UPDATE SET fingerprint = excluded.fingerprint, timestamp = excluded.timestamp
+                                WHERE excluded.timestamp >= latest_fingerprints.timestamp;
+                            END;""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS fingerprints__delete AFTER DELETE ON fingerprints BEGIN
+                            DELETE FROM latest_fingerprints WHERE file_id = old.file_id AND algorithm = old.algorithm;
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                SELECT file_id, algorithm, fingerprint, max(timestamp) FROM fingerprints
+                                WHERE file_id = old.file_id AND algorithm = old.algorithm GROUP BY file_id, algorithm;
+                            END;""")
+        conn.commit()
+        self.__backfill_latest_fingerprints(conn.execute('SELECT coalesce(max(file_id), 0) FROM latest_fingerprints').fetchone()[0], None, 'timestamp')
+        conn.execute('PRAGMA user_version = 4')
+        conn.commit()
+
+    #
+    # Migrates from version 4, adding the indexes for the lookups of backup items and backups by mount point. The history
+    # of fingerprints is indexed by (file_id, timestamp), which serves both the lookups by file and the check for
+    # duplicates in bulk_add_fingerprints, so the index on file_id alone is dropped.
+    #
+    def __migrate_to_v5(self):
+        conn = self.conn
+        conn.execute('BEGIN')
+        conn.execute('CREATE INDEX IF NOT EXISTS fingerprints__file_id_timestamp ON fingerprints (file_id, timestamp);')
+        conn.execute('DROP INDEX IF EXISTS fingerprints__file_id;')
+        conn.execute('CREATE INDEX IF NOT EXISTS backup_files__backup_id_file_id ON backup_files (backup_id, file_id);')
+        conn.execute('CREATE INDEX IF NOT EXISTS backups__base_path ON backups (base_path);')
+        conn.execute('PRAGMA user_version = 5')
+        conn.commit()
+
+    #
+    # Migrates from version 5, making the history of fingerprints change-only: a row is a run of scans that found the
+    # same fingerprint, from timestamp (the first one) to last_seen (the latest one, NULL if it's the same). The latest
+    # fingerprints now record when they were last seen, so the triggers are replaced; the latest fingerprint is only
+    # recomputed when the deleted row might be it, so compacting doesn't rescan the history for each deleted row.
+    # Existing runs of identical rows are collapsed by compact_fingerprints().
+    #
+    def __migrate_to_v6(self):
+        conn = self.conn
+        conn.execute('BEGIN')
+
+        if 'last_seen' not in [row[1] for row in conn.execute('PRAGMA table_info(fingerprints)')]:
+            conn.execute('ALTER TABLE fingerprints ADD COLUMN last_seen INTEGER')
+
+        conn.execute('DROP TRIGGER IF EXISTS fingerprints__insert;')
+        conn.execute('DROP TRIGGER IF EXISTS fingerprints__delete;')
+        conn.execute("""CREATE TRIGGER fingerprints__insert AFTER INSERT ON fingerprints BEGIN
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                VALUES(new.file_id, new.algorithm, new.fingerprint, coalesce(new.last_seen, new.timestamp))
+                                ON CONFLICT(file_id, algorithm) DO UPDATE SET fingerprint = excluded.fingerprint, timestamp = excluded.timestamp
+                                WHERE excluded.timestamp >= latest_fingerprints.timestamp;
+                            END;""")
+        conn.execute("""CREATE TRIGGER fingerprints__update AFTER UPDATE OF last_seen ON fingerprints BEGIN
+                            UPDATE latest_fingerprints SET timestamp = new.last_seen
+                                WHERE file_id = new.file_id AND algorithm = new.algorithm AND fingerprint = new.fingerprint
+                                AND timestamp < new.last_seen;
+                            END;""")
+        conn.execute("""CREATE TRIGGER fingerprints__delete AFTER DELETE ON fingerprints
+                            WHEN EXISTS (SELECT 1 FROM latest_fingerprints WHERE file_id = old.file_id AND algorithm = old.algorithm
+                                         AND fingerprint = old.fingerprint AND timestamp <= coalesce(old.last_seen, old.timestamp)) BEGIN
+                            DELETE FROM latest_fingerprints WHERE file_id = old.file_id AND algorithm = old.algorithm;
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                SELECT file_id, algorithm, fingerprint, max(coalesce(last_seen, timestamp)) FROM fingerprints
+                                WHERE file_id = old.file_id AND algorithm = old.algorithm GROUP BY file_id, algorithm;
+                            END;""")
+        conn.execute('PRAGMA user_version = 6')
+        conn.commit()
+
+    #
+    # Migrates from version 6, normalizing the paths of files and backup files into a folder and a name. Folders are
+    # stored once in the folders table, with a trailing '/' (so the path of a file is the path of its folder followed by
+    # its name, and the files in a folder and its subfolders are found by a range scan on the folders). Folders of
+    # backup files are relative to the base path of the backup. The two tables are rebuilt as in version 2, keeping
+    # the row ids, and the database is vacuumed. Paths of files are unique from now on: where more files share a path,
+    # only the one fingerprinted most recently keeps it.
+    #
+    def __migrate_to_v7(self):
+        conn = self.conn
+        conn.create_function('folder_of', 1, lambda path: self.__split_path(path)[0] if path is not None else None, deterministic=True)
+        conn.create_function('name_of', 1, lambda path: self.__split_path(path)[1] if path is not None else None, deterministic=True)
+        conn.execute("""CREATE TABLE IF NOT EXISTS folders (
+                            id INTEGER PRIMARY KEY,
+                            path TEXT NOT NULL UNIQUE
                             );""")
-        self.conn.commit()
+        conn.execute("""CREATE TABLE IF NOT EXISTS files_v7 (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            folder_id INTEGER,
+                            name TEXT
+                            );""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS backup_files_v7 (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            backup_id INTEGER NOT NULL,
+                            file_id INTEGER NOT NULL,
+                            folder_id INTEGER NOT NULL,
+                            name TEXT NOT NULL
+                            );""")
+        steps = [
+            ('files', ['INSERT OR IGNORE INTO folders(path) SELECT DISTINCT folder_of(path) FROM files WHERE rowid > ? AND rowid <= ? AND path IS NOT NULL',
+                       'INSERT INTO files_v7(id, uuid, folder_id, name) SELECT f.id, f.uuid, d.id, name_of(f.path) '
+                       'FROM files f LEFT JOIN folders d ON d.path = folder_of(f.path) WHERE f.rowid > ? AND f.rowid <= ? ORDER BY f.rowid']),
+            ('backup_files', ['INSERT OR IGNORE INTO folders(path) SELECT DISTINCT folder_of(path) FROM backup_files WHERE rowid > ? AND rowid <= ?',
+                              'INSERT INTO backup_files_v7(id, uuid, backup_id, file_id, folder_id, name) '
+                              'SELECT b.id, b.uuid, b.backup_id, b.file_id, d.id, name_of(b.path) '
+                              'FROM backup_files b JOIN folders d ON d.path = folder_of(b.path) WHERE b.rowid > ? AND b.rowid <= ? ORDER BY b.rowid'])
+        ]
+        self.__migrate_in_chunks(steps, ' to version 7')
+        conn.execute('BEGIN')
+
+        for table in ['files', 'backup_files']:
+            conn.execute(f'DROP TABLE {table}')
+            conn.execute(f'ALTER TABLE {table}_v7 RENAME TO {table}')
+
+        conn.execute('CREATE INDEX IF NOT EXISTS files__name ON files (name);')
+        self.__clear_duplicate_paths()
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS files__folder_id_name ON files (folder_id, name);')
+        conn.execute('CREATE INDEX IF NOT EXISTS backup_files__backup_id_file_id ON backup_files (backup_id, file_id);')
+        conn.execute('DROP TABLE schema_migration')
+        conn.execute('PRAGMA user_version = 7')
+        conn.commit()
+        self.debug('Vacuuming...')
+        conn.execute('VACUUM')
+
+    #
+    # Clears the paths of files that share them with a file fingerprinted more recently (e.g. a tracked file that was
+    # replaced by another one before moves were detected), so they can be made unique. Duplicates are rare.
+    #
+    def __clear_duplicate_paths(self):
+        duplicates = self.conn.execute('SELECT folder_id, name FROM files WHERE folder_id IS NOT NULL GROUP BY folder_id, name HAVING COUNT(*) > 1').fetchall()
+
+        for folder_id, name in duplicates:
+            rows = self.conn.execute('SELECT f.id FROM files f LEFT JOIN latest_fingerprints l ON l.file_id = f.id WHERE f.folder_id = ? AND f.name = ? '
+                                     'GROUP BY f.id ORDER BY coalesce(max(l.timestamp), 0) DESC, f.id DESC', (folder_id, name)).fetchall()
+            self.debug(f'Clearing duplicate paths of files: {[row[0] for row in rows[1:]]}')
+            self.conn.executemany('UPDATE files SET folder_id = NULL, name = NULL WHERE id = ?', rows[1:])
+
+    #
+    # Returns the (id, path) mappings, ordered by folder and name.
+    #
+    def find_mappings(self) -> [(str, str)]:
+        return self.__query('SELECT f.uuid, d.path || f.name FROM folders d JOIN files f ON f.folder_id = d.id ORDER BY d.path, f.name', (), commit=True)
 
     #
-    # Closes the connection to the database.
+    # Iterates over the (id, path) mappings of files in the given folder (recursively), ordered by folder and name, as
+    # FileCatalog.sort() does. Rows are streamed from the database in the order of the indexes of folders and files,
+    # without sorting them, so memory usage doesn't depend on the number of files.
     #
-    def close(self):
-        if self.conn:
-            self.debug('Closing db connection...')
-            self.conn.close()
-            self.conn = None
+    def iterate_mappings(self, folder: str):
+        sql = 'SELECT f.uuid, d.path || f.name FROM folders d JOIN files f ON f.folder_id = d.id WHERE d.path >= ? AND d.path < ? ORDER BY d.path, f.name'
+        args = self.__folder_range(folder)
+        self.debug(f'{sql} - {args}')
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+
+        for row in cursor:
+            yield row[0], row[1]
 
     #
-    # Returns the (id, path) mappings.
+    # Returns the path of a file given its id, or None.
     #
-    def find_mappings(self) -> [(str, str)]:
-        return self.__query('SELECT id, path FROM files ORDER BY path', (), commit=True)
+    def find_path_by_id(self, file_id: str) -> str:
+        rows = self.__query('SELECT d.path || f.name FROM files f JOIN folders d ON d.id = f.folder_id WHERE f.uuid = ?', (file_id,))
+        return rows[0][0] if len(rows) == 1 else None
 
     #
     # Adds a new file.
     #
     def add_path(self, file_id: str, path: str, commit=False):
-        self.__update('INSERT INTO files(id, path) VALUES(?, ?)', (file_id, path), commit)
+        self.add_paths([(file_id, path)], commit)
 
     #
     # Updates a file mapping.
     #
     def update_path(self, file_id: str, path: str, commit=False):
-        self.__update('UPDATE files SET path = ? WHERE id = ?', (path, file_id), commit)
+        self.update_paths([(file_id, path)], commit)
+
+    #
+    # Updates many (file_id, path) file mappings at once.
+    #
+    def update_paths(self, mappings: [(str, str)], commit=False):
+        rows = self.__add_folders(mappings)
+        self.__update_many('UPDATE files SET folder_id = (SELECT id FROM folders WHERE path = ?), name = ? WHERE uuid = ?',
+                           [(folder, name, file_id) for file_id, folder, name in rows], commit)
+
+    #
+    # Forgets the paths of the given files, which are no more where they were; their history is kept.
+    #
+    def clear_paths(self, file_ids: [str], commit=False):
+        self.__update_many('UPDATE files SET folder_id = NULL, name = NULL WHERE uuid = ?', [(file_id,) for file_id in file_ids], commit)
+
+    #
+    # Moves all the files in a folder (recursively) to another folder. Names don't change. Only the folders are updated,
+    # unless some of them already exist at the new path: in that case their files are moved to the existing ones, and
+    # files already there with the same name, which the moved ones replace, lose their path. Returns the (id, path) of
+    # the replaced files.
+    #
+    def rename_folder(self, old_folder: str, new_folder: str, commit=False) -> [(str, str)]:
+        folders = self.__query('SELECT id, path FROM folders WHERE path >= ? AND path < ?', self.__folder_range(old_folder))
+        renamed_ids = {folder_id for folder_id, _ in folders}
+        renames = []
+        replaced = []
+
+        for folder_id, path in folders:
+            new_path = f'{new_folder}{path[len(old_folder):]}'
+            rows = self.__query('SELECT id FROM folders WHERE path = ?', (new_path,))
+
+            if rows and rows[0][0] not in renamed_ids:
+                clashes = self.__query('SELECT t.uuid, t.name FROM files t JOIN files f ON f.name = t.name WHERE t.folder_id = ? AND f.folder_id = ?',
+                                       (rows[0][0], folder_id))
+                replaced += [(file_id, f'{new_path}{name}') for file_id, name in clashes]
+                self.clear_paths([file_id for file_id, _ in clashes])
+                self.__update('UPDATE files SET folder_id = ? WHERE folder_id = ?', (rows[0][0], folder_id))
+                self.__update('DELETE FROM folders WHERE id = ?', (folder_id,))
+            else:
+                renames += [(new_path, folder_id)]
+
+        # first to temporary paths (without the trailing '/', so they can't clash), as a new path might be an old one
+        self.__update_many('UPDATE folders SET path = CAST(id AS TEXT) WHERE id = ?', [(folder_id,) for _, folder_id in renames])
+        self.__update_many('UPDATE folders SET path = ? WHERE id = ?', renames, commit)
+        return replaced
+
+    #
+    # Returns the number of files in a folder (recursively).
+    #
+    def count_files(self, folder: str) -> int:
+        return self.__query('SELECT COUNT(*) FROM folders d JOIN files f ON f.folder_id = d.id WHERE d.path >= ? AND d.path < ?',
+                            self.__folder_range(folder))[0][0]
+
+    #
+    # Returns (folder, file count) tuples for the given folder and its subfolders that contain files, ordered by path.
+    # Counts are not recursive; folders end with '/'.
+    #
+    def count_files_by_folder(self, folder: str) -> [(str, int)]:
+        return self.__query('SELECT d.path, COUNT(*) FROM folders d JOIN files f ON f.folder_id = d.id WHERE d.path >= ? AND d.path < ? '
+                            'GROUP BY d.path ORDER BY d.path', self.__folder_range(folder))
+
+    #
+    # Adds the folders of the given (id, path) tuples, if not already present. Returns (id, folder, name) tuples.
+    #
+    def __add_folders(self, mappings: [(str, str)]) -> [(str, str, str)]:
+        rows = [(file_id, *self.__split_path(path)) for file_id, path in mappings]
+        self.__update_many('INSERT OR IGNORE INTO folders(path) VALUES(?)', [(folder,) for folder in sorted({folder for _, folder, _ in rows})])
+        return rows
+
+    #
+    # Returns the bounds of the paths of folders in the given folder (recursively), itself included.
+    #
+    @staticmethod
+    def __folder_range(folder: str) -> (str, str):
+        return f'{folder}/', f'{folder}0'  # '0' is the character after '/'
+
+    #
+    # Splits a path into the folder, with the trailing '/', and the name.
+    #
+    @staticmethod
+    def __split_path(path: str) -> (str, str):
+        index = path.rfind('/') + 1
+        return path[:index], path[index:]
 
     #
     #
     #
     def find_file_id_by_name(self, file_name) -> str:
-        rows = self.__query('SELECT id FROM files WHERE path LIKE ?', (f'%/{file_name}',))
+        rows = self.__query('SELECT uuid FROM files WHERE name = ?', (file_name,))
         return rows[0][0] if len(rows) == 1 else None
         # FIXME: len(rows) > 1 should raise an exception
 
     #
-    # Adds a fingerprint into the database.
+    # Returns a dict name -> id for the given file names. Names that are not found, or that are shared by more than a
+    # file, are not included.
+    #
+    def find_file_ids_by_name(self, file_names: [str]) -> dict:
+        file_names = list(set(file_names))
+        result = {}
+        ambiguous = set()
+
+        for i in range(0, len(file_names), NAME_LOOKUP_BATCH):
+            batch = file_names[i:i + NAME_LOOKUP_BATCH]
+
+            for file_name, file_id in self.__query(f'SELECT name, uuid FROM files WHERE name IN ({", ".join("?" * len(batch))})', batch):
+                if file_name in result:
+                    ambiguous.add(file_name)
+
+                result[file_name] = file_id
+
+        return {file_name: file_id for file_name, file_id in result.items() if file_name not in ambiguous}
+
+    #
+    # Adds a fingerprint into the database. The file must be already present.
     #
     def add_fingerprint(self, file_id: str, file_name: str, algorithm: str, fingerprint: str, timestamp, commit=False):
         if not file_id:  # should be done by file_id NOT NULL in the schema, but we have to fix old imported data without file_id first
             raise RuntimeError('file_id can\'t be null')
 
-        t = (self.generate_id(), file_id, file_name, algorithm, fingerprint, timestamp)
-        self.__update('INSERT INTO fingerprints(id, file_id, name, algorithm, fingerprint, timestamp) values(?, ?, ?, ?, ?, ?)', t, commit)
+        self.add_fingerprints([(file_id, file_name, algorithm, fingerprint, timestamp)], commit)
 
     #
-    # Deletes a fingerprint.
+    # Adds many (file_id, path) files at once.
+    #
+    def add_paths(self, files: [(str, str)], commit=False):
+        self.__update_many('INSERT INTO files(uuid, folder_id, name) VALUES(?, (SELECT id FROM folders WHERE path = ?), ?)', self.__add_folders(files),
+                           commit)
+
+    #
+    # Adds many (file_id, file_name, algorithm, fingerprint, timestamp) fingerprints at once. The files must be already
+    # present. The history is change-only: a fingerprint equal to the latest one of the file for the same algorithm
+    # only updates when it was last seen.
+    #
+    def add_fingerprints(self, fingerprints: [(str, str, str, str, datetime)], commit=False):
+        rows = self.__fingerprint_rows(fingerprints)
+        self.__update_many('INSERT INTO fingerprints(file_id, name, algorithm, fingerprint, timestamp) '
+                           'SELECT (SELECT id FROM files WHERE uuid = :file_id), :name, :algorithm, :fingerprint, :timestamp '
+                           'WHERE NOT EXISTS (SELECT 1 FROM latest_fingerprints WHERE file_id = (SELECT id FROM files WHERE uuid = :file_id) '
+                           'AND algorithm = :algorithm AND fingerprint = :fingerprint)', rows)
+        self.__update_last_seen(rows, commit)
+
+    #
+    # Adds many (file_id, path) files at once; files whose id is already present are ignored.
+    #
+    def bulk_add_files(self, files: [(str, str)], commit=False):
+        self.__update_many('INSERT OR IGNORE INTO files(uuid, folder_id, name) VALUES(?, (SELECT id FROM folders WHERE path = ?), ?)',
+                           self.__add_folders(files), commit)
+
+    #
+    # Adds many (file_id, file_name, algorithm, fingerprint, timestamp) fingerprints at once, as add_fingerprints() does;
+    # fingerprints whose timestamp is already covered by a row of the file, or of files that are not present, are
+    # ignored.
+    #
+    def bulk_add_fingerprints(self, fingerprints: [(str, str, str, str, datetime)], commit=False):
+        rows = self.__fingerprint_rows(fingerprints)
+        self.__update_many('INSERT INTO fingerprints(file_id, name, algorithm, fingerprint, timestamp) '
+                           'SELECT f.id, :name, :algorithm, :fingerprint, :timestamp FROM files f WHERE f.uuid = :file_id '
+                           'AND NOT EXISTS (SELECT 1 FROM latest_fingerprints WHERE file_id = f.id AND algorithm = :algorithm AND fingerprint = :fingerprint) '
+                           'AND NOT EXISTS (SELECT 1 FROM fingerprints WHERE file_id = f.id AND timestamp <= :timestamp '
+                           'AND coalesce(last_seen, timestamp) >= :timestamp)', rows)
+        self.__update_last_seen(rows, commit)
+
+    #
+    # Converts (file_id, file_name, algorithm, fingerprint, timestamp) fingerprints to rows with named values.
+    #
+    def __fingerprint_rows(self, fingerprints: [(str, str, str, str, datetime)]) -> [dict]:
+        return [{'file_id': file_id, 'name': file_name, 'algorithm': algorithm, 'fingerprint': self.__pack_digest(algorithm, fingerprint),
+                 'timestamp': self.__to_epoch(timestamp)} for file_id, file_name, algorithm, fingerprint, timestamp in fingerprints]
+
     #
-    def delete_fingerprint(self, fingerprint_id: str, commit=False):
+    # Sets when the latest fingerprints were last seen, for rows that match them and are more recent. Rows just inserted
+    # match too, but they're not more recent, so they're not touched.
+    #
+    def __update_last_seen(self, rows: [dict], commit=False):
+        self.__update_many('UPDATE fingerprints SET last_seen = :timestamp WHERE id = (SELECT f.id FROM latest_fingerprints l '
+                           'JOIN fingerprints f ON f.file_id = l.file_id AND f.algorithm = l.algorithm AND f.fingerprint = l.fingerprint '
+                           'WHERE l.file_id = (SELECT id FROM files WHERE uuid = :file_id) AND l.algorithm = :algorithm '
+                           'AND l.fingerprint = :fingerprint ORDER BY f.timestamp DESC LIMIT 1) '
+                           'AND coalesce(last_seen, timestamp) < :timestamp', rows, commit)
+
+    #
+    # Deletes a fingerprint, given its row id.
+    #
+    def delete_fingerprint(self, fingerprint_id: int, commit=False):
         self.__update('DELETE FROM fingerprints WHERE id = ?', (fingerprint_id,), commit)
 
     #
     # Retrieves (fingerprint, timestamp) tuples for the given file_id.
     #
     def find_fingerprint_by_file_id(self, file_id: str) -> (str, str):
-        return self.__query('SELECT fingerprint, datetime(timestamp) FROM fingerprints WHERE file_id = ? ORDER BY timestamp', (file_id,), commit=False)
+        rows = self.__query('SELECT fingerprint, timestamp FROM fingerprints WHERE file_id = (SELECT id FROM files WHERE uuid = ?) ORDER BY timestamp',
+                            (file_id,), commit=False)
+        return [(self.__unpack_digest(fingerprint), self.__format_epoch(timestamp)) for fingerprint, timestamp in rows]
+
+    #
+    # Retrieves (fingerprint, first_seen, last_seen) tuples for the given file_id: each one is a run of scans that found
+    # the same fingerprint.
+    #
+    def find_fingerprint_ranges_by_file_id(self, file_id: str) -> [(str, str, str)]:
+        rows = self.__query('SELECT fingerprint, timestamp, coalesce(last_seen, timestamp) FROM fingerprints '
+                            'WHERE file_id = (SELECT id FROM files WHERE uuid = ?) ORDER BY timestamp', (file_id,))
+        return [(self.__unpack_digest(fingerprint), self.__format_epoch(first_seen), self.__format_epoch(last_seen))
+                for fingerprint, first_seen, last_seen in rows]
 
     #
     # Retrieves the latest (fingerprint, timestamp) tuple for the given file_id.
     #
     def find_latest_fingerprint_by_id(self, file_id: str) -> (str, str):
-        fingerprints = self.find_fingerprint_by_file_id(file_id)
-        return fingerprints[-1] if len(fingerprints) > 0 else (None, None)
+        rows = self.__query('SELECT fingerprint, timestamp FROM latest_fingerprints WHERE file_id = (SELECT id FROM files WHERE uuid = ?) '
+                            'ORDER BY timestamp DESC LIMIT 1', (file_id,))
+        return (self.__unpack_digest(rows[0][0]), self.__format_epoch(rows[0][1])) if len(rows) > 0 else (None, None)
+
+    #
+    # Retrieves the latest (fingerprint, timestamp) tuple for the given file_id, ignoring errors.
+    #
+    def find_latest_md5_fingerprint_by_id(self, file_id: str) -> (str, str):
+        rows = self.__query("SELECT fingerprint, timestamp FROM latest_fingerprints WHERE file_id = (SELECT id FROM files WHERE uuid = ?) "
+                            "AND algorithm = 'md5'", (file_id,))
+        return (self.__unpack_digest(rows[0][0]), self.__format_epoch(rows[0][1])) if len(rows) > 0 else (None, None)
+
+    #
+    # Recomputes the latest fingerprints from the history, for files whose row id is greater than from_file_id. Files
+    # are processed in chunks, each one committed; progress_function, if given, is called with the current and the
+    # last file id.
+    #
+    def backfill_latest_fingerprints(self, from_file_id: int = 0, progress_function=None):
+        self.__backfill_latest_fingerprints(from_file_id, progress_function, 'coalesce(last_seen, timestamp)')
+
+    #
+    # Collapses the runs of identical fingerprints in the history of each file and algorithm, as recorded before version
+    # 6, into a single row from the first to the last timestamp of the run. Only consecutive rows are merged, so every
+    # change of fingerprint is kept. Files are processed in chunks, each one committed, so an interrupted compaction can
+    # be just run again; progress_function, if given, is called with the current and the last file id. Returns the
+    # number of deleted rows.
+    #
+    def compact_fingerprints(self, progress_function=None) -> int:
+        last_file_id = 0
+        max_file_id = self.conn.execute('SELECT coalesce(max(id), 0) FROM files').fetchone()[0]
+        deleted_count = 0
+
+        while last_file_id < max_file_id:
+            high_file_id = min(last_file_id + MIGRATION_BATCH, max_file_id)
+            rows = self.__query('SELECT id, file_id, algorithm, fingerprint, coalesce(last_seen, timestamp) FROM fingerprints '
+                                'WHERE file_id > ? AND file_id <= ? ORDER BY file_id, timestamp', (last_file_id, high_file_id))
+            runs = {}  # (file_id, algorithm) -> [id of the first row, fingerprint, last_seen]
+            last_seen_updates = {}
+            deleted_ids = []
+
+            for fingerprint_id, file_id, algorithm, fingerprint, last_seen in rows:
+                run = runs.get((file_id, algorithm))
+
+                if run is not None and run[1] == fingerprint:
+                    if last_seen > run[2]:
+                        run[2] = last_seen
+                        last_seen_updates[run[0]] = last_seen
+
+                    deleted_ids += [(fingerprint_id,)]
+                else:
+                    runs[(file_id, algorithm)] = [fingerprint_id, fingerprint, last_seen]
+
+            # last_seen first, so the delete trigger finds the right latest fingerprint
+            self.__update_many('UPDATE fingerprints SET last_seen = ? WHERE id = ?', [(last_seen, fingerprint_id) for fingerprint_id, last_seen
+                                                                                     in last_seen_updates.items()])
+            self.__update_many('DELETE FROM fingerprints WHERE id = ?', deleted_ids, commit=True)
+            deleted_count += len(deleted_ids)
+            last_file_id = high_file_id
+            self.debug(f'Compacted fingerprints up to file {last_file_id}')
+
+            if progress_function:
+                progress_function(last_file_id, max_file_id)
+
+        return deleted_count
+
+    #
+    # See backfill_latest_fingerprints(). seen is the expression of the time a fingerprint was last seen, which changed
+    # in version 6.
+    #
+    def __backfill_latest_fingerprints(self, from_file_id: int, progress_function, seen: str):
+        last_file_id = from_file_id
+        max_file_id = self.conn.execute('SELECT coalesce(max(id), 0) FROM files').fetchone()[0]
+
+        while last_file_id < max_file_id:
+            high_file_id = min(last_file_id + MIGRATION_BATCH, max_file_id)
+            self.__update('INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp) '
+                          f'SELECT file_id, algorithm, fingerprint, max({seen}) FROM fingerprints WHERE file_id > ? AND file_id <= ? '
+                          'GROUP BY file_id, algorithm '
+                          'ON CONFLICT(file_id, algorithm) DO UPDATE SET fingerprint = excluded.fingerprint, timestamp = excluded.timestamp',
+                          (last_file_id, high_file_id), commit=True)
+            last_file_id = high_file_id
+            self.debug(f'Backfilled latest fingerprints up to file {last_file_id}')
+
+            if progress_function:
+                progress_function(last_file_id, max_file_id)
 
     #
     # Adds a backup. Returns the backup id.
@@ -170,8 +1090,8 @@ class FingerprintingStorage:
     def add_backup(self, base_path: str, label: str, volume_id: str, creation_date: datetime, registration_date: datetime, encrypted,
                    commit=False) -> str:
         backup_id = self.generate_id()
-        t = (backup_id, base_path, label, volume_id, creation_date, registration_date, encrypted)
-        self.__update('INSERT INTO backups(id, base_path, label, volume_id, creation_date, registration_date, encrypted) VALUES(?, ?, ?, ?, ?, ? ,?)', t,
+        t = (backup_id, base_path, label, volume_id, self.__to_epoch(creation_date), self.__to_epoch(registration_date), encrypted)
+        self.__update('INSERT INTO backups(uuid, base_path, label, volume_id, creation_date, registration_date, encrypted) VALUES(?, ?, ?, ?, ?, ? ,?)', t,
                       commit)
         return backup_id
 
@@ -180,51 +1100,41 @@ class FingerprintingStorage:
     #
     def find_backup_item_id(self, backup_id: str, file_id: str) -> str:
         t = (backup_id, file_id)
-        result = self.__query('SELECT id from backup_files WHERE backup_id = ? AND file_id = ?', t)
+        result = self.__query('SELECT uuid from backup_files WHERE backup_id = (SELECT id FROM backups WHERE uuid = ?) '
+                              'AND file_id = (SELECT id FROM files WHERE uuid = ?)', t)
         # TODO: error if len > 1
         return result[0][0] if len(result) == 1 else None
 
     #
-    # Returns namedtuples for all registered backups.
+    # Returns namedtuples for all registered backups. It doesn't wait for operations in progress (see snapshot()).
     #
     def get_backups(self) -> namedtuple:
-        need_conn = not self.conn
-
-        if need_conn:
-            self.open()
-
-        try:
-            t = ()
-            return self.__query_nt('SELECT id, base_path, label, volume_id, encrypted, '
-                                   'datetime(creation_date), datetime(registration_date), datetime(latest_check_date) '
-                                   'FROM backups ORDER BY label', t, commit=False)
-        finally:
-            if need_conn:
-                self.close()
+        with self.snapshot():
+            return self.__query_nt(f'SELECT {BACKUP_COLUMNS} FROM backups ORDER BY label', (), commit=False)
 
     #
     # Sets the latest check timestamp.
     #
     def set_backup_check_latest_timestamp(self, backup_id, timestamp):
-        self.__update('UPDATE backups SET latest_check_date=? WHERE id=?', (timestamp, backup_id,))
+        self.__update('UPDATE backups SET latest_check_date=? WHERE uuid=?', (self.__to_epoch(timestamp), backup_id,))
 
     #
     # Returns a namedtuple for a backup given the base_path.
     #
     def find_backup_by_mount_point(self, mount_point: str) -> namedtuple:
-        return self.__single(self.__query_nt('SELECT * FROM backups WHERE base_path=?', (mount_point,)))
+        return self.__single(self.__query_nt(f'SELECT {BACKUP_COLUMNS} FROM backups WHERE base_path=?', (mount_point,)))
 
     #
     # Returns a namedtuple for a backup given the volume id.
     #
     def find_backup_by_volume_id(self, volume_id):
-        return self.__single(self.__query_nt('SELECT * FROM backups WHERE volume_id=?', (volume_id,)))
+        return self.__single(self.__query_nt(f'SELECT {BACKUP_COLUMNS} FROM backups WHERE volume_id=?', (volume_id,)))
 
     #
     # Returns a namedtuple for a backup given the volume label.
     #
     def find_backup_by_label(self, label):
-        return self.__single(self.__query_nt('SELECT * FROM backups WHERE label=?', (label,)))
+        return self.__single(self.__query_nt(f'SELECT {BACKUP_COLUMNS} FROM backups WHERE label=?', (label,)))
 
     #
     #
@@ -242,14 +1152,25 @@ class FingerprintingStorage:
         raise RuntimeError(f'Expected only 0 or 1 results, found {count}')
 
     #
-    # Adds a backup file.
+    # Adds a backup file. Returns the backup file id. If the file is not in the database, it's added with an unknown path.
     #
     def add_backup_item(self, backup_id: str, file_id, backup_file: str, commit=False) -> str:
         backup_item_id = self.generate_id()
-        t = (backup_item_id, backup_id, file_id, backup_file)
-        self.__update('INSERT INTO backup_files(id, backup_id, file_id, path) VALUES(?, ?, ?, ?)', t, commit)
+        self.__update('INSERT OR IGNORE INTO files(uuid) VALUES(?)', (file_id,))
+        _, folder, name = self.__add_folders([(file_id, backup_file)])[0]
+        t = (backup_item_id, backup_id, file_id, folder, name)
+        self.__update('INSERT INTO backup_files(uuid, backup_id, file_id, folder_id, name) VALUES(?, (SELECT id FROM backups WHERE uuid = ?), '
+                      '(SELECT id FROM files WHERE uuid = ?), (SELECT id FROM folders WHERE path = ?), ?)', t, commit)
         return backup_item_id
 
+    #
+    # Adds the fingerprint of a backup file.
+    #
+    def add_backup_fingerprint(self, backup_item_id: str, algorithm: str, fingerprint: str, timestamp, commit=False):
+        t = (backup_item_id, algorithm, self.__pack_digest(algorithm, fingerprint), self.__to_epoch(timestamp))
+        self.__update('INSERT INTO backup_fingerprints(backup_file_id, algorithm, fingerprint, timestamp) '
+                      'VALUES((SELECT id FROM backup_files WHERE uuid = ?), ?, ?, ?)', t, commit)
+
     #
     # Commits the current transaction.
     #
@@ -273,36 +1194,27 @@ class FingerprintingStorage:
         return rows
 
     #
-    # Executes a query into a namedtuple.
+    # Executes a query into a namedtuple. Columns in TIMESTAMP_COLUMNS are converted to datetime.
     #
     def __query_nt(self, sql: str, args, commit=False):
         self.debug(f'{sql} - {args}')
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+        row_type, timestamp_indexes = self.__row_type(tuple(col[0] for col in cursor.description))
 
-        def row_factory(cursor, row):
-            fields = []
-            date_time_fields = []
-
-            for field in [col[0] for col in cursor.description]:
-                if re.match('^datetime(.*)$', field):
-                    field = field[9:-1]
-                    date_time_fields += [field]
-
-                fields += [field]
+        if timestamp_indexes:
+            rows = []
 
-            Row = namedtuple("Row", fields)
-            row = Row(*row)
+            for row in cursor:
+                values = list(row)
 
-            for field in date_time_fields:
-                date_time_str = getattr(row, field)
-                date_time = datetime.strptime(date_time_str, '%Y-%m-%d %H:%M:%S') if date_time_str else None
-                row = row._replace(**{field: date_time})
+                for index in timestamp_indexes:
+                    values[index] = self.__from_epoch(values[index])
 
-            return row
+                rows.append(row_type._make(values))
+        else:
+            rows = list(map(row_type._make, cursor))
 
-        self.conn.row_factory = row_factory
-        cursor = self.conn.cursor()
-        cursor.execute(sql, args)
-        rows = cursor.fetchall()
         #  self.debug(f'>>>> {rows}')
 
         if commit:
@@ -310,6 +1222,20 @@ class FingerprintingStorage:
 
         return rows
 
+    #
+    # Returns the namedtuple type for the given columns and the indexes of those in TIMESTAMP_COLUMNS. They are created
+    # once for each distinct set of columns, and shared by all the instances.
+    #
+    @staticmethod
+    def __row_type(fields: tuple) -> (type, [int]):
+        row_type = FingerprintingStorage.__row_types.get(fields)
+
+        if row_type is None:
+            row_type = (namedtuple('Row', fields), [index for index, field in enumerate(fields) if field in TIMESTAMP_COLUMNS])
+            FingerprintingStorage.__row_types[fields] = row_type
+
+        return row_type
+
     #
     # Executes an update.
     #
@@ -320,6 +1246,64 @@ class FingerprintingStorage:
         if commit:
             self.commit()
 
+    #
+    # Executes an update for each of the given args.
+    #
+    def __update_many(self, sql: str, args_list: list, commit=False):
+        self.debug(f'{sql} [{len(args_list)} rows]')
+        self.conn.cursor().executemany(sql, args_list)
+
+        if commit:
+            self.commit()
+
+    #
+    # Converts a timestamp (a datetime, naive ones are taken as UTC, or a string in ISO format as stored by version 1) to
+    # seconds since the epoch.
+    #
+    @staticmethod
+    def __to_epoch(timestamp) -> int:
+        if timestamp is None or isinstance(timestamp, int):
+            return timestamp
+
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+
+        return calendar.timegm(timestamp.utctimetuple())
+
+    #
+    # Converts seconds since the epoch to a naive datetime.
+    #
+    @staticmethod
+    def __from_epoch(epoch: int) -> datetime:
+        return EPOCH + timedelta(seconds=epoch) if epoch is not None else None
+
+    #
+    # Converts seconds since the epoch to a string as formatted by SQLite datetime().
+    #
+    @staticmethod
+    def __format_epoch(epoch: int) -> str:
+        return (EPOCH + timedelta(seconds=epoch)).strftime(PackedAttributes.TIMESTAMP_FORMAT)
+
+    #
+    # Converts a hex digest to bytes; other values (e.g. error messages) are kept as they are.
+    #
+    @staticmethod
+    def __pack_digest(algorithm: str, fingerprint: str):
+        if algorithm != 'error' and isinstance(fingerprint, str):
+            try:
+                return bytes.fromhex(fingerprint)
+            except ValueError:
+                pass
+
+        return fingerprint
+
+    #
+    # Converts a digest stored as bytes back to hex.
+    #
+    @staticmethod
+    def __unpack_digest(fingerprint) -> str:
+        return fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
+
 
 #
 #
@@ -343,6 +1327,121 @@ class FingerprintingStats:
         self.elapsed = time.time() - self.__start_time
 
 
+#
+# A compact catalog of enumerated files. Folders are interned in a table, names are stored in a single buffer and sizes
+# in an array; FileInfo tuples are only created on the fly while iterating.
+#
+class FileCatalog:
+    #
+    # Constructor.
+    #
+    def __init__(self):
+        self.__folders = []
+        self.__folder_index_by_path = {}
+        self.__folder_indexes = array('I')
+        self.__names = bytearray()
+        self.__name_offsets = array('Q', [0])
+        self.__sizes = array('q')
+        self.__last_key = None
+        self.__sorted = True
+
+    #
+    # Creates a catalog out of FileInfo tuples.
+    #
+    @staticmethod
+    def of(files) -> 'FileCatalog':
+        result = FileCatalog()
+
+        for file in files:
+            result.add(file.folder, file.name, file.size)
+
+        return result
+
+    #
+    # Adds a file.
+    #
+    def add(self, folder: str, name: str, size: int):
+        folder_index = self.__folder_index_by_path.get(folder)
+
+        if folder_index is None:
+            folder_index = len(self.__folders)
+            self.__folders.append(folder)
+            self.__folder_index_by_path[folder] = folder_index
+
+        key = (f'{folder}/', name)
+
+        if self.__sorted and self.__last_key is not None and key < self.__last_key:
+            self.__sorted = False
+
+        self.__last_key = key
+        self.__folder_indexes.append(folder_index)
+        self.__names += os.fsencode(name)
+        self.__name_offsets.append(len(self.__names))
+        self.__sizes.append(size)
+
+    #
+    # Returns the key files are sorted by: (folder, name), with the folder ending with '/'. So the files in a folder
+    # come before those in its subfolders, as the database returns them by walking its indexes, without sorting.
+    #
+    @staticmethod
+    def sort_key(path: str) -> (str, str):
+        index = path.rfind('/') + 1
+        return path[:index], path[index:]
+
+    #
+    # Sorts the catalog by sort_key(). It's a no-op if files were added in order, as enumerate_files() does.
+    #
+    def sort(self):
+        if self.__sorted:
+            return
+
+        order = sorted(range(len(self)), key=self.__key)
+        folder_indexes, names, name_offsets, sizes = array('I'), bytearray(), array('Q', [0]), array('q')
+
+        for i in order:
+            folder_indexes.append(self.__folder_indexes[i])
+            names += self.__names[self.__name_offsets[i]:self.__name_offsets[i + 1]]
+            name_offsets.append(len(names))
+            sizes.append(self.__sizes[i])
+
+        self.__folder_indexes, self.__names, self.__name_offsets, self.__sizes = folder_indexes, names, name_offsets, sizes
+        self.__sorted = True
+
+    #
+    # Returns the total size of files.
+    #
+    def total_size(self) -> int:
+        return sum(self.__sizes)
+
+    #
+    # Returns the approximate memory used by the catalog, excluding the interned folder table.
+    #
+    def footprint(self) -> int:
+        return sum(sys.getsizeof(a) for a in (self.__folder_indexes, self.__names, self.__name_offsets, self.__sizes))
+
+    def __len__(self) -> int:
+        return len(self.__sizes)
+
+    def __getitem__(self, i: int) -> 'FingerprintingFileSystem.FileInfo':
+        if i < 0:
+            i += len(self)
+
+        if not 0 <= i < len(self):
+            raise IndexError('FileCatalog index out of range')
+
+        folder = self.__folders[self.__folder_indexes[i]]
+        name = os.fsdecode(bytes(self.__names[self.__name_offsets[i]:self.__name_offsets[i + 1]]))
+        return FingerprintingFileSystem.FileInfo(name, folder, f'{folder}/{name}', self.__sizes[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __key(self, i: int) -> (str, str):
+        name = os.fsdecode(bytes(self.__names[self.__name_offsets[i]:self.__name_offsets[i + 1]]))
+        return f'{self.__folders[self.__folder_indexes[i]]}/', name
+
+
 #
 #
 #
@@ -352,63 +1451,316 @@ class FingerprintingFileSystem:
     #
     #
     #
-    def __init__(self, stats: FingerprintingStats = None, debug_function=None):
+    def __init__(self, stats: FingerprintingStats = None, io_profiles: IOProfiles = None, debug_function=None):
         self.stats = stats if stats else FingerprintingStats()
         self.debug = debug_function
+        self.__io_profiles = io_profiles
+        self.__manifests = {}
+        self.__dirty_manifests = set()
+        self.__xattr_unsupported_devices = set()
+        self.__manifest_lock = threading.RLock()
+
+    #
+    # Returns the I/O profile for the given path, by default as detected and configured in config.yaml.
+    #
+    def io_profile(self, path: str, device: int = None) -> IOProfile:
+        if self.__io_profiles is None:
+            self.__io_profiles = IOProfiles.from_config(debug_function=self.debug)
+
+        return self.__io_profiles.profile_for(path, device)
 
     #
     # Sets a single attribute.
     #
-    @staticmethod
-    def set_attribute(path: str, name: str, value: str):
-        xattr.setxattr(path, name, value.encode(CHARSET))
+    def set_attribute(self, path: str, name: str, value: str):
+        folder, file_name = os.path.split(path)
+        manifest = self.__manifest(folder)
+
+        if manifest is None:
+            try:
+                xattr.setxattr(path, name, value.encode(CHARSET))
+                return
+            except OSError as e:
+                manifest = self.__xattr_unsupported(folder, e)
+
+        with self.__manifest_lock:
+            manifest.setdefault(file_name, {})[name] = value
+            self.__mark_manifest_dirty(folder)
 
     #
     # Get a single attribute.
     #
-    @staticmethod
-    def get_attribute(path: str, name: str) -> str:
-        return xattr.getxattr(path, name).decode(CHARSET) if name in xattr.listxattr(path) else None
+    def get_attribute(self, path: str, name: str) -> str:
+        return self.get_attributes(path).get(name)
 
     #
-    # Returns a list of files in the given folder (recursively inspected), matching the given filter.
+    # Removes the given attributes.
+    #
+    def remove_attributes(self, path: str, names: [str]):
+        folder, file_name = os.path.split(path)
+        manifest = self.__manifest(folder)
+
+        if manifest is None:
+            for name in names:
+                xattr.removexattr(path, name)
+        else:
+            with self.__manifest_lock:
+                attributes = manifest.get(file_name, {})
+
+                for name in names:
+                    attributes.pop(name, None)
+
+                self.__mark_manifest_dirty(folder)
+
+    #
+    # Gets all the attributes of this application (starting with XATTR_PREFIX) as a dict. Attributes are listed only
+    # once and only those present are read.
+    #
+    def get_attributes(self, path: str) -> dict:
+        folder, file_name = os.path.split(path)
+        manifest = self.__manifest(folder)
+
+        if manifest is None:
+            try:
+                return {name: xattr.getxattr(path, name).decode(CHARSET) for name in xattr.listxattr(path) if name.startswith(XATTR_PREFIX)}
+            except OSError as e:
+                manifest = self.__xattr_unsupported(folder, e)
+
+        with self.__manifest_lock:
+            return dict(manifest.get(file_name, {}))
+
+    #
+    # Writes the pending changes to manifests.
+    #
+    def flush_attributes(self):
+        with self.__manifest_lock:
+            for folder in list(self.__dirty_manifests):
+                self.__write_manifest(folder)
+
+    #
+    # Attributes of files in folders without extended attribute support are stored in a manifest, a single file per
+    # folder that is read once and written when changes to another folder begin (or at flush_attributes()). A folder
+    # uses a manifest if it already contains one or if its device rejected extended attributes. Returns the manifest
+    # (name -> attributes) of the given folder, or None if extended attributes are used.
+    #
+    def __manifest(self, folder: str) -> dict:
+        with self.__manifest_lock:
+            if folder in self.__manifests:
+                return self.__manifests[folder]
+
+            manifest_path = f'{folder}/{MANIFEST_FILE}'
+
+            if os.path.exists(manifest_path):
+                with open(manifest_path, 'rt', encoding=CHARSET) as file:
+                    manifest = json.load(file)['files']
+            elif self.__xattr_unsupported_devices and os.stat(folder).st_dev in self.__xattr_unsupported_devices:
+                manifest = {}
+            else:
+                manifest = None
+
+            if len(self.__manifests) >= MANIFEST_CACHE_SIZE:
+                for cached_folder in [cached_folder for cached_folder in self.__manifests if cached_folder not in self.__dirty_manifests]:
+                    del self.__manifests[cached_folder]
+
+            self.__manifests[folder] = manifest
+            return manifest
+
+    #
+    # Switches the given folder (and its device) to the manifest, if the error is because extended attributes are not
+    # supported; otherwise raises it again.
+    #
+    def __xattr_unsupported(self, folder: str, error: OSError) -> dict:
+        if error.errno not in XATTR_UNSUPPORTED_ERRNOS:
+            raise error
+
+        with self.__manifest_lock:
+            device = os.stat(folder).st_dev
+
+            if device not in self.__xattr_unsupported_devices:
+                self.__xattr_unsupported_devices.add(device)
+
+                if self.debug:
+                    self.debug(f'Extended attributes not supported on {folder}, using manifests')
+
+            self.__manifests[folder] = {}
+            return self.__manifests[folder]
+
+    #
+    # Marks the manifest of the given folder as changed, writing the other changed ones: since files are processed
+    # folder by folder, changes to them are over.
+    #
+    def __mark_manifest_dirty(self, folder: str):
+        for dirty_folder in list(self.__dirty_manifests):
+            if dirty_folder != folder:
+                self.__write_manifest(dirty_folder)
+
+        self.__dirty_manifests.add(folder)
+
+    #
+    # Writes the manifest of the given folder, atomically replacing the previous one.
+    #
+    def __write_manifest(self, folder: str):
+        manifest_path = f'{folder}/{MANIFEST_FILE}'
+        files = {name: attributes for name, attributes in self.__manifests[folder].items() if attributes}
+
+        with open(f'{manifest_path}.tmp', 'wt', encoding=CHARSET) as file:
+            json.dump({'version': 1, 'files': files}, file, separators=(',', ':'), sort_keys=True)
+
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+        self.__dirty_manifests.discard(folder)
+
+    #
+    # Gets the attributes of many files, yielding (path, attributes) in the same order as paths. Reads are performed by
+    # a pool of workers sized after the concurrency of the I/O profile of the first path, keeping a bounded number of
+    # reads in flight; so round trips are overlapped on network file systems.
+    #
+    def get_attributes_batch(self, paths):
+        paths = iter(paths)
+        first_path = next(paths, None)
+
+        if first_path is None:
+            return
+
+        concurrency = self.io_profile(first_path).concurrency
+
+        if concurrency <= 1:
+            yield first_path, self.get_attributes(first_path)
+
+            for path in paths:
+                yield path, self.get_attributes(path)
+
+            return
+
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending.append((first_path, executor.submit(self.get_attributes, first_path)))
+
+            for path in paths:
+                pending.append((path, executor.submit(self.get_attributes, path)))
+
+                if len(pending) >= concurrency * 4:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+
+    #
+    # Returns a catalog of files in the given folders (recursively inspected), matching the given filter. The filter can
+    # be either a regular expression for file names or a FileFilter; excluded folders are pruned without being walked.
+    # Files are enumerated in the order of FileCatalog.sort() (the files of a folder, then its subfolders), so the
+    # catalog of a single folder doesn't need to be sorted afterwards.
     #
     @staticmethod
-    def enumerate_files(folders: [str], file_filter: str = '.*') -> [FileInfo]:
-        result = []
+    def enumerate_files(folders: [str], file_filter=MATCH_ALL) -> 'FileCatalog':
+        file_filter = FileFilter.of(file_filter)
+        result = FileCatalog()
 
         for folder in folders:
-            for sub_folder, _, files in os.walk(folder, followlinks=True):
-                for file in files:
-                    if re.search(file_filter, file.lower()):
-                        path = f'{sub_folder}/{file}'
-                        file_info = FingerprintingFileSystem.FileInfo(file, sub_folder, path, os.stat(path).st_size)
-                        result += [file_info]
+            stack = [(folder, '')]
+
+            while stack:
+                sub_folder, relative_folder = stack.pop()
+                sub_folders = []
+
+                for _, entry in FingerprintingFileSystem.__sorted_entries(sub_folder):
+                    relative_path = f'{relative_folder}/{entry.name}'
+
+                    if entry.is_dir():
+                        if file_filter.accepts_folder(relative_path):
+                            sub_folders.append((entry.path, relative_path))
+                    elif file_filter.accepts_file(relative_path, entry.name):
+                        result.add(sub_folder, entry.name, entry.stat().st_size)
+
+                stack += reversed(sub_folders)
 
         return result
 
     #
-    # Computes a fingerprint; returns (algorithm, fingerprint) or (error, error_message).
+    # Returns the names of (files, folders) contained in the given folder, without recursion, matching the given filter.
+    #
+    @staticmethod
+    def list_folder(folder: str, file_filter=MATCH_ALL) -> ([str], [str]):
+        file_filter = FileFilter.of(file_filter)
+        files = []
+        folders = []
+
+        for _, entry in FingerprintingFileSystem.__sorted_entries(folder):
+            if entry.is_dir():
+                if file_filter.accepts_folder(f'/{entry.name}'):
+                    folders += [entry.name]
+            elif file_filter.accepts_file(f'/{entry.name}', entry.name):
+                files += [entry.name]
+
+        return files, folders
+
+    #
+    # Returns an iterator over the entries of a folder, sorted by name; a sub-folder sorts as its name followed by '/',
+    # as folders do in FileCatalog.sort_key(). Manifests, and temporary copies left behind by a crash, are never returned.
+    #
+    @staticmethod
+    def __sorted_entries(folder: str):
+        try:
+            with os.scandir(folder) as scanner:
+                entries = [(f'{entry.name}/' if entry.is_dir() else entry.name, entry) for entry in scanner
+                           if not entry.name.startswith(MANIFEST_FILE)]
+        except OSError:  # as os.walk() does
+            entries = []
+
+        return iter(sorted(entries, key=lambda item: item[0]))
+
+    #
+    # Computes a fingerprint; returns (algorithm, fingerprint) or (error, error_message). The file is read as specified
+    # by the I/O profile of the file system it belongs to.
     #
     def compute_fingerprint(self, path: str) -> (str, str):
         try:
             with open(path, 'rb') as file:
-                size = os.stat(path).st_size
+                stat = os.fstat(file.fileno())
+                size = stat.st_size
+                profile = self.io_profile(path, stat.st_dev)
+
+                if profile.sequential and hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
-                if size < MMAP_THRESHOLD:  # Preliminary tests, plain I/O is 3x faster
-                    data = file.read()
+                if profile.mmap_threshold is None or size < profile.mmap_threshold:  # Preliminary tests, plain I/O is 3x faster
+                    digest = self.__plain_io_digest(file, profile.chunk_size)
                     self.stats.plain_io_reads = self.stats.plain_io_reads + size
                 else:
                     with mmap.mmap(file.fileno(), length=0, access=mmap.ACCESS_READ) as stream:
-                        data = stream.read()
+                        digest = hashlib.md5(stream).hexdigest()
                         self.stats.mmap_reads = self.stats.mmap_reads + size
 
                 self.stats.processed_file_count = self.stats.processed_file_count + 1
-                return 'md5', hashlib.md5(data).hexdigest()
+                return 'md5', digest
         except OSError as e:
             self.debug(f'While processing {path}: {e.strerror}')
             return 'error', e.strerror
 
+    #
+    # Computes the digest of a file with plain I/O, reading it all at once or in chunks of the given size.
+    #
+    @staticmethod
+    def __plain_io_digest(file, chunk_size: int) -> str:
+        if not chunk_size:
+            return hashlib.md5(file.read()).hexdigest()
+
+        md5 = hashlib.md5()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+
+        while True:
+            count = file.readinto(buffer)
+
+            if not count:
+                break
+
+            md5.update(view[:count])
+
+        return md5.hexdigest()
+
     #
     # Returns the volume UUID.
     #
@@ -528,6 +1880,301 @@ class FingerprintingFileSystem:
         return os.path.exists(file)
 
 
+#
+# Reconciles the files enumerated in a folder with the files table, by merge-joining the two streams ordered by folder
+# and name.
+# Each file is classified as:
+#
+# + unchanged: its path is already in the database (file_id is the id from the database);
+# + new: its path is not in the database and it has no id;
+# + moved: its path is not in the database but its id is, with previous_path;
+# + unknown: its path is not in the database and its id is unknown.
+#
+# Attributes are only read (by means of attributes_reader) for files whose path is not in the database. At the end,
+# rows of the database that didn't match any file are returned as missing (file is None), unless they have been moved
+# to another path. Memory usage is proportional to the number of missing and moved files, not to the database size.
+#
+class Reconciler:
+    UNCHANGED = 'unchanged'
+    NEW = 'new'
+    MOVED = 'moved'
+    UNKNOWN = 'unknown'
+    MISSING = 'missing'
+
+    Item = namedtuple('Item', 'status, file, file_id, previous_path, attributes')
+
+    #
+    # Constructor. files must be sorted as FileCatalog.sort() does, mappings must be (id, path) tuples sorted in the
+    # same way.
+    #
+    def __init__(self, files, mappings, attributes_reader, path_by_id):
+        self.files = files
+        self.mappings = mappings
+        self.attributes_reader = attributes_reader
+        self.path_by_id = path_by_id
+
+    def __iter__(self):
+        moved_ids = set()
+        missing = []
+        mappings = self.__monotonic(self.mappings)
+        mapping = next(mappings, None)
+
+        for file in self.files:
+            key = FileCatalog.sort_key(file.path)
+
+            while mapping is not None and mapping[2] < key:
+                missing += [mapping]
+                mapping = next(mappings, None)
+
+            if mapping is not None and mapping[2] == key:
+                yield Reconciler.Item(Reconciler.UNCHANGED, file, mapping[0], None, None)
+                mapping = next(mappings, None)
+                continue
+
+            attributes = self.attributes_reader(file.path)
+            file_id = attributes[0]
+
+            if file_id is None:
+                yield Reconciler.Item(Reconciler.NEW, file, None, None, attributes)
+                continue
+
+            previous_path = self.path_by_id(file_id)
+
+            if previous_path is None:
+                yield Reconciler.Item(Reconciler.UNKNOWN, file, file_id, None, attributes)
+            else:
+                moved_ids.add(file_id)
+                yield Reconciler.Item(Reconciler.MOVED, file, file_id, previous_path, attributes)
+
+        while mapping is not None:
+            missing += [mapping]
+            mapping = next(mappings, None)
+
+        for file_id, path, _ in missing:
+            if file_id not in moved_ids:
+                yield Reconciler.Item(Reconciler.MISSING, None, file_id, path, None)
+
+    #
+    # Filters mappings so that paths are strictly increasing, yielding (id, path, key) tuples. Paths updated or inserted
+    # while the reconciliation is in progress are always behind the current position; this makes sure that they are
+    # never seen again.
+    #
+    @staticmethod
+    def __monotonic(mappings):
+        previous_key = None
+
+        for file_id, path in mappings:
+            key = FileCatalog.sort_key(path)
+
+            if previous_key is None or key > previous_key:
+                previous_key = key
+                yield file_id, path, key
+
+
+#
+# Buffers the rows written by a scan and inserts them in bulk, in transactions bounded by the number of rows and by
+# time. Actions registered with after_commit(), such as writing the attributes that refer to the rows, are performed
+# only after the rows have been committed. So if the process crashes, at most the latest batch is lost, consistently in
+# both the database and the attributes; the next scan finds those files again.
+#
+# If a writer is given, batches are handed over to it and the buffer doesn't wait for them to be committed: actions
+# are performed later, by the thread that uses the buffer, as soon as the writer acknowledges the commit.
+#
+class IngestBuffer:
+    #
+    # Constructor.
+    #
+    def __init__(self, storage: FingerprintingStorage, max_rows: int = INGEST_BATCH_ROWS, max_seconds: float = INGEST_BATCH_SECONDS,
+                 time_function=time.monotonic, writer: 'IngestWriter' = None, debug_function=None):
+        self.storage = storage
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.time_function = time_function
+        self.writer = writer
+        self.debug = debug_function
+        self.__paths = []
+        self.__fingerprints = []
+        self.__actions = []
+        self.__pending_actions = deque()  # of the batches submitted to the writer, in order
+        self.__batch_start = time_function()
+
+    #
+    # Adds a new file.
+    #
+    def add_path(self, file_id: str, path: str):
+        self.__paths += [(file_id, path)]
+
+    #
+    # Adds a fingerprint.
+    #
+    def add_fingerprint(self, file_id: str, file_name: str, algorithm: str, fingerprint: str, timestamp):
+        if not file_id:
+            raise RuntimeError('file_id can\'t be null')
+
+        self.__fingerprints += [(file_id, file_name, algorithm, fingerprint, timestamp)]
+
+    #
+    # Registers an action to be performed after the current batch has been committed.
+    #
+    def after_commit(self, action):
+        self.__actions += [action]
+
+    #
+    # Flushes the current batch if it's full or old enough. The actions of batches committed in the meantime by the
+    # writer are performed.
+    #
+    def flush_if_needed(self):
+        if len(self.__paths) + len(self.__fingerprints) >= self.max_rows or self.time_function() - self.__batch_start >= self.max_seconds:
+            self.flush()
+        elif self.writer:
+            self.__perform_acknowledged(block=False)
+
+    #
+    # Inserts the buffered rows in a single transaction and then performs the registered actions. With a writer, only
+    # the actions of the batches already committed are performed, unless wait is True.
+    #
+    def flush(self, wait: bool = False):
+        if (self.__paths or self.__fingerprints) and self.debug:
+            self.debug(f'Flushing {len(self.__paths)} files and {len(self.__fingerprints)} fingerprints...')
+
+        if self.writer:
+            if self.__paths or self.__fingerprints or self.__actions:
+                self.__pending_actions.append(self.__actions)
+                self.writer.submit(self.__paths, self.__fingerprints)
+
+            self.__paths, self.__fingerprints, self.__actions = [], [], []
+            self.__batch_start = self.time_function()
+            self.__perform_acknowledged(block=False)
+
+            while wait and self.__pending_actions:
+                self.__perform_acknowledged(block=True)
+
+            return
+
+        if self.__paths or self.__fingerprints:
+            self.storage.add_paths(self.__paths)
+            self.storage.add_fingerprints(self.__fingerprints)
+            self.storage.commit()
+
+        actions = self.__actions
+        self.__paths, self.__fingerprints, self.__actions = [], [], []
+        self.__batch_start = self.time_function()
+
+        for action in actions:
+            action()
+
+    #
+    # Performs the actions of the batches acknowledged by the writer; if block is True, waits for at least one.
+    #
+    def __perform_acknowledged(self, block: bool):
+        for _ in range(self.writer.acknowledged(block)):
+            for action in self.__pending_actions.popleft():
+                action()
+
+
+#
+# Writes the batches of an IngestBuffer in a dedicated thread, which owns its own connection to the database, so that
+# computing fingerprints and waiting for the database overlap instead of adding up. Batches are passed through a
+# bounded queue, so the producer is slowed down if the database can't keep up. Each committed batch is acknowledged, in
+# order, to the producer. An error stops the writer, discarding the following batches, and is raised to the producer.
+#
+# Since the producer keeps reading with its own connection while the writer commits, this requires the WAL journal
+# mode; with other modes a commit would wait for the readers.
+#
+class IngestWriter:
+    #
+    # Constructor. operation selects the database profile of the writer connection.
+    #
+    def __init__(self, storage: FingerprintingStorage, operation: str = None, max_batches: int = WRITE_BEHIND_QUEUE_BATCHES, debug_function=None):
+        self.storage = storage
+        self.operation = operation
+        self.debug = debug_function
+        self.__batches = queue.Queue(maxsize=max_batches)
+        self.__acknowledgements = queue.Queue()
+        self.__error = None
+        self.__thread = None
+
+    #
+    # Starts the writer thread.
+    #
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name='IngestWriter', daemon=True)
+        self.__thread.start()
+
+    #
+    # Submits a batch of (file_id, path) files and (file_id, file_name, algorithm, fingerprint, timestamp)
+    # fingerprints; blocks if the queue is full.
+    #
+    def submit(self, paths: [(str, str)], fingerprints: [(str, str, str, str, datetime)]):
+        self.__raise_error()
+        self.__batches.put((paths, fingerprints))
+
+    #
+    # Returns the number of batches committed since the previous call; if block is True, waits for at least one.
+    #
+    def acknowledged(self, block: bool = False) -> int:
+        count = 0
+
+        try:
+            while True:
+                self.__acknowledgements.get(block=block and count == 0, timeout=0.1)
+                count += 1
+        except queue.Empty:
+            pass
+
+        if count == 0:
+            self.__raise_error()
+
+        return count
+
+    #
+    # Waits for the submitted batches to be written and stops the writer thread. Raises the error of the writer, if any.
+    #
+    def stop(self):
+        if self.__thread:
+            self.__batches.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+        self.__raise_error()
+
+    #
+    #
+    #
+    def __run(self):
+        try:
+            self.storage.open(self.operation)
+        except Exception as e:
+            self.__error = e
+
+        while True:
+            batch = self.__batches.get()
+
+            if batch is None:
+                break
+
+            if self.__error is None:  # otherwise just drains the queue, so the producer never blocks
+                try:
+                    paths, fingerprints = batch
+                    self.storage.add_paths(paths)
+                    self.storage.add_fingerprints(fingerprints)
+                    self.storage.commit()
+                    self.__acknowledgements.put(True)
+                except Exception as e:
+                    self.debug(f'Error while writing: {e}')
+                    self.__error = e
+
+        self.storage.close()
+        self.storage.close_connection()
+
+    #
+    #
+    #
+    def __raise_error(self):
+        if self.__error is not None:
+            raise self.__error
+
+
 #
 # Presentation.
 #
@@ -550,6 +2197,9 @@ class FingerprintingPresentation:
     def notify_file_moved(self, old_path: str, new_path: str):
         pass
 
+    def notify_folder_moved(self, old_path: str, new_path: str, file_count: int):
+        pass
+
     def notify_error(self, message: str):
         pass
 
@@ -572,6 +2222,9 @@ class FingerprintingControl:
                  file_system: FingerprintingFileSystem = None,
                  time_provider=None,
                  id_generator=None,
+                 attribute_timestamps: str = None,
+                 write_behind: bool = None,
+                 packed_attributes: bool = None,
                  log=None,
                  debug_function=None):
         self.executor = executor
@@ -584,63 +2237,135 @@ class FingerprintingControl:
         self.file_system = file_system if file_system else FingerprintingFileSystem(debug_function=debug_function)
         self.log = log
         self.debug = debug_function
+        self.attribute_timestamps = attribute_timestamps
+        self.write_behind = write_behind
+        self.packed_attributes = packed_attributes
+        self.__enumeration_cache = None
 
     #
     # Scans files.
     #
     def scan(self, folder: str, file_filter: str, only_new_files=False):
         stats = self.file_system.stats
+        writer = None
+        completed = False
 
         try:
             stats.reset()
-            self.storage.open()
+            self.storage.open('scan')
+            timestamps_policy = self.attribute_timestamps if self.attribute_timestamps else Config.attribute_timestamps_config()
+            packed_attributes = self.__packed_attributes()
             files = self.__count_files([folder], file_filter)
-            path_map_by_id = self.__load_id_map()
 
             if only_new_files:
                 self.presentation.notify_message('Scanning only new files')
 
             new_timestamp = self.time_provider()
             new_timestamp_str = new_timestamp.strftime("%Y-%m-%d %H:%M:%S")
-            total_progress = sum(file.size for file in files)
+            total_progress = files.total_size()
             current_progress = 0
+            missing_count = 0
+            moves = []
+            moved_ids = set()
+            replaced_ids = []
+            writer = self.__ingest_writer()
+            ingest = IngestBuffer(self.storage, writer=writer, debug_function=self.debug)
+            # New files at tracked paths can be added only after the paths have been cleared, at the end.
+            late_ingest = IngestBuffer(self.storage, max_rows=sys.maxsize, max_seconds=float('inf'), debug_function=self.debug)
+            # In only new files mode attributes are read only for files whose path is not in the database, so prefetching
+            # them all would be a waste.
+            attributes_reader = self.__get_attributes if only_new_files else self.__batch_attributes_reader(files)
+            reconciler = Reconciler(files, self.storage.iterate_mappings(folder), attributes_reader, self.storage.find_path_by_id)
+
+            for item in reconciler:
+                ingest.flush_if_needed()
+
+                if item.status == Reconciler.MISSING:
+                    if item.file_id in moved_ids:  # moved over a tracked file
+                        continue
 
-            for file in files:
+                    self.debug(f'Missing {item.file_id}: {item.previous_path}')
+                    missing_count += 1
+                    continue
+
+                file = item.file
                 path = file.path
                 file_name = file.name
-                file_id, fingerprint, _ = self.__get_attributes(path)
-
-                if file_id is None:
-                    file_id = self.generate_id()
-                    self.file_system.set_attribute(path, XATTR_ID, file_id)
-                    self.storage.add_path(file_id, path, commit=True)
+                file_id = item.file_id
+                target = ingest
+
+                if item.status == Reconciler.UNCHANGED and only_new_files:  # tracked, no need to look at attributes
+                    self.presentation.notify_file(path, is_new=False)
+                    current_progress += file.size
+                    self.presentation.notify_progress(current_progress, total_progress)
+                    continue
+
+                if item.status == Reconciler.UNCHANGED:
+                    attributes = attributes_reader(path)
+                    id_missing = attributes.file_id is None
+
+                    if id_missing:  # a new file at a tracked path, e.g. mv A B; touch A
+                        self.debug(f'{path} replaced by a new file')
+                        replaced_ids += [file_id]
+                        file_id = self.generate_id()
+                        target = late_ingest
+                        target.add_path(file_id, path)
+                    elif attributes.file_id != file_id:  # replaced by another file, e.g. mv B A
+                        previous_path = self.storage.find_path_by_id(attributes.file_id)
+
+                        if previous_path is None:
+                            self.presentation.notify_error(f'Mismatching {attributes.file_id} for {path}, expected {file_id}')
+                            current_progress += file.size
+                            self.presentation.notify_progress(current_progress, total_progress)
+                            continue
+
+                        self.debug(f'{path} replaced by {previous_path}')
+                        replaced_ids += [file_id]
+                        file_id = attributes.file_id
+                        moved_ids.add(file_id)
+                        moves += [(file_id, previous_path, path)]
                 else:
-                    if only_new_files:
-                        self.presentation.notify_file(path, is_new=False)
-                        current_progress += file.size
-                        self.presentation.notify_progress(current_progress, total_progress)
-                        continue
-
-                    if file_id not in path_map_by_id:
-                        self.presentation.notify_error(f'Unknown {file_id} for {path}')
-                        current_progress += file.size
-                        self.presentation.notify_progress(current_progress, total_progress)
-                        continue
-
-                    prev_path = path_map_by_id[file_id]
-
-                    if prev_path != path:
-                        self.presentation.notify_file_moved(prev_path, path)
-                        self.storage.update_path(file_id, path, commit=True)
+                    attributes = item.attributes
+                    id_missing = item.status == Reconciler.NEW
+
+                    if id_missing:
+                        file_id = self.generate_id()
+                        ingest.add_path(file_id, path)
+                    else:
+                        if only_new_files:
+                            self.presentation.notify_file(path, is_new=False)
+                            current_progress += file.size
+                            self.presentation.notify_progress(current_progress, total_progress)
+                            continue
+
+                        if item.status == Reconciler.UNKNOWN:
+                            self.presentation.notify_error(f'Unknown {file_id} for {path}')
+                            current_progress += file.size
+                            self.presentation.notify_progress(current_progress, total_progress)
+                            continue
+
+                        moves += [(file_id, item.previous_path, path)]
 
                 algorithm, new_fingerprint = self.file_system.compute_fingerprint(path)
-                self.storage.add_fingerprint(file_id, file_name, algorithm, new_fingerprint, new_timestamp, commit=True)
+                target.add_fingerprint(file_id, file_name, algorithm, new_fingerprint, new_timestamp)
+
+                fingerprint = attributes.fingerprint
+                packed = attributes.packed or packed_attributes  # files keep the layout they have, unless opted in
 
                 if algorithm == 'error':
+                    if id_missing:
+                        target.after_commit(partial(self.__write_attributes, path, FileAttributes(file_id, None, None, attributes.legacy, packed)))
+
                     self.presentation.notify_error(f'Error for {path}: {new_fingerprint}')
                 else:
-                    self.file_system.set_attribute(path, XATTR_FINGERPRINT, new_fingerprint)
-                    self.file_system.set_attribute(path, XATTR_FINGERPRINT_TIMESTAMP, new_timestamp_str)
+                    new_attributes = FileAttributes(file_id, new_fingerprint, new_timestamp_str, attributes.legacy, packed)
+
+                    # Only the timestamp would change, unless the file is being switched to the packed record.
+                    if not id_missing and not (packed and attributes.legacy) and attributes.packed == packed and new_fingerprint == fingerprint:
+                        target.after_commit(partial(self.__write_timestamp, path, attributes.timestamp, new_attributes, timestamps_policy))
+                    else:
+                        target.after_commit(partial(self.__write_attributes, path, new_attributes))
+
                     self.presentation.notify_file(path, is_new=fingerprint is None)
 
                     if fingerprint is not None and new_fingerprint != fingerprint:
@@ -648,7 +2373,21 @@ class FingerprintingControl:
 
                 current_progress += file.size
                 self.presentation.notify_progress(current_progress, total_progress)
+
+            ingest.flush(wait=True)
+
+            if replaced_ids:  # before the moves, so the paths are free
+                self.storage.clear_paths(replaced_ids)
+
+            self.__apply_moves(moves)
+            late_ingest.flush()
+
+            if missing_count:
+                self.presentation.notify_message(f'{missing_count} files not found in {folder}')
+
+            completed = True
         finally:
+            self.__clean_up(([writer.stop] if writer else []) + [self.file_system.flush_attributes], completed)
             stats.stop()
             total_reads = stats.plain_io_reads + stats.mmap_reads
             elapsed = stats.elapsed
@@ -660,14 +2399,246 @@ class FingerprintingControl:
             self.presentation.notify_message(f'{format_bytes(stats.plain_io_reads)} in plain I/O, {format_bytes(stats.mmap_reads)} in memory mapped I/O')
             self.storage.close()
 
+    #
+    # Migrates the attributes of files in the given folder from the legacy layout to the packed record. Fingerprints are
+    # not computed, so this is much faster than a scan.
+    #
+    def migrate_attributes(self, folder: str, file_filter: str = MATCH_ALL):
+        files = self.__count_files([folder], file_filter)
+        attributes_reader = self.__batch_attributes_reader(files)
+        migrated_count = 0
+
+        for i, file in enumerate(files):
+            attributes = attributes_reader(file.path)
+
+            if attributes.legacy:
+                try:
+                    self.__write_attributes(file.path, attributes._replace(packed=True))
+                    migrated_count += 1
+                except ValueError:  # left in the legacy layout, which is still supported
+                    self.presentation.notify_error(f'Malformed timestamp for {file.path}: {attributes.timestamp}')
+
+            self.presentation.notify_progress(i + 1, len(files))
+
+        self.file_system.flush_attributes()
+        self.presentation.notify_message(f'{migrated_count} files migrated')
+
+    #
+    # Recomputes the latest fingerprint of each file from the history of fingerprints.
+    #
+    def backfill_latest_fingerprints(self):
+        try:
+            self.storage.open('backfill-latest-fingerprints')
+            self.presentation.notify_message('Backfilling latest fingerprints...')
+            self.storage.backfill_latest_fingerprints(progress_function=self.presentation.notify_progress)
+            self.presentation.notify_message('Latest fingerprints backfilled')
+        finally:
+            self.storage.close()
+
+    #
+    # Collapses the runs of identical fingerprints recorded by scans before the history became change-only.
+    #
+    def compact_fingerprints(self):
+        try:
+            self.storage.open('compact-fingerprints')
+            self.presentation.notify_message('Compacting fingerprints...')
+            deleted_count = self.storage.compact_fingerprints(progress_function=self.presentation.notify_progress)
+            self.presentation.notify_message(f'{deleted_count} redundant fingerprints removed')
+        finally:
+            self.storage.close()
+
+    #
+    # Rebuilds the database from the attributes of files in the given folders (by default, the scan folders in
+    # config.yaml), without computing fingerprints. Folders are enumerated in parallel and rows are inserted in bulk;
+    # files and fingerprints already in the database are preserved.
+    #
+    def rebuild_database(self, folders: [str] = None):
+        folders = folders if folders else [scan.path for scan in Config.scan_config().values()]
+
+        if not folders:
+            self.presentation.notify_message('No folders to rebuild the database from')
+            return
+
+        try:
+            self.storage.open('rebuild-database')
+            self.presentation.notify_counting()
+            self.presentation.notify_message(f'Counting files in {folders}...')
+            file_filter = FileFilter.with_standard_excludes()
+
+            def enumerate_files(folder: str) -> FileCatalog:
+                catalog = self.file_system.enumerate_files([folder], file_filter)
+                catalog.sort()  # inserting in the order of the files__folder_id_name index is faster
+                return catalog
+
+            concurrency = max(self.file_system.io_profile(folder).concurrency for folder in folders)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(len(folders), concurrency))) as executor:
+                catalogs = list(executor.map(enumerate_files, folders))
+
+            total_count = sum(len(catalog) for catalog in catalogs)
+            self.presentation.notify_file_count(total_count)
+            current_count = 0
+            untracked_count = 0
+            files = []
+            fingerprints = []
+
+            for catalog in catalogs:
+                for path, attributes in self.file_system.get_attributes_batch(file.path for file in catalog):
+                    attributes = self.__file_attributes(path, attributes)
+                    current_count += 1
+
+                    if attributes.file_id is None:
+                        untracked_count += 1
+                    else:
+                        files += [(attributes.file_id, path)]
+
+                        if attributes.fingerprint and attributes.timestamp:
+                            try:
+                                timestamp = datetime.strptime(attributes.timestamp, PackedAttributes.TIMESTAMP_FORMAT)
+                                fingerprints += [(attributes.file_id, Path(path).name, 'md5', attributes.fingerprint, timestamp)]
+                            except ValueError:  # the file is restored anyway, the next scan will fingerprint it
+                                self.presentation.notify_error(f'Malformed timestamp for {path}: {attributes.timestamp}')
+
+                    if len(files) >= REBUILD_BATCH:
+                        self.__bulk_add(files, fingerprints)
+                        files, fingerprints = [], []
+
+                    self.presentation.notify_progress(current_count, total_count)
+
+            self.__bulk_add(files, fingerprints)
+            self.presentation.notify_message(f'{total_count - untracked_count} files restored, {untracked_count} files without id')
+        finally:
+            self.storage.close()
+
+    #
+    #
+    #
+    def __bulk_add(self, files: [(str, str)], fingerprints: [(str, str, str, str, datetime)]):
+        self.storage.bulk_add_files(files)
+        self.storage.bulk_add_fingerprints(fingerprints)
+        self.storage.commit()
+
+    #
+    # Restores the attributes of files in the given folder that lost them (e.g. after being copied by a tool that doesn't
+    # preserve extended attributes), matching them to the database by path: so the history of fingerprints is kept and
+    # the next scan doesn't treat them as new files. If verify is True, the attributes are restored only if the file
+    # still has the latest fingerprint in the database. Files are verified and written in parallel batches.
+    #
+    def restore_attributes(self, folder: str, file_filter: str = MATCH_ALL, verify: bool = False):
+        try:
+            self.storage.open('restore-attributes')
+            files = self.__count_files([folder], file_filter)
+            attributes_reader = self.__batch_attributes_reader(files)
+            reconciler = Reconciler(files, self.storage.iterate_mappings(folder), attributes_reader, self.storage.find_path_by_id)
+            counts = [0, 0]  # restored, mismatched
+            packed = self.__packed_attributes()
+            batch = []
+            current_count = 0
+
+            for item in reconciler:
+                if item.status == Reconciler.MISSING:
+                    continue
+
+                if item.status == Reconciler.UNCHANGED and attributes_reader(item.file.path).file_id is None:
+                    fingerprint, timestamp = self.storage.find_latest_md5_fingerprint_by_id(item.file_id)
+                    batch += [(item.file.path, FileAttributes(item.file_id, fingerprint, timestamp, [], packed))]
+
+                    if len(batch) >= RESTORE_BATCH:
+                        self.__restore_attributes_batch(batch, verify, counts)
+                        batch = []
+
+                current_count += 1
+                self.presentation.notify_progress(current_count, len(files))
+
+            self.__restore_attributes_batch(batch, verify, counts)
+            self.file_system.flush_attributes()
+            self.presentation.notify_message(f'{counts[0]} files restored' + (f', {counts[1]} mismatched' if verify else ''))
+        finally:
+            self.storage.close()
+
+    #
+    # Restores a batch of (path, attributes) on a pool of workers sized after the concurrency of the I/O profile.
+    #
+    def __restore_attributes_batch(self, batch: [(str, FileAttributes)], verify: bool, counts: [int]):
+        if not batch:
+            return
+
+        def restore(path: str, attributes: FileAttributes) -> str:
+            if verify and attributes.fingerprint:
+                _, fingerprint = self.file_system.compute_fingerprint(path)
+
+                if fingerprint != attributes.fingerprint:
+                    return f'Mismatch for {path}: found {fingerprint} expected {attributes.fingerprint}'
+
+            self.__write_attributes(path, attributes)
+            return None
+
+        concurrency = self.file_system.io_profile(batch[0][0]).concurrency
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for (path, _), error in zip(batch, executor.map(lambda entry: restore(*entry), batch)):
+                if error:
+                    counts[1] += 1
+                    self.presentation.notify_error(error)
+                else:
+                    counts[0] += 1
+                    self.presentation.notify_file(path, is_new=False)
+
+    #
+    # Applies the moves of files detected by a scan, as (file_id, old_path, new_path), in a single transaction. Moves
+    # sharing the same rewrite of the path prefix are notified together as a moved folder; if they are all the files
+    # that were in the old folder, the folder is renamed with a single update.
+    #
+    def __apply_moves(self, moves: [(str, str, str)]):
+        if not moves:
+            return
+
+        for (old_folder, new_folder), group in self.__group_moves(moves).items():
+            if len(group) == 1:
+                file_id, old_path, new_path = group[0]
+                self.presentation.notify_file_moved(old_path, new_path)
+                self.storage.update_paths([(file_id, new_path)])
+            else:
+                self.presentation.notify_folder_moved(old_folder, new_folder, len(group))
+
+                if self.storage.count_files(old_folder) == len(group):
+                    for _, path in self.storage.rename_folder(old_folder, new_folder):
+                        self.presentation.notify_error(f'Replaced by a moved file: {path}')
+                else:
+                    self.storage.update_paths([(file_id, new_path) for file_id, _, new_path in group])
+
+        self.storage.commit()
+
+    #
+    # Groups moves by (old_folder, new_folder), the longest rewrite of the path prefix that explains each of them.
+    #
+    @staticmethod
+    def __group_moves(moves: [(str, str, str)]) -> dict:
+        groups = {}
+
+        for move in moves:
+            _, old_path, new_path = move
+            old_parts = old_path.split('/')
+            new_parts = new_path.split('/')
+            common = 0
+
+            while common < min(len(old_parts), len(new_parts)) - 1 and old_parts[-1 - common] == new_parts[-1 - common]:
+                common += 1
+
+            key = ('/'.join(old_parts[:len(old_parts) - common]), '/'.join(new_parts[:len(new_parts) - common])) if common else (old_path, new_path)
+            groups.setdefault(key, []).append(move)
+
+        return groups
+
     #
     # Registers a new backup.
     #
     def register_backup(self, label: str, mount_point: str, eject_after: bool = False):
         veracrypt_backup, actual_mount_point = self.__check_veracrypt_backup(mount_point)
+        enumeration_scope = self.__begin_enumeration_scope()
 
         try:
-            self.storage.open()
+            self.storage.open('register-backup')
             volume_id = self.file_system.find_volume_uuid(mount_point)  # Beware: of the container volume!
             assert volume_id
             creation_date = self.file_system.creation_date(actual_mount_point)
@@ -685,9 +2656,7 @@ class FingerprintingControl:
             registration_date = self.time_provider()
             backup_id = self.storage.add_backup(actual_mount_point, label, volume_id, creation_date, registration_date, veracrypt_backup)
 
-            for current_progress, file in enumerate(files, start=1):
-                file_id = self.__find_file_id(file.path)
-
+            for current_progress, (file, file_id) in enumerate(self.__find_file_ids(files), start=1):
                 if file_id:
                     backup_file = file.path.replace(f'{actual_mount_point}/', '')
                     self.storage.add_backup_item(backup_id, file_id, backup_file)
@@ -702,6 +2671,7 @@ class FingerprintingControl:
         finally:
             self.storage.close()
             self.__eventually_unmount_veracrypt_backup(veracrypt_backup, actual_mount_point)
+            self.__end_enumeration_scope(enumeration_scope)
 
     #
     # Checks an existing backup.
@@ -709,9 +2679,10 @@ class FingerprintingControl:
     def check_backup(self, mount_point: str, eject_after: bool = False):
         veracrypt_backup, actual_mount_point = self.__check_veracrypt_backup(mount_point)
         new_timestamp = self.time_provider()
+        enumeration_scope = self.__begin_enumeration_scope()
 
         try:
-            self.storage.open()
+            self.storage.open('check-backup')
             current_volume_id = self.file_system.find_volume_uuid(mount_point)  # Beware: of the container volume!
             assert current_volume_id
             backup = self.storage.find_backup_by_volume_id(current_volume_id)
@@ -722,12 +2693,11 @@ class FingerprintingControl:
 
             files = self.__count_files([actual_mount_point])
             check_timestamp = self.time_provider()
-            total_progress = sum(file.size for file in files)
+            total_progress = files.total_size()
             current_progress = 0
 
-            for file in files:
+            for file, file_id in self.__find_file_ids(files):
                 file_relative_path = file.path.replace(f'{actual_mount_point}/', '')
-                file_id = self.__find_file_id(file.path)
 
                 if file_id:
                     self.presentation.notify_file(file_relative_path, is_new=False)
@@ -739,7 +2709,7 @@ class FingerprintingControl:
                         self.presentation.notify_error(f'File was not registered as part of the backup: {file_relative_path} - registering now')
                         backup_item_id = self.storage.add_backup_item(backup.id, file_id, file_relative_path)
 
-                    self.storage.add_fingerprint(backup_item_id, file.name, algorithm, fingerprint, new_timestamp)
+                    self.storage.add_backup_fingerprint(backup_item_id, algorithm, fingerprint, new_timestamp)
 
                     if algorithm == 'error':
                         self.presentation.notify_error(f'{file_relative_path}: {algorithm}')
@@ -757,6 +2727,7 @@ class FingerprintingControl:
         finally:
             self.storage.close()
             self.__eventually_unmount_veracrypt_backup(veracrypt_backup, actual_mount_point)
+            self.__end_enumeration_scope(enumeration_scope)
 
     #
     #
@@ -777,10 +2748,11 @@ class FingerprintingControl:
         opt_image_file = f'{working_folder}/{backup_name}'
         opt_image_file_with_ext = f'{opt_image_file}.dmg'
         key_file = Config.encrypted_backup_key_file()
+        enumeration_scope = self.__begin_enumeration_scope()
 
         try:
             files_to_backup = self.__count_files(folders)
-            total_size = sum(file.size for file in files_to_backup)
+            total_size = files_to_backup.total_size()
             size = int(round((total_size + len(files_to_backup) * 10 * 1024) * 1.02))
 
             # TODO: check size
@@ -799,7 +2771,7 @@ class FingerprintingControl:
 
             self.presentation.notify_message('Copying files...')
             self.presentation.notify_secondary_progress(0)
-            total_progress = sum(file.size for file in files_to_backup)
+            total_progress = total_size
             current_progress = 0
 
             for file in files_to_backup:
@@ -841,6 +2813,8 @@ class FingerprintingControl:
         except BaseException as e:
             self.presentation.notify_error(f'ERROR: Procedure failed: {e}')
         finally:
+            self.__end_enumeration_scope(enumeration_scope)
+
             if burn:
                 self.presentation.notify_message(f'Cleaning up working area ({working_folder})...')
                 self.file_system.remove_folder(working_folder)
@@ -851,22 +2825,20 @@ class FingerprintingControl:
     # or not in function of the 'registered' parameter.
     #
     def mounted_backup_volumes(self, registered: bool):
-        self.storage.open()
         volume_names = os.listdir('/Volumes')
         result = []
 
-        for volume_name in volume_names:
-            mount_point = f'/Volumes/{volume_name}'
-            volume_id = self.file_system.find_volume_uuid(mount_point)
-            backup = self.storage.find_backup_by_volume_id(volume_id) if volume_id else None
+        with self.storage.snapshot():  # don't wait for operations in progress
+            for volume_name in volume_names:
+                mount_point = f'/Volumes/{volume_name}'
+                volume_id = self.file_system.find_volume_uuid(mount_point)
+                backup = self.storage.find_backup_by_volume_id(volume_id) if volume_id else None
 
-            if backup and registered:
-                result += [(mount_point, backup.label)]
+                if backup and registered:
+                    result += [(mount_point, backup.label)]
 
-            elif not backup and not registered:
-                result += [(mount_point, volume_name)]
-
-        self.storage.close()
+                elif not backup and not registered:
+                    result += [(mount_point, volume_name)]
 
         return sorted(result)
 
@@ -969,10 +2941,11 @@ class FingerprintingControl:
 
     #
     # Check whether this is a Veracrypt backup. If it is, mount the encrypted volume and returns the new mount point.
+    # Only the volume root is inspected: a Veracrypt backup contains a single image file and nothing else.
     #
     def __check_veracrypt_backup(self, mount_point: str) -> (bool, str):
-        files_in_volume_root = [file.name for file in self.file_system.enumerate_files([mount_point])]
-        veracrypt_backup = len(files_in_volume_root) == 1 and files_in_volume_root[0].endswith('.veracrypt')
+        files_in_volume_root, folders_in_volume_root = self.file_system.list_folder(mount_point, FileFilter.with_standard_excludes())
+        veracrypt_backup = len(files_in_volume_root) == 1 and not folders_in_volume_root and files_in_volume_root[0].endswith('.veracrypt')
 
         if not veracrypt_backup:
             return False, mount_point
@@ -989,15 +2962,41 @@ class FingerprintingControl:
     #
     #
     #
-    def __count_files(self, folders: [str], file_filter: str = '.*') -> [FingerprintingFileSystem.FileInfo]:
-        self.presentation.notify_counting()
-        self.presentation.notify_message(f'Counting files in {folders}...')
-        files = self.file_system.enumerate_files(folders, file_filter)
-        files = sorted(files, key=lambda file: file.path)
+    def __count_files(self, folders: [str], file_filter: str = MATCH_ALL) -> FileCatalog:
+        key = (tuple(folders), file_filter)
+        files = self.__enumeration_cache.get(key) if self.__enumeration_cache is not None else None
+
+        if files is None:
+            self.presentation.notify_counting()
+            self.presentation.notify_message(f'Counting files in {folders}...')
+            files = self.file_system.enumerate_files(folders, FileFilter.with_standard_excludes(file_filter))
+            files.sort()
+
+            if self.__enumeration_cache is not None:
+                self.__enumeration_cache[key] = files
+
         self.presentation.notify_file_count(len(files))
         self.presentation.notify_message(utilities.file_enumeration_message(files))
         return files
 
+    #
+    # Starts caching enumerated files, so the phases of an operation (e.g. registering and checking a newly burnt backup)
+    # walk the same folders only once. Returns True if the caller owns the scope and must end it.
+    #
+    def __begin_enumeration_scope(self) -> bool:
+        if self.__enumeration_cache is not None:
+            return False
+
+        self.__enumeration_cache = {}
+        return True
+
+    #
+    # Ends the enumeration cache scope, if owned by the caller.
+    #
+    def __end_enumeration_scope(self, owner: bool):
+        if owner:
+            self.__enumeration_cache = None
+
     #
     #
     #
@@ -1007,39 +3006,156 @@ class FingerprintingControl:
             self.file_system.unmount_veracrypt_image(mount_point)
 
     #
+    # Yields (file, file_id) for the given files. Ids are read from attributes; files without them (e.g. on optical discs
+    # that don't support extended attributes) are looked up by name, in batches.
+    #
+    def __find_file_ids(self, files: FileCatalog):
+        batch = []
+
+        for file, (_, attributes) in zip(files, self.file_system.get_attributes_batch(file.path for file in files)):
+            batch += [(file, PackedAttributes.of(attributes).file_id)]
+
+            if len(batch) >= NAME_LOOKUP_BATCH:
+                yield from self.__find_file_ids_by_name(batch)
+                batch = []
+
+        yield from self.__find_file_ids_by_name(batch)
+
     #
+    # Yields (file, file_id) for the given (file, file_id) pairs, looking up by name the missing ids.
     #
-    def __find_file_id(self, path: str) -> str:
-        file_id = self.file_system.get_attribute(path, XATTR_ID)
+    def __find_file_ids_by_name(self, batch: [('FingerprintingFileSystem.FileInfo', str)]):
+        file_names = [file.name for file, file_id in batch if not file_id]
+        file_ids_by_name = self.storage.find_file_ids_by_name(file_names) if file_names else {}
 
-        if not file_id:
-            file_name = Path(path).name
-            file_id = self.storage.find_file_id_by_name(file_name)
+        for file, file_id in batch:
+            yield file, file_id if file_id else file_ids_by_name.get(file.name)
+
+    #
+    # Gets the attributes for the given path.
+    #
+    def __get_attributes(self, path: str) -> FileAttributes:
+        return self.__file_attributes(path, self.file_system.get_attributes(path))
+
+    #
+    # Returns a function that gets the attributes for the given path, prefetching them in
+    # batches for the given files. Paths must be requested in the same order as files (some can be skipped); other paths
+    # are read individually, without consuming the prefetched ones that come after them.
+    #
+    def __batch_attributes_reader(self, files: FileCatalog):
+        batch = self.file_system.get_attributes_batch(file.path for file in files)
+        next_entry = [next(batch, None)]  # the first prefetched (path, attributes) not requested yet
+
+        def read_attributes(path: str) -> FileAttributes:
+            key = FileCatalog.sort_key(path)
+
+            while next_entry[0] is not None:
+                batch_path, attributes = next_entry[0]
+                batch_key = FileCatalog.sort_key(batch_path)
 
-        return file_id
+                if batch_key > key:
+                    break
+
+                next_entry[0] = next(batch, None)
+
+                if batch_key == key:
+                    return self.__file_attributes(path, attributes)
+
+            return self.__get_attributes(path)
+
+        return read_attributes
 
     #
     #
     #
-    def __load_id_map(self) -> dict:
-        self.debug('Retrieving the id mappings ...')
-        path_map_by_id = {}
+    def __file_attributes(self, path: str, attributes: dict) -> FileAttributes:
+        file_attributes = PackedAttributes.of(attributes)
+        self.debug(f'__get_attributes({path}): {file_attributes}')
+
+        return file_attributes
+
+    #
+    # Returns a started writer for the rows of a scan if write-behind is enabled, otherwise None. Write-behind requires
+    # the WAL journal mode, so it's ignored with profiles that don't use it.
+    #
+    def __ingest_writer(self) -> 'IngestWriter':
+        write_behind = self.write_behind if self.write_behind is not None else Config.write_behind_config()
 
-        for file_id, path in self.storage.find_mappings():
-            path_map_by_id[file_id] = path
+        if not write_behind:
+            return None
+
+        if self.storage.profile_for('scan').journal_mode != 'wal':
+            self.debug('Write-behind disabled, as it requires the WAL journal mode')
+            return None
 
-        return path_map_by_id
+        writer = IngestWriter(self.storage, 'scan', debug_function=self.debug)
+        writer.start()
+        return writer
 
     #
-    # Gets (file_id, fingerprint, timestamp) attributes for the given path.
+    # Writes attributes that differ from the current ones only by the timestamp, according to the policy: 'eager' writes
+    # them immediately, 'deferred' writes them only if the timestamp on the file is older than DEFERRED_TIMESTAMP_MAX_AGE
+    # (an age threshold, so scans in the meantime don't touch the file), 'never' skips them. The database always records
+    # the latest verification time.
     #
-    def __get_attributes(self, path: str) -> (str, str, int):
-        file_id = self.file_system.get_attribute(path, XATTR_ID)
-        fingerprint = self.file_system.get_attribute(path, XATTR_FINGERPRINT)
-        timestamp = self.file_system.get_attribute(path, XATTR_FINGERPRINT_TIMESTAMP)
-        self.debug(f'__get_attributes({path}): {file_id}, {fingerprint}, {timestamp}')
+    def __write_timestamp(self, path: str, old_timestamp: str, attributes: FileAttributes, policy: str):
+        if policy == 'eager':
+            self.__write_attributes(path, attributes)
+        elif policy == 'deferred':
+            try:
+                old_time = datetime.strptime(old_timestamp, PackedAttributes.TIMESTAMP_FORMAT)
+            except (TypeError, ValueError):  # missing or malformed, to be rewritten
+                old_time = None
 
-        return file_id, fingerprint, timestamp
+            if old_time is None or datetime.strptime(attributes.timestamp, PackedAttributes.TIMESTAMP_FORMAT) - old_time >= DEFERRED_TIMESTAMP_MAX_AGE:
+                self.__write_attributes(path, attributes)
+
+    #
+    # Runs all the given cleanup actions, even if some of them fail. If the operation completed, the first error is then
+    # raised; otherwise errors are only notified, so they don't replace the one that is being propagated.
+    #
+    def __clean_up(self, actions, completed: bool):
+        first_error = None
+
+        for action in actions:
+            try:
+                action()
+            except Exception as e:
+                if completed and first_error is None:
+                    first_error = e
+                else:
+                    self.presentation.notify_error(f'Error while cleaning up: {e}')
+
+        if first_error:
+            raise first_error
+
+    #
+    # Writes the attributes in the layout given by attributes.packed. The packed record is written and then the legacy
+    # attributes, if any, are removed; in the legacy layout, the id is written only if the file hasn't got it yet.
+    #
+    def __write_attributes(self, path: str, attributes: FileAttributes):
+        if attributes.packed:
+            self.file_system.set_attribute(path, XATTR_RECORD, PackedAttributes.pack(attributes.file_id, attributes.fingerprint, attributes.timestamp))
+
+            if attributes.legacy:
+                self.file_system.remove_attributes(path, attributes.legacy)
+
+            return
+
+        if XATTR_ID not in attributes.legacy:
+            self.file_system.set_attribute(path, XATTR_ID, attributes.file_id)
+
+        if attributes.fingerprint:
+            self.file_system.set_attribute(path, XATTR_FINGERPRINT, attributes.fingerprint)
+
+        if attributes.timestamp:
+            self.file_system.set_attribute(path, XATTR_FINGERPRINT_TIMESTAMP, attributes.timestamp)
+
+    #
+    # Whether attributes are written in the packed layout by default, rather than in the layout of the file.
+    #
+    def __packed_attributes(self) -> bool:
+        return self.packed_attributes if self.packed_attributes is not None else Config.packed_attributes_config()
 
     #
     #
@@ -1080,22 +3196,50 @@ def __main():
         def notify_file_moved(self, old_path: str, new_path: str):
             print(f'{old_path}\n    ↳ {new_path}', flush=True)
 
+        def notify_folder_moved(self, old_path: str, new_path: str, file_count: int):
+            print(f'{old_path}/\n    ↳ {new_path}/ ({file_count} files)', flush=True)
+
         def notify_error(self, message: str):
             print(f'ERROR: {message}', flush=True)
 
     only_new_files = '--only-new-files' in sys.argv
+    migrate_attributes = '--migrate-attributes' in sys.argv
+    rebuild_database = '--rebuild-database' in sys.argv
+    backfill_latest_fingerprints = '--backfill-latest-fingerprints' in sys.argv
+    compact_fingerprints = '--compact-fingerprints' in sys.argv
+    restore_attributes = '--restore-attributes' in sys.argv
 
     if '--scan' in sys.argv:
         pass
         # folder = Config.photos_folder()
         # file_filter = Config.photos_file_filter()
+    elif migrate_attributes and sys.argv.index('--migrate-attributes') + 1 < len(sys.argv):
+        folder = sys.argv[sys.argv.index('--migrate-attributes') + 1]
+    elif rebuild_database or backfill_latest_fingerprints or compact_fingerprints:
+        pass
+    elif restore_attributes and sys.argv.index('--restore-attributes') + 1 < len(sys.argv):
+        folder = sys.argv[sys.argv.index('--restore-attributes') + 1]
     else:
-        print(f'{str(Path(sys.argv[0]).name)} [--scan {Config.scan_config().keys()}] [--only-new-files] [--debug]', flush=True)
+        print(f'{str(Path(sys.argv[0]).name)} [--scan {Config.scan_config().keys()}] [--only-new-files] [--migrate-attributes <folder>] '
+              f'[--rebuild-database] [--restore-attributes <folder> [--verify]] [--backfill-latest-fingerprints] '
+              f'[--compact-fingerprints] [--debug]', flush=True)
         sys.exit(1)
 
     presentation = TerminalPresentation()
-    fingerprinting_control = FingerprintingControl(database_folder=Config.database_folder(), presentation=presentation, debug_function=__debug)
-    fingerprinting_control.scan(folder=folder, file_filter=file_filter, only_new_files=only_new_files)
+    fingerprinting_control = FingerprintingControl(database_folder=Config.database_folder(), executor=None, presentation=presentation, debug_function=__debug)
+
+    if migrate_attributes:
+        fingerprinting_control.migrate_attributes(folder=folder)
+    elif rebuild_database:
+        fingerprinting_control.rebuild_database()
+    elif backfill_latest_fingerprints:
+        fingerprinting_control.backfill_latest_fingerprints()
+    elif compact_fingerprints:
+        fingerprinting_control.compact_fingerprints()
+    elif restore_attributes:
+        fingerprinting_control.restore_attributes(folder=folder, verify='--verify' in sys.argv)
+    else:
+        fingerprinting_control.scan(folder=folder, file_filter=file_filter, only_new_files=only_new_files)
 
 
 if __name__ == '__main__':
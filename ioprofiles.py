@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import os
+import re
+from collections import namedtuple
+
+from config import Config
+
+MB = 1024 * 1024
+
+#
+# How files are read: chunk_size is the size of each read (0 means the whole file at once), files not smaller than
+# mmap_threshold are memory mapped (None means never), concurrency is the number of parallel I/O operations that the
+# device handles well, sequential enables the read-ahead hint.
+#
+IOProfile = namedtuple('IOProfile', 'name, chunk_size, mmap_threshold, concurrency, sequential')
+
+IO_PROFILES = {
+    'default': IOProfile('default', chunk_size=0, mmap_threshold=128 * MB, concurrency=1, sequential=False),
+    'ssd': IOProfile('ssd', chunk_size=8 * MB, mmap_threshold=128 * MB, concurrency=4, sequential=False),
+    'hdd': IOProfile('hdd', chunk_size=16 * MB, mmap_threshold=None, concurrency=1, sequential=True),
+    'network': IOProfile('network', chunk_size=4 * MB, mmap_threshold=None, concurrency=8, sequential=True),
+    'fuse': IOProfile('fuse', chunk_size=1 * MB, mmap_threshold=None, concurrency=2, sequential=True),
+    'optical': IOProfile('optical', chunk_size=2 * MB, mmap_threshold=None, concurrency=1, sequential=True)
+}
+
+NETWORK_FILE_SYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afpfs', 'webdav', 'davfs', '9p', 'ceph', 'glusterfs', 'fuse.sshfs'}
+OPTICAL_FILE_SYSTEMS = {'iso9660', 'udf', 'cd9660'}
+
+Mount = namedtuple('Mount', 'mount_point, device, fs_type')
+
+
+#
+# Detects the I/O profile to use for each file, from the type of the file system and the rotational flag of the
+# underlying block device of its mount (from /proc/self/mountinfo and sysfs). When they are not available (e.g. on
+# macOS) the default profile is used, unless it's explicitly configured for the mount point.
+#
+class IOProfiles:
+    #
+    # Constructor. profile_overrides maps a profile name to the fields to override (a new profile can be defined by
+    # specifying 'base', the name of the profile it's derived from); mount_overrides maps a mount point (or any other
+    # folder) to a profile name.
+    #
+    def __init__(self, profile_overrides: dict = None, mount_overrides: dict = None, mountinfo_file: str = '/proc/self/mountinfo',
+                 sys_folder: str = '/sys', debug_function=None):
+        self.profiles = self.__merge_profiles(profile_overrides if profile_overrides else {})
+        self.mount_overrides = {os.path.abspath(mount_point): name for mount_point, name in (mount_overrides or {}).items()}
+
+        for mount_point, name in self.mount_overrides.items():
+            if name not in self.profiles:
+                raise ValueError(f'I/O profile for {mount_point} must be one of {sorted(self.profiles)}, found: {name}')
+
+        self.mountinfo_file = mountinfo_file
+        self.sys_folder = sys_folder
+        self.debug = debug_function
+        self.__mounts = None
+        self.__profile_by_device = {}
+
+    #
+    # Creates an instance with the overrides in config.yaml.
+    #
+    @staticmethod
+    def from_config(debug_function=None) -> 'IOProfiles':
+        return IOProfiles(profile_overrides=Config.io_profiles_config(), mount_overrides=Config.io_profile_mounts_config(),
+                          debug_function=debug_function)
+
+    #
+    # Returns the profile for the given path. The detected profile is cached by device, so passing st_dev (if already
+    # known) saves a stat().
+    #
+    def profile_for(self, path: str, device: int = None) -> IOProfile:
+        if self.mount_overrides:
+            name = self.__overridden_profile_name(path)
+
+            if name:
+                return self.profiles[name]
+
+        if device is None:
+            device = os.stat(path).st_dev
+
+        profile = self.__profile_by_device.get(device)
+
+        if profile is None:
+            mount = self.mount_for(path)
+            profile = self.profiles[self.classify(mount)]
+            self.__profile_by_device[device] = profile
+
+            if self.debug:
+                self.debug(f'I/O profile for {mount}: {profile}')
+
+        return profile
+
+    #
+    # Returns the mount that contains the given path.
+    #
+    def mount_for(self, path: str) -> Mount:
+        path = os.path.realpath(path)
+        best = None
+
+        for mount in self.mounts():
+            mount_point = mount.mount_point.rstrip('/')
+
+            if (path == mount_point or path.startswith(f'{mount_point}/')) and (best is None or len(mount_point) > len(best.mount_point.rstrip('/'))):
+                best = mount
+
+        if best is None:  # no mount table
+            mount_point = path
+
+            while not os.path.ismount(mount_point) and mount_point != os.path.dirname(mount_point):
+                mount_point = os.path.dirname(mount_point)
+
+            best = Mount(mount_point, None, None)
+
+        return best
+
+    #
+    # Returns the name of the profile for the given mount.
+    #
+    def classify(self, mount: Mount) -> str:
+        fs_type = mount.fs_type if mount and mount.fs_type else ''
+
+        if fs_type in NETWORK_FILE_SYSTEMS:
+            return 'network'
+
+        if fs_type.startswith('fuse'):
+            return 'fuse'
+
+        if fs_type in OPTICAL_FILE_SYSTEMS:
+            return 'optical'
+
+        rotational = self.rotational(mount.device) if mount else None
+
+        if rotational is None:
+            return 'default'
+
+        return 'hdd' if rotational else 'ssd'
+
+    #
+    # Returns the rotational flag of a block device given as 'major:minor', or None if unknown.
+    #
+    def rotational(self, device: str):
+        if not device:
+            return None
+
+        device_folder = os.path.realpath(f'{self.sys_folder}/dev/block/{device}')
+
+        if os.path.exists(f'{device_folder}/partition'):
+            device_folder = os.path.dirname(device_folder)
+
+        try:
+            with open(f'{device_folder}/queue/rotational', 'rt') as file:
+                return file.read().strip() == '1'
+        except OSError:
+            return None
+
+    #
+    # Returns the mounts, read once from the mountinfo file.
+    #
+    def mounts(self) -> [Mount]:
+        if self.__mounts is None:
+            self.__mounts = []
+
+            try:
+                with open(self.mountinfo_file, 'rt') as file:
+                    for line in file:
+                        # 36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+                        fields = line.split()
+
+                        if '-' in fields:
+                            separator = fields.index('-')
+                            self.__mounts += [Mount(self.__unescape(fields[4]), fields[2], fields[separator + 1])]
+            except OSError:
+                pass
+
+        return self.__mounts
+
+    #
+    # Returns the name of the profile explicitly configured for the longest folder containing the given path, if any.
+    #
+    def __overridden_profile_name(self, path: str) -> str:
+        path = os.path.abspath(path)
+        matches = [folder for folder in self.mount_overrides if path == folder or path.startswith(f'{folder.rstrip("/")}/')]
+        return self.mount_overrides[max(matches, key=len)] if matches else None
+
+    #
+    # Mount points in mountinfo have blanks and other special characters escaped as octal sequences.
+    #
+    @staticmethod
+    def __unescape(string: str) -> str:
+        return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), string)
+
+    #
+    # Overrides come from config.yaml, so they are validated with errors that name the offending key.
+    #
+    @staticmethod
+    def __merge_profiles(overrides: dict) -> dict:
+        profiles = dict(IO_PROFILES)
+
+        for name, fields in overrides.items():
+            if not isinstance(fields, dict):
+                raise ValueError(f'I/O profile {name} must be a mapping of fields, found: {fields}')
+
+            fields = dict(fields)
+            base_name = fields.pop('base', name if name in profiles else 'default')
+
+            if base_name not in profiles:
+                raise ValueError(f'Base of I/O profile {name} must be one of {sorted(profiles)}, found: {base_name}')
+
+            for field, value in fields.items():
+                IOProfiles.__validate_field(name, field, value)
+
+            profiles[name] = profiles[base_name]._replace(name=name, **fields)
+
+        return profiles
+
+    #
+    #
+    #
+    @staticmethod
+    def __validate_field(name: str, field: str, value):
+        fields = [field for field in IOProfile._fields if field != 'name']
+
+        if field not in fields:
+            raise ValueError(f'Field of I/O profile {name} must be one of {fields}, found: {field}')
+
+        if field == 'sequential':
+            valid = isinstance(value, bool)
+        elif field == 'mmap_threshold':
+            valid = value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 0)
+        else:
+            minimum = 1 if field == 'concurrency' else 0
+            valid = isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+        if not valid:
+            raise ValueError(f'Invalid value for {field} of I/O profile {name}: {value}')
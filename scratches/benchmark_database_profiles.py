@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+#
+# Compares the database profiles on a synthetic workload: small transactions (one per file, as the scan used to do),
+# bulk transactions (as the scan and the rebuild of the database do now) and the queries of a scan.
+#
+#   SOLIBLUE_HOME=test-resources/test-home python scratches/benchmark_database_profiles.py [file count]
+#
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from fingerprinting import FingerprintingStorage, DATABASE_PROFILES, INGEST_BATCH_ROWS
+from utilities import generate_id
+
+
+def benchmark(profile: str, file_count: int) -> dict:
+    with tempfile.TemporaryDirectory() as folder:
+        storage = FingerprintingStorage(database_folder=folder, profile=profile, profile_overrides={}, operation_profiles={},
+                                        debug_function=lambda message: None)
+        storage.open()
+        now = datetime.now()
+        files = [(generate_id(), f'/Volumes/Archive/Photos/{i // 1000:04}/IMG_{i:06}.NEF') for i in range(file_count)]
+        result = {}
+
+        start = time.perf_counter()
+
+        for file_id, path in files[:file_count // 10]:
+            storage.add_path(file_id, path)
+            storage.add_fingerprint(file_id, os.path.basename(path), 'md5', 'd41d8cd98f00b204e9800998ecf8427e', now, commit=True)
+
+        result['small tx/s'] = (file_count // 10) / (time.perf_counter() - start)
+        start = time.perf_counter()
+
+        for i in range(file_count // 10, file_count, INGEST_BATCH_ROWS):
+            batch = files[i:i + INGEST_BATCH_ROWS]
+            storage.add_paths(batch)
+            storage.add_fingerprints([(file_id, os.path.basename(path), 'md5', 'd41d8cd98f00b204e9800998ecf8427e', now) for file_id, path in batch])
+            storage.commit()
+
+        result['bulk rows/s'] = (file_count - file_count // 10) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        count = sum(1 for _ in storage.iterate_mappings('/Volumes/Archive/Photos'))
+
+        for file_id, _ in files[::100]:
+            storage.find_latest_md5_fingerprint_by_id(file_id)
+
+        result['queries s'] = time.perf_counter() - start
+        assert count == file_count
+        storage.close_all()
+        return result
+
+
+if __name__ == '__main__':
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f'{"profile":10} {"small tx/s":>12} {"bulk rows/s":>12} {"queries s":>10}')
+
+    for name in DATABASE_PROFILES:
+        r = benchmark(name, file_count)
+        print(f'{name:10} {r["small tx/s"]:12.0f} {r["bulk rows/s"]:12.0f} {r["queries s"]:10.2f}')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+#
+# Compares the decoding of rows into namedtuples by the previous row factory (a new type for each row) with the cached
+# row types, reading a synthetic backups table.
+#
+#   SOLIBLUE_HOME=test-resources/test-home python scratches/benchmark_row_factory.py [row count]
+#
+
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from fingerprinting import FingerprintingStorage, BACKUP_COLUMNS, TIMESTAMP_COLUMNS, EPOCH
+from datetime import timedelta
+
+
+def previous_query_nt(conn, sql: str) -> list:
+    def row_factory(cursor, row):
+        fields = [col[0] for col in cursor.description]
+        Row = namedtuple("Row", fields)
+        return Row(*[EPOCH + timedelta(seconds=value) if field in TIMESTAMP_COLUMNS and value is not None else value
+                     for field, value in zip(fields, row)])
+
+    cursor = conn.cursor()
+    cursor.row_factory = row_factory
+    cursor.execute(sql)
+    return cursor.fetchall()
+
+
+if __name__ == '__main__':
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    with tempfile.TemporaryDirectory() as folder:
+        storage = FingerprintingStorage(database_folder=folder, profile='bulk', profile_overrides={}, operation_profiles={},
+                                        debug_function=lambda message: None)
+        storage.open()
+        storage.conn.executemany('INSERT INTO backups(uuid, base_path, label, volume_id, encrypted, creation_date, registration_date) '
+                                 'VALUES(?, ?, ?, ?, 1, ?, ?)',
+                                 ((f'uuid-{i}', f'/Volumes/Backup{i}', f'label-{i}', f'volume-{i}', 1600000000 + i, 1600000000 + i)
+                                  for i in range(row_count)))
+        storage.commit()
+        sql = f'SELECT {BACKUP_COLUMNS} FROM backups'
+
+        start = time.perf_counter()
+        previous = previous_query_nt(storage.conn, sql)
+        time_previous = time.perf_counter() - start
+
+        start = time.perf_counter()
+        current = storage._FingerprintingStorage__query_nt(sql, ())
+        time_current = time.perf_counter() - start
+
+        assert [tuple(row) for row in previous] == [tuple(row) for row in current]
+        storage.close_all()
+
+        print(f'{row_count} rows')
+        print(f'type per row: {time_previous:8.2f} s')
+        print(f'cached type:  {time_current:8.2f} s ({time_previous / time_current:.1f}x)')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+#
+# Creates a synthetic database with the version 1 schema, migrates it to the current version and compares the size
+# and the time of the lookups done by scans.
+#
+#   SOLIBLUE_HOME=test-resources/test-home python scratches/benchmark_schema_v2.py [file count]
+#
+
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from fingerprinting import FingerprintingStorage
+from utilities import generate_id
+
+FINGERPRINTS_PER_FILE = 3
+
+
+def create_version_1(database_file: str, file_count: int) -> [str]:
+    conn = sqlite3.connect(database_file)
+    conn.executescript("""
+        CREATE TABLE files (id TEXT PRIMARY KEY, path TEXT NOT NULL);
+        CREATE TABLE fingerprints (id TEXT PRIMARY KEY, name TEXT NOT NULL, file_id TEXT NOT NULL, algorithm TEXT NOT NULL,
+                                   fingerprint TEXT NOT NULL, timestamp INTEGER NOT NULL);
+        CREATE TABLE backups(id TEXT PRIMARY KEY, base_path TEXT NOT NULL, label TEXT NOT NULL UNIQUE, volume_id TEXT NOT NULL UNIQUE,
+                             encrypted INTEGER NOT NULL, creation_date INTEGER NOT NULL, registration_date INTEGER NOT NULL, latest_check_date);
+        CREATE TABLE backup_files(id TEXT PRIMARY KEY, backup_id TEXT NOT NULL, file_id TEXT NOT NULL, path TEXT NOT NULL);
+        CREATE INDEX files__path ON files (path);
+        CREATE INDEX fingerprints__name ON fingerprints (name);
+        CREATE INDEX fingerprints__file_id ON fingerprints (file_id);
+        CREATE INDEX fingerprints__timestamp ON fingerprints (timestamp);
+        """)
+    file_ids = [generate_id() for _ in range(file_count)]
+    conn.executemany('INSERT INTO files VALUES(?, ?)', [(file_id, f'/Volumes/Archive/Photos/{i // 1000:04}/IMG_{i:06}.NEF')
+                                                         for i, file_id in enumerate(file_ids)])
+    start = datetime(2020, 1, 1)
+    conn.executemany('INSERT INTO fingerprints VALUES(?, ?, ?, ?, ?, ?)',
+                     [(generate_id(), f'IMG_{i:06}.NEF', file_id, 'md5', hashlib.md5(file_id.encode()).hexdigest(), start + timedelta(days=j, seconds=i))
+                      for j in range(FINGERPRINTS_PER_FILE) for i, file_id in enumerate(file_ids)])
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    return file_ids
+
+
+def lookups(conn: sqlite3.Connection, sql: str, file_ids: [str]) -> float:
+    start = time.perf_counter()
+
+    for file_id in file_ids:
+        conn.execute(sql, (file_id,)).fetchall()
+
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    with tempfile.TemporaryDirectory() as folder:
+        database_file = f'{folder}/fingerprints.db'
+        file_ids = create_version_1(database_file, file_count)
+        sample = random.sample(file_ids, min(20000, file_count))
+        size_v1 = os.path.getsize(database_file)
+        conn = sqlite3.connect(database_file)
+        time_v1 = lookups(conn, "SELECT fingerprint, datetime(timestamp) FROM fingerprints WHERE file_id = ? AND algorithm = 'md5' "
+                                "ORDER BY timestamp DESC LIMIT 1", sample)
+        conn.close()
+
+        storage = FingerprintingStorage(database_folder=folder, profile='default', profile_overrides={}, operation_profiles={},
+                                        debug_function=lambda message: None)
+        start = time.perf_counter()
+        storage.open()
+        migration_time = time.perf_counter() - start
+        time_v2 = lookups(storage.conn, "SELECT fingerprint, timestamp FROM fingerprints WHERE file_id = (SELECT id FROM files WHERE uuid = ?) "
+                                        "AND algorithm = 'md5' ORDER BY timestamp DESC LIMIT 1", sample)
+        storage.close_all()
+        size_v2 = os.path.getsize(database_file)
+
+        print(f'{file_count} files, {file_count * FINGERPRINTS_PER_FILE} fingerprints, migrated in {migration_time:.1f} s')
+        print(f'size:    {size_v1 / 1024 / 1024:8.1f} MiB -> {size_v2 / 1024 / 1024:8.1f} MiB ({size_v2 / size_v1:.0%})')
+        print(f'lookups: {time_v1:8.2f} s   -> {time_v2:8.2f} s ({len(sample)} latest fingerprints by file id)')
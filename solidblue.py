@@ -28,6 +28,7 @@ from PySide2.QtWidgets import QDialog, QDialogButtonBox, QMainWindow, QCheckBox,
 
 from config import Config
 from executor import Worker, Executor
+from filtering import FileFilter
 from fingerprinting import FingerprintingControl, FingerprintingPresentation
 from rsync import RSync, RSyncPresentation
 from utilities import extract, notification, html_italic, shortened_path, html_red, html_bold
@@ -543,6 +544,11 @@ class FingerprintingPresentationAdapter(FingerprintingPresentation, AdapterSuppo
         new_path = shortened_path(new_path)
         self.widgets.log_to_console(f'{old_path}\n    ↳ {new_path}')
 
+    def notify_folder_moved(self, old_path: str, new_path: str, file_count: int):
+        old_path = shortened_path(old_path)
+        new_path = shortened_path(new_path)
+        self.widgets.log_to_console(f'{old_path}/\n    ↳ {new_path}/ ({file_count} files)')
+
     def notify_error(self, message: str):
         message = html_red(message)
         self.widgets.log_red_to_console(message)
@@ -576,7 +582,7 @@ class MainWindow(QWidget):
         self.log_file = open(log_path, 'wt')
         self.log(f'Home directory: {self.home} - Script directory: {Config.resource("")}')
 
-        self.macos_excludes = Config.resource('macos-excludes.txt')
+        self.file_filter = FileFilter.with_standard_excludes()
 
         self.executor = Executor(self.log, self.log_exception)
         self.widgets = Widgets(self, self.executor, self.log, self.log_exception)
@@ -681,7 +687,7 @@ class MainWindow(QWidget):
         flags = ['--delete', '--delete-excluded', '--delete-before', '--progress', '--stats', '-rtvv', '--ignore-errors',
                  '--itemize-changes', "--out-format=INFO: %i %l %n", ]
         flags += config.extra_rsync_flags
-        flags += [f'--exclude-from={self.macos_excludes}']
+        flags += self.file_filter.rsync_flags()
         rsync = Config.resource('rsync3')
         timestamp = self.__current_timestamp()
 
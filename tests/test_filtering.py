@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import os
+import tempfile
+import unittest
+
+from config import Config
+from filtering import FileFilter
+from fingerprinting import FingerprintingFileSystem
+
+
+class TestFileFilter(unittest.TestCase):
+    def test_include_regex(self):
+        under_test = FileFilter(include=r'\.(jpg|nef)$')
+        self.assertTrue(under_test.accepts_file('/a/IMG_0001.JPG', 'IMG_0001.JPG'))
+        self.assertTrue(under_test.accepts_file('/a/IMG_0001.nef', 'IMG_0001.nef'))
+        self.assertFalse(under_test.accepts_file('/a/IMG_0001.xmp', 'IMG_0001.xmp'))
+
+    def test_extensions(self):
+        under_test = FileFilter(extensions=['.JPG', 'nef'])
+        self.assertTrue(under_test.accepts_file('/a/IMG_0001.jpg', 'IMG_0001.jpg'))
+        self.assertTrue(under_test.accepts_file('/a/IMG_0001.NEF', 'IMG_0001.NEF'))
+        self.assertFalse(under_test.accepts_file('/a/IMG_0001.xmp', 'IMG_0001.xmp'))
+        self.assertFalse(under_test.accepts_file('/a/README', 'README'))
+
+    def test_unanchored_excludes(self):
+        under_test = FileFilter(excludes=['.Spotlight-V100', '.DocumentRevisions-V100*', 'Library/Caches/JetBrains'])
+        self.assertFalse(under_test.accepts_folder('/.Spotlight-V100'))
+        self.assertFalse(under_test.accepts_folder('/Volume/.Spotlight-V100'))
+        self.assertFalse(under_test.accepts_folder('/.DocumentRevisions-V100-bad'))
+        self.assertFalse(under_test.accepts_folder('/Users/fritz/Library/Caches/JetBrains'))
+        self.assertTrue(under_test.accepts_folder('/Users/fritz/Library/Caches'))
+        self.assertTrue(under_test.accepts_folder('/x.Spotlight-V100'))
+        self.assertFalse(under_test.accepts_file('/a/.Spotlight-V100', '.Spotlight-V100'))
+
+    def test_anchored_excludes(self):
+        under_test = FileFilter(excludes=['/.fseventsd', '/.vol/*', '/private/tmp/'])
+        self.assertFalse(under_test.accepts_folder('/.fseventsd'))
+        self.assertTrue(under_test.accepts_folder('/a/.fseventsd'))
+        self.assertTrue(under_test.accepts_folder('/.vol'))
+        self.assertFalse(under_test.accepts_folder('/.vol/1234'))
+        self.assertFalse(under_test.accepts_file('/.vol/1234', '1234'))
+        self.assertFalse(under_test.accepts_folder('/private/tmp'))
+        self.assertTrue(under_test.accepts_file('/private/tmp', 'tmp'))
+
+    def test_rsync_flags(self):
+        under_test = FileFilter(excludes=['*.tmp'], excludes_file=Config.excludes_file())
+        self.assertEqual(under_test.rsync_flags(), [f'--exclude-from={Config.excludes_file()}', '--exclude=*.tmp'])
+
+    def test_standard_excludes(self):
+        under_test = FileFilter.with_standard_excludes()
+        self.assertFalse(under_test.accepts_folder('/.Spotlight-V100'))
+        self.assertFalse(under_test.accepts_folder('/Network Trash Folder'))
+        self.assertFalse(under_test.accepts_file('/Folder/$Recycle.Bin', '$Recycle.Bin'))
+        self.assertFalse(under_test.accepts_file('/Folder/.solidblue-manifest', '.solidblue-manifest'))
+        self.assertFalse(under_test.accepts_file('/Folder/.solidblue-manifest.tmp', '.solidblue-manifest.tmp'))
+        self.assertTrue(under_test.accepts_file('/Folder/File', 'File'))
+        self.assertIn('--exclude=.solidblue-manifest*', under_test.rsync_flags())
+
+    def test_enumerate_files_prunes_excluded_folders(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for path in ['Folder1/File1.jpg', 'Folder1/File2.xmp', '.Spotlight-V100/Store/File3.jpg', 'Folder2/.Trashes/File4.jpg']:
+                os.makedirs(os.path.dirname(f'{folder}/{path}'), exist_ok=True)
+
+                with open(f'{folder}/{path}', 'wb') as file:
+                    file.write(b'x')
+
+            walked = []
+            under_test = FileFilter(include=r'\.jpg$', excludes=['.Spotlight-V100', '.Trashes'])
+            accepts_folder = under_test.accepts_folder
+            under_test.accepts_folder = lambda relative_path: walked.append(relative_path) or accepts_folder(relative_path)
+            files = FingerprintingFileSystem.enumerate_files([folder], under_test)
+
+            self.assertEqual([file.path for file in files], [f'{folder}/Folder1/File1.jpg'])
+            self.assertNotIn('/.Spotlight-V100/Store', walked)
+
+
+if __name__ == '__main__':
+    unittest.main()
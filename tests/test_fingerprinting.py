@@ -11,6 +11,7 @@
 #  __maintainer__ = "Fabrizio Giudici"
 #  __email__ = "fabrizio.giudici@tidalwave.it"
 #  __status__ = "Prototype"
+import errno
 import os
 import unittest
 from collections import namedtuple
@@ -21,7 +22,9 @@ from mockito import when, unstub
 
 from config import Config
 from executor import Executor
-from fingerprinting import FingerprintingControl, FingerprintingPresentation, FingerprintingStats, FingerprintingFileSystem
+from ioprofiles import IOProfile, IO_PROFILES
+from fingerprinting import DATABASE_PROFILES, FingerprintingControl, FingerprintingPresentation, FingerprintingStats, FingerprintingFileSystem, FileCatalog, IngestBuffer, IngestWriter, \
+    XATTR_ID, XATTR_FINGERPRINT, XATTR_FINGERPRINT_TIMESTAMP, XATTR_RECORD, XATTR_LEGACY
 
 
 #
@@ -46,9 +49,21 @@ class MockStorage:
     def find_mappings(self):  # (id, map)
         return self.paths_dict_by_id.items()
 
+    def iterate_mappings(self, folder: str):  # (id, map)
+        return sorted(filter(lambda item: item[1].startswith(f'{folder}/'), self.paths_dict_by_id.items()), key=lambda item: FileCatalog.sort_key(item[1]))
+
+    def find_path_by_id(self, file_id: str) -> str:
+        return self.paths_dict_by_id.get(file_id, None)
+
+    def find_file_ids_by_name(self, file_names: [str]) -> dict:
+        return {Path(path).name: file_id for file_id, path in self.paths_dict_by_id.items() if Path(path).name in file_names}
+
     def find_latest_fingerprint_by_id(self, file_id: str) -> (str, str):
         return f'md5({self.paths_dict_by_id[file_id]})', None
 
+    def find_latest_md5_fingerprint_by_id(self, file_id: str) -> (str, str):
+        return f'md5({self.paths_dict_by_id[file_id]})', '2020-10-01 00:00:00'
+
     def find_backup_item_id(self, backup_id: str, file_id: str) -> str:
         return 'id-of-backup-of-' + file_id
 
@@ -58,12 +73,15 @@ class MockStorage:
     def find_backup_by_label(self, label: str):
         pass
 
-    def open(self):
+    def open(self, operation: str = None):
         self.done += [('open()',)]
 
     def close(self):
         self.done += [('close()',)]
 
+    def close_connection(self):
+        self.done += [('close_connection()',)]
+
     def commit(self):
         self.done += [('commit()',)]
 
@@ -73,9 +91,34 @@ class MockStorage:
     def update_path(self, file_id: str, path: str, commit=False):
         self.done += [('update_path()', file_id, path, commit)]
 
+    def update_paths(self, mappings: [(str, str)], commit=False):
+        self.done += [('update_paths()', mappings, commit)]
+
+    def clear_paths(self, file_ids: [str], commit=False):
+        self.done += [('clear_paths()', file_ids, commit)]
+
+    def rename_folder(self, old_folder: str, new_folder: str, commit=False):
+        self.done += [('rename_folder()', old_folder, new_folder, commit)]
+        return []
+
+    def count_files(self, folder: str) -> int:
+        return len([path for path in self.paths_dict_by_id.values() if path.startswith(f'{folder}/')])
+
     def add_fingerprint(self, file_id: str, file_name: str, algorithm: str, fingerprint: str, timestamp, commit=False):
         self.done += [('insert_fingerprint()', file_id, algorithm, fingerprint, timestamp, commit)]
 
+    def add_paths(self, files: [(str, str)], commit=False):
+        self.done += [('add_paths()', files, commit)]
+
+    def add_fingerprints(self, fingerprints: [(str, str, str, str, datetime)], commit=False):
+        self.done += [('add_fingerprints()', fingerprints, commit)]
+
+    def bulk_add_files(self, files: [(str, str)], commit=False):
+        self.done += [('bulk_add_files()', files, commit)]
+
+    def bulk_add_fingerprints(self, fingerprints: [(str, str, str, str, datetime)], commit=False):
+        self.done += [('bulk_add_fingerprints()', fingerprints, commit)]
+
     def add_backup(self, base_path: str, label: str, volume_id: str, creation_date: datetime, registration_date: datetime, encrypted, commit=False) -> str:
         new_id = 'id-of-new-backup'
         self.done += [('add_backup()', new_id, base_path, label, volume_id, creation_date, registration_date, encrypted, commit)]
@@ -84,6 +127,9 @@ class MockStorage:
     def add_backup_item(self, backup_id: str, file_id, backup_file: str, commit=False) -> str:
         self.done += [('add_backup_item()', backup_id, file_id, backup_file, commit)]
 
+    def add_backup_fingerprint(self, backup_item_id: str, algorithm: str, fingerprint: str, timestamp, commit=False):
+        self.done += [('add_backup_fingerprint()', backup_item_id, algorithm, fingerprint, timestamp, commit)]
+
     def set_backup_check_latest_timestamp(self, backup_id, timestamp):
         self.done += [('set_backup_check_latest_timestamp', backup_id, timestamp)]
 
@@ -100,6 +146,7 @@ class MockFileSystem:
         self.files = []
         self.fingerprints_dict_by_id = {}
         self.attributes_dict_by_path_and_name = {}
+        self.attributes_read_paths = []
 
         self.done = []
 
@@ -112,18 +159,35 @@ class MockFileSystem:
 
         self.stats = MockStats()
 
-    def enumerate_files(self, folders: [str], file_filter: str = '.*') -> [FingerprintingFileSystem.FileInfo]:
+    def enumerate_files(self, folders: [str], file_filter: str = '.*') -> FileCatalog:
         result = []
 
         for folder in folders:
             result += filter(lambda file: file.path.startswith(folder), self.files)
 
-        return result
+        return FileCatalog.of(result)
+
+    def list_folder(self, folder: str, file_filter: str = '.*') -> ([str], [str]):
+        files = [file.name for file in self.files if file.folder == folder]
+        folders = {file.path[len(folder) + 1:].split('/')[0] for file in self.files if file.folder.startswith(f'{folder}/')}
+        return files, sorted(folders)
+
+    @staticmethod
+    def io_profile(path: str, device: int = None) -> IOProfile:
+        return IO_PROFILES['default']
 
     def get_attribute(self, path: str, name: str) -> str:
         key = (path, name)
         return self.attributes_dict_by_path_and_name[key] if key in self.attributes_dict_by_path_and_name else None
 
+    def get_attributes(self, path: str) -> dict:
+        self.attributes_read_paths += [path]
+        return {name: value for (attribute_path, name), value in self.attributes_dict_by_path_and_name.items() if attribute_path == path}
+
+    def get_attributes_batch(self, paths):
+        for path in paths:
+            yield path, self.get_attributes(path)
+
     @staticmethod
     def compute_fingerprint(path: str) -> (str, str):
         if 'with_error' in path:
@@ -146,6 +210,12 @@ class MockFileSystem:
     def set_attribute(self, path: str, name: str, value: str):
         self.done += [('set_attribute()', path, name, value)]
 
+    def remove_attributes(self, path: str, names: [str]):
+        self.done += [('remove_attributes()', path, names)]
+
+    def flush_attributes(self):
+        pass
+
     def eject_optical_disc(self, mount_point: str):
         self.done += [('eject_optical_disk()', mount_point)]
 
@@ -225,6 +295,9 @@ class MockPresentation(FingerprintingPresentation):
     def notify_file_moved(self, old_path: str, new_path: str):
         self.things_done += [('notify_file_moved()', old_path, new_path)]
 
+    def notify_folder_moved(self, old_path: str, new_path: str, file_count: int):
+        self.things_done += [('notify_folder_moved()', old_path, new_path, file_count)]
+
     def notify_error(self, message: str):
         self.things_done += [('notify_error()', message)]
 
@@ -321,33 +394,35 @@ class TestFingerprintControl(unittest.TestCase):
         expected = [
             # STORAGE
             ('open()',),
-            ('update_path()', '00000000-0000-0000-0000-000000000004', 'folder/file_moved', True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000000004', 'md5', 'md5(folder/file_moved)', now, True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000000002', 'md5', 'md5(folder/file_with_changed_md5)', now, True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000000003', 'error', 'I/O error', now, True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000000001', 'md5', 'md5(folder/file_with_unchanged_md5)', now, True),
-            ('add_path()', '00000000-0000-0000-0000-000000001001', 'folder/new_file', True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000001001', 'md5', 'md5(folder/new_file)', now, True),
-            ('add_path()', '00000000-0000-0000-0000-000000001002', 'folder/new_file_with_error', True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000001002', 'error', 'I/O error', now, True),
+            ('add_paths()', [('00000000-0000-0000-0000-000000001001', 'folder/new_file'),
+                             ('00000000-0000-0000-0000-000000001002', 'folder/new_file_with_error')], False),
+            ('add_fingerprints()', [
+                ('00000000-0000-0000-0000-000000000004', 'file_moved', 'md5', 'md5(folder/file_moved)', now),
+                ('00000000-0000-0000-0000-000000000002', 'file_with_changed_md5', 'md5', 'md5(folder/file_with_changed_md5)', now),
+                ('00000000-0000-0000-0000-000000000003', 'file_with_error', 'error', 'I/O error', now),
+                ('00000000-0000-0000-0000-000000000001', 'file_with_unchanged_md5', 'md5', 'md5(folder/file_with_unchanged_md5)', now),
+                ('00000000-0000-0000-0000-000000001001', 'new_file', 'md5', 'md5(folder/new_file)', now),
+                ('00000000-0000-0000-0000-000000001002', 'new_file_with_error', 'error', 'I/O error', now)], False),
+            ('commit()',),
+            ('update_paths()', [('00000000-0000-0000-0000-000000000004', 'folder/file_moved')], False),
+            ('commit()',),
             ('close()',),
             # FILE SYSTEM
-            ('set_attribute()', 'folder/file_moved', 'it.tidalwave.datamanager.fingerprint.md5', 'md5(folder/file_moved)'),
-            ('set_attribute()', 'folder/file_moved', 'it.tidalwave.datamanager.fingerprint.md5.timestamp', now_str),
-            ('set_attribute()', 'folder/file_with_changed_md5', 'it.tidalwave.datamanager.fingerprint.md5', 'md5(folder/file_with_changed_md5)'),
-            ('set_attribute()', 'folder/file_with_changed_md5', 'it.tidalwave.datamanager.fingerprint.md5.timestamp', now_str),
-            ('set_attribute()', 'folder/file_with_unchanged_md5', 'it.tidalwave.datamanager.fingerprint.md5', 'md5(folder/file_with_unchanged_md5)'),
-            ('set_attribute()', 'folder/file_with_unchanged_md5', 'it.tidalwave.datamanager.fingerprint.md5.timestamp', now_str),
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.id', '00000000-0000-0000-0000-000000001001'),
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.fingerprint.md5', 'md5(folder/new_file)'),
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.fingerprint.md5.timestamp', now_str),
-            ('set_attribute()', 'folder/new_file_with_error', 'it.tidalwave.datamanager.id', '00000000-0000-0000-0000-000000001002'),
+            ('set_attribute()', 'folder/file_moved', XATTR_FINGERPRINT, 'md5(folder/file_moved)'),
+            ('set_attribute()', 'folder/file_moved', XATTR_FINGERPRINT_TIMESTAMP, now_str),
+            ('set_attribute()', 'folder/file_with_changed_md5', XATTR_FINGERPRINT, 'md5(folder/file_with_changed_md5)'),
+            ('set_attribute()', 'folder/file_with_changed_md5', XATTR_FINGERPRINT_TIMESTAMP, now_str),
+            ('set_attribute()', 'folder/file_with_unchanged_md5', XATTR_FINGERPRINT, 'md5(folder/file_with_unchanged_md5)'),
+            ('set_attribute()', 'folder/file_with_unchanged_md5', XATTR_FINGERPRINT_TIMESTAMP, now_str),
+            ('set_attribute()', 'folder/new_file', XATTR_ID, '00000000-0000-0000-0000-000000001001'),
+            ('set_attribute()', 'folder/new_file', XATTR_FINGERPRINT, 'md5(folder/new_file)'),
+            ('set_attribute()', 'folder/new_file', XATTR_FINGERPRINT_TIMESTAMP, now_str),
+            ('set_attribute()', 'folder/new_file_with_error', XATTR_ID, '00000000-0000-0000-0000-000000001002'),
             # PRESENTATION
             ('notify_counting()',),
             ('notify_message()', "Counting files in ['folder']..."),
             ('notify_file_count()', 6),
             ('notify_message()', 'Found 6 files (156.6 MB)'),
-            ('notify_file_moved()', 'oldfolder/file_moved', 'folder/file_moved'),
             ('notify_file()', 'folder/file_moved', False),
             ('notify_progress()', 1696838, 156637291),
             ('notify_file()', 'folder/file_with_changed_md5', False),
@@ -362,12 +437,373 @@ class TestFingerprintControl(unittest.TestCase):
             ('notify_progress()', 143291252, 156637291),
             ('notify_error()', 'Error for folder/new_file_with_error: I/O error'),
             ('notify_progress()', 156637291, 156637291),
+            ('notify_file_moved()', 'oldfolder/file_moved', 'folder/file_moved'),
             ('notify_message()', '4 files (1.59 GB) processed in 59 seconds (27.0 MB/sec)'),
             ('notify_message()', '1.23 GB in plain I/O, 359.7 MB in memory mapped I/O')
         ]
 
         self.assertEqual(actual, expected)
 
+    #
+    #
+    #
+    def test_scan_with_packed_attributes(self):
+        # GIVEN
+        self.__setup_fixture(packed_attributes=True)
+        self.__mock_files()
+        # WHEN
+        self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        self.assertEqual(self.file_system.things_done(), [
+            ('set_attribute()', 'folder/file_moved', XATTR_RECORD, '1;00000000-0000-0000-0000-000000000004;md5(folder/file_moved);20201101T000000'),
+            ('remove_attributes()', 'folder/file_moved', XATTR_LEGACY),
+            ('set_attribute()', 'folder/file_with_changed_md5', XATTR_RECORD, '1;00000000-0000-0000-0000-000000000002;md5(folder/file_with_changed_md5);20201101T000000'),
+            ('remove_attributes()', 'folder/file_with_changed_md5', XATTR_LEGACY),
+            ('set_attribute()', 'folder/file_with_unchanged_md5', XATTR_RECORD, '1;00000000-0000-0000-0000-000000000001;md5(folder/file_with_unchanged_md5);20201101T000000'),
+            ('remove_attributes()', 'folder/file_with_unchanged_md5', XATTR_LEGACY),
+            ('set_attribute()', 'folder/new_file', XATTR_RECORD, '1;00000000-0000-0000-0000-000000001001;md5(folder/new_file);20201101T000000'),
+            ('set_attribute()', 'folder/new_file_with_error', XATTR_RECORD, '1;00000000-0000-0000-0000-000000001002;;')
+        ])
+
+    #
+    #
+    #
+    def test_scan_attribute_timestamps_policies(self):
+        unchanged_write = ('set_attribute()', 'folder/a_unchanged', 'it.tidalwave.datamanager.record',
+                           '1;00000000-0000-0000-0000-000000000001;md5(folder/a_unchanged);20201101T000000')
+        new_writes = [('set_attribute()', 'folder/b_new', XATTR_ID, '00000000-0000-0000-0000-000000001001'),
+                      ('set_attribute()', 'folder/b_new', XATTR_FINGERPRINT, 'md5(folder/b_new)'),
+                      ('set_attribute()', 'folder/b_new', XATTR_FINGERPRINT_TIMESTAMP, '2020-11-01 00:00:00')]
+
+        for policy, old_timestamp, expected in [('eager', '20201001T000000', [unchanged_write] + new_writes),
+                                                ('deferred', '20201001T000000', [unchanged_write] + new_writes),
+                                                ('deferred', '20201025T000000', new_writes),  # recent enough, not rewritten
+                                                ('never', '20201001T000000', new_writes)]:
+            # GIVEN
+            self.__setup_fixture(attribute_timestamps=policy)
+            self.file_system.mock_file(path='folder/a_unchanged')
+            self.file_system.mock_file(path='folder/b_new')
+            self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000001'] = 'folder/a_unchanged'
+            self.file_system.attributes_dict_by_path_and_name[('folder/a_unchanged', 'it.tidalwave.datamanager.record')] = \
+                f'1;00000000-0000-0000-0000-000000000001;md5(folder/a_unchanged);{old_timestamp}'
+            # WHEN
+            self.under_test.scan(folder='folder', file_filter='.*')
+            # THEN
+            self.assertEqual(self.file_system.things_done(), expected)
+
+    #
+    #
+    #
+    def test_scan_cleanup_error_does_not_replace_scan_error(self):
+        # GIVEN
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/a')
+        self.file_system.compute_fingerprint = self.__raising(RuntimeError('scan failed'))
+        self.file_system.flush_attributes = self.__raising(OSError(errno.ENOSPC, 'No space left on device'))
+        # WHEN
+        with self.assertRaisesRegex(RuntimeError, 'scan failed'):
+            self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        self.assertIn(('notify_error()', 'Error while cleaning up: [Errno 28] No space left on device'), self.presentation.things_done)
+        self.assertIn(('close()',), self.storage.things_done())
+
+        # GIVEN
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/a')
+        self.file_system.flush_attributes = self.__raising(OSError(errno.ENOSPC, 'No space left on device'))
+        # WHEN
+        with self.assertRaisesRegex(OSError, 'No space left on device'):
+            self.under_test.scan(folder='folder', file_filter='.*')
+
+    #
+    #
+    #
+    def test_migrate_attributes(self):
+        # GIVEN
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/legacy_file', file_id='00000000-0000-0000-0000-000000000001', fingerprint='md5(folder/legacy_file)',
+                                   timestamp_str='2020-10-01 00:00:00')
+        self.file_system.mock_file(path='folder/malformed_legacy_file', file_id='00000000-0000-0000-0000-000000000003',
+                                   fingerprint='md5(folder/malformed_legacy_file)', timestamp_str='2020-10-01')
+        self.file_system.mock_file(path='folder/packed_file')
+        self.file_system.attributes_dict_by_path_and_name[('folder/packed_file', 'it.tidalwave.datamanager.record')] = \
+            '1;00000000-0000-0000-0000-000000000002;md5(folder/packed_file);20201001T000000'
+        # WHEN
+        self.under_test.migrate_attributes(folder='folder')
+        # THEN
+        self.assertEqual(self.file_system.things_done(), [
+            ('set_attribute()', 'folder/legacy_file', 'it.tidalwave.datamanager.record', '1;00000000-0000-0000-0000-000000000001;md5(folder/legacy_file);20201001T000000'),
+            ('remove_attributes()', 'folder/legacy_file', XATTR_LEGACY)
+        ])
+        self.assertIn(('notify_error()', 'Malformed timestamp for folder/malformed_legacy_file: 2020-10-01'), self.presentation.things_done)
+        self.assertEqual(self.presentation.things_done[-1], ('notify_message()', '1 files migrated'))
+
+    #
+    #
+    #
+    def test_rebuild_database(self):
+        # GIVEN
+        self.__setup_fixture()
+        self.__mock_files()
+        self.file_system.attributes_dict_by_path_and_name[('folder/new_file', 'it.tidalwave.datamanager.record')] = \
+            '1;00000000-0000-0000-0000-000000000005;md5(folder/new_file);20201101T000000'
+        self.file_system.attributes_dict_by_path_and_name[('folder/file_with_error', 'it.tidalwave.datamanager.fingerprint.md5.timestamp')] = \
+            '2020-13-45 00:00:00'
+        # WHEN
+        self.under_test.rebuild_database(folders=['folder'])
+        # THEN
+        old_timestamp = datetime(2020, 10, 1, 0, 0, 0)
+        self.assertEqual(self.storage.things_done(), [
+            ('open()',),
+            ('bulk_add_files()', [('00000000-0000-0000-0000-000000000004', 'folder/file_moved'),
+                                  ('00000000-0000-0000-0000-000000000002', 'folder/file_with_changed_md5'),
+                                  ('00000000-0000-0000-0000-000000000003', 'folder/file_with_error'),
+                                  ('00000000-0000-0000-0000-000000000001', 'folder/file_with_unchanged_md5'),
+                                  ('00000000-0000-0000-0000-000000000005', 'folder/new_file')], False),
+            ('bulk_add_fingerprints()', [('00000000-0000-0000-0000-000000000004', 'file_moved', 'md5', 'md5(folder/file_moved)', old_timestamp),
+                                         ('00000000-0000-0000-0000-000000000002', 'file_with_changed_md5', 'md5', 'oldmd5(folder/file_with_changed_md5)', old_timestamp),
+                                         ('00000000-0000-0000-0000-000000000001', 'file_with_unchanged_md5', 'md5', 'md5(folder/file_with_unchanged_md5)', old_timestamp),
+                                         ('00000000-0000-0000-0000-000000000005', 'new_file', 'md5', 'md5(folder/new_file)', datetime(2020, 11, 1, 0, 0, 0))], False),
+            ('commit()',),
+            ('close()',)
+        ])
+        self.assertIn(('notify_error()', 'Malformed timestamp for folder/file_with_error: 2020-13-45 00:00:00'), self.presentation.things_done)
+        self.assertEqual(self.presentation.things_done[-1], ('notify_message()', '5 files restored, 1 files without id'))
+
+    #
+    #
+    #
+    def test_rebuild_database_without_folders(self):
+        # GIVEN
+        self.__setup_fixture()
+        when(Config).scan_config().thenReturn({})
+        # WHEN
+        self.under_test.rebuild_database()
+        # THEN
+        self.assertEqual(self.storage.things_done(), [])
+        self.assertEqual(self.presentation.things_done, [('notify_message()', 'No folders to rebuild the database from')])
+
+    #
+    #
+    #
+    def test_restore_attributes(self):
+        for verify in [False, True]:
+            # GIVEN
+            self.__setup_fixture()
+            self.file_system.mock_file(path='folder/stripped_file')
+            self.file_system.mock_file(path='folder/stripped_file_with_error')
+            self.file_system.mock_file(path='folder/file_with_attributes', file_id='00000000-0000-0000-0000-000000000003')
+            self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000001'] = 'folder/stripped_file'
+            self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000002'] = 'folder/stripped_file_with_error'
+            # WHEN
+            self.under_test.restore_attributes(folder='folder', verify=verify)
+            # THEN
+            expected = [('set_attribute()', 'folder/stripped_file', XATTR_ID, '00000000-0000-0000-0000-000000000001'),
+                        ('set_attribute()', 'folder/stripped_file', XATTR_FINGERPRINT, 'md5(folder/stripped_file)'),
+                        ('set_attribute()', 'folder/stripped_file', XATTR_FINGERPRINT_TIMESTAMP, '2020-10-01 00:00:00')]
+
+            if not verify:
+                expected += [('set_attribute()', 'folder/stripped_file_with_error', XATTR_ID, '00000000-0000-0000-0000-000000000002'),
+                             ('set_attribute()', 'folder/stripped_file_with_error', XATTR_FINGERPRINT, 'md5(folder/stripped_file_with_error)'),
+                             ('set_attribute()', 'folder/stripped_file_with_error', XATTR_FINGERPRINT_TIMESTAMP, '2020-10-01 00:00:00')]
+
+            self.assertEqual(self.file_system.things_done(), expected)
+            self.assertEqual(self.presentation.things_done[-1], ('notify_message()', '1 files restored, 1 mismatched' if verify else '2 files restored'))
+
+    #
+    #
+    #
+    def test_scan_folder_moves(self):
+        # GIVEN
+        self.__setup_fixture()
+
+        for i, path in enumerate(['old/a/x/1', 'old/a/x/2', 'old/a/y/3', 'old/b/4', 'old/b/5', 'old/c/6']):
+            file_id = f'00000000-0000-0000-0000-00000000000{i}'
+            new_path = path.replace('old/a/', 'folder/renamed/').replace('old/b/', 'folder/b/').replace('old/c/6', 'folder/c/6-renamed')
+            self.file_system.mock_file(path=new_path, file_id=file_id)
+            self.file_system.paths_dict_by_id[file_id] = path
+
+        self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000009'] = 'old/b/not-moved'
+        # WHEN
+        self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        moves = [thing for thing in self.storage.things_done() if thing[0] in ('update_paths()', 'rename_folder()', 'commit()')]
+        self.assertEqual(moves, [
+            ('commit()',),  # the ingest of fingerprints
+            ('update_paths()', [('00000000-0000-0000-0000-000000000003', 'folder/b/4'), ('00000000-0000-0000-0000-000000000004', 'folder/b/5')], False),
+            ('update_paths()', [('00000000-0000-0000-0000-000000000005', 'folder/c/6-renamed')], False),
+            ('rename_folder()', 'old/a', 'folder/renamed', False),
+            ('commit()',)
+        ])
+        notifications = [thing for thing in self.presentation.things_done if thing[0] in ('notify_file_moved()', 'notify_folder_moved()')]
+        self.assertEqual(notifications, [
+            ('notify_folder_moved()', 'old', 'folder', 2),
+            ('notify_file_moved()', 'old/c/6', 'folder/c/6-renamed'),
+            ('notify_folder_moved()', 'old/a', 'folder/renamed', 3)
+        ])
+
+    #
+    #
+    #
+    def test_scan_file_replaced_by_move(self):
+        # GIVEN
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/a', file_id='00000000-0000-0000-0000-000000000002', fingerprint='md5(folder/a)')
+        self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000001'] = 'folder/a'
+        self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000002'] = 'folder/b'
+        self.file_system.mock_file(path='folder/c', file_id='00000000-0000-0000-0000-000000000003')
+        self.file_system.attributes_dict_by_path_and_name[('folder/c', 'it.tidalwave.datamanager.id')] = '00000000-0000-0000-0000-000000000009'
+        # WHEN
+        self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        changes = [thing for thing in self.storage.things_done() if thing[0] in ('add_fingerprints()', 'clear_paths()', 'update_paths()')]
+        self.assertEqual(changes, [
+            ('add_fingerprints()', [('00000000-0000-0000-0000-000000000002', 'a', 'md5', 'md5(folder/a)', self.__mock_time_provider())], False),
+            ('clear_paths()', ['00000000-0000-0000-0000-000000000001'], False),
+            ('update_paths()', [('00000000-0000-0000-0000-000000000002', 'folder/a')], False)
+        ])
+        notifications = [thing for thing in self.presentation.things_done if thing[0] in ('notify_file_moved()', 'notify_error()')]
+        self.assertEqual(notifications, [
+            ('notify_error()', 'Mismatching 00000000-0000-0000-0000-000000000009 for folder/c, expected 00000000-0000-0000-0000-000000000003'),
+            ('notify_file_moved()', 'folder/b', 'folder/a')
+        ])
+
+    #
+    #
+    #
+    def test_scan_new_file_at_tracked_path(self):
+        # GIVEN mv a b; touch a
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/a')
+        self.file_system.mock_file(path='folder/b', file_id='00000000-0000-0000-0000-000000000001', fingerprint='md5(folder/b)')
+        self.file_system.paths_dict_by_id['00000000-0000-0000-0000-000000000001'] = 'folder/a'
+        # WHEN
+        self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        now = self.__mock_time_provider()
+        changes = [thing for thing in self.storage.things_done() if thing[0] != 'open()' and thing[1:2] != ([],)]
+        self.assertEqual(changes, [
+            ('add_fingerprints()', [('00000000-0000-0000-0000-000000000001', 'b', 'md5', 'md5(folder/b)', now)], False),
+            ('commit()',),
+            ('clear_paths()', ['00000000-0000-0000-0000-000000000001'], False),
+            ('update_paths()', [('00000000-0000-0000-0000-000000000001', 'folder/b')], False),
+            ('commit()',),
+            ('add_paths()', [('00000000-0000-0000-0000-000000001001', 'folder/a')], False),
+            ('add_fingerprints()', [('00000000-0000-0000-0000-000000001001', 'a', 'md5', 'md5(folder/a)', now)], False),
+            ('commit()',),
+            ('close()',)
+        ])
+        self.assertIn(('set_attribute()', 'folder/a', XATTR_ID, '00000000-0000-0000-0000-000000001001'), self.file_system.things_done())
+        notifications = [thing for thing in self.presentation.things_done if thing[0] in ('notify_file()', 'notify_file_moved()', 'notify_error()')]
+        self.assertEqual(notifications, [
+            ('notify_file()', 'folder/a', True),
+            ('notify_file()', 'folder/b', False),
+            ('notify_file_moved()', 'folder/a', 'folder/b')
+        ])
+
+    #
+    #
+    #
+    def test_ingest_buffer(self):
+        # GIVEN
+        storage = MockStorage(MockFileSystem())
+        clock = [0.0]
+        written = []
+        under_test = IngestBuffer(storage, max_rows=3, max_seconds=10.0, time_function=lambda: clock[0])
+        # WHEN
+        under_test.add_path('id1', 'folder/1')
+        under_test.add_fingerprint('id1', '1', 'md5', 'fp1', 'now')
+        under_test.after_commit(lambda: written.append(list(storage.done)))
+        under_test.flush_if_needed()
+        # THEN
+        self.assertEqual(storage.done, [])
+        # WHEN
+        under_test.add_path('id2', 'folder/2')
+        under_test.flush_if_needed()
+        # THEN
+        self.assertEqual(storage.done, [('add_paths()', [('id1', 'folder/1'), ('id2', 'folder/2')], False),
+                                        ('add_fingerprints()', [('id1', '1', 'md5', 'fp1', 'now')], False),
+                                        ('commit()',)])
+        self.assertEqual(written, [storage.done])
+        # WHEN
+        under_test.add_path('id3', 'folder/3')
+        clock[0] = 10.0
+        under_test.flush_if_needed()
+        # THEN
+        self.assertEqual(storage.done[-3:], [('add_paths()', [('id3', 'folder/3')], False), ('add_fingerprints()', [], False), ('commit()',)])
+
+    #
+    #
+    #
+    def test_ingest_buffer_with_writer(self):
+        # GIVEN
+        storage = MockStorage(MockFileSystem())
+        written = []
+        writer = IngestWriter(storage, 'scan', debug_function=self.__debug)
+        under_test = IngestBuffer(storage, max_rows=1, writer=writer)
+        writer.start()
+        # WHEN
+        under_test.add_path('id1', 'folder/1')
+        under_test.after_commit(lambda: written.append('1'))
+        under_test.flush_if_needed()
+        under_test.add_path('id2', 'folder/2')
+        under_test.after_commit(lambda: written.append('2'))
+        under_test.flush(wait=True)
+        writer.stop()
+        # THEN
+        self.assertEqual(written, ['1', '2'])
+        self.assertEqual(storage.done, [('open()',),
+                                        ('add_paths()', [('id1', 'folder/1')], False), ('add_fingerprints()', [], False), ('commit()',),
+                                        ('add_paths()', [('id2', 'folder/2')], False), ('add_fingerprints()', [], False), ('commit()',),
+                                        ('close()',), ('close_connection()',)])
+
+    #
+    #
+    #
+    def test_ingest_writer_error(self):
+        # GIVEN
+        storage = MockStorage(MockFileSystem())
+        written = []
+
+        def fail(fingerprints, commit=False):
+            raise RuntimeError('disk full')
+
+        storage.add_fingerprints = fail
+        writer = IngestWriter(storage, 'scan', debug_function=self.__debug)
+        under_test = IngestBuffer(storage, writer=writer)
+        writer.start()
+        # WHEN
+        under_test.add_path('id1', 'folder/1')
+        under_test.after_commit(lambda: written.append('1'))
+        # THEN
+        with self.assertRaises(RuntimeError):
+            under_test.flush(wait=True)
+
+        with self.assertRaises(RuntimeError):
+            writer.stop()
+
+        self.assertEqual(written, [])
+
+    #
+    #
+    #
+    def test_scan_with_ingest_writer_error(self):
+        # GIVEN
+        self.__setup_fixture()
+        self.file_system.mock_file(path='folder/a')
+        flushed = []
+        self.under_test.write_behind = True
+        self.storage.profile_for = lambda operation=None: DATABASE_PROFILES['safe']
+        self.storage.add_fingerprints = self.__raising(RuntimeError('disk full'))
+        self.file_system.flush_attributes = lambda: flushed.append(True)
+        # WHEN
+        with self.assertRaisesRegex(RuntimeError, 'disk full'):
+            self.under_test.scan(folder='folder', file_filter='.*')
+        # THEN
+        self.assertIn(('notify_error()', 'Error while cleaning up: disk full'), self.presentation.things_done)
+        self.assertEqual(flushed, [True])
+        self.assertIn(('close()',), self.storage.things_done())
+
     #
     #
     #
@@ -378,21 +814,24 @@ class TestFingerprintControl(unittest.TestCase):
         # WHEN
         self.under_test.scan(folder='folder', file_filter='.*', only_new_files=True)
         # THEN
+        self.assertEqual(self.file_system.attributes_read_paths, ['folder/file_moved', 'folder/new_file', 'folder/new_file_with_error'])
         actual = self.storage.things_done() + self.file_system.things_done() + self.presentation.things_done
         now = self.__mock_time_provider()
         expected = [
             # STORAGE
             ('open()',),
-            ('add_path()', '00000000-0000-0000-0000-000000001001', 'folder/new_file', True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000001001', 'md5', 'md5(folder/new_file)', now, True),
-            ('add_path()', '00000000-0000-0000-0000-000000001002', 'folder/new_file_with_error', True),
-            ('insert_fingerprint()', '00000000-0000-0000-0000-000000001002', 'error', 'I/O error', now, True),
+            ('add_paths()', [('00000000-0000-0000-0000-000000001001', 'folder/new_file'),
+                             ('00000000-0000-0000-0000-000000001002', 'folder/new_file_with_error')], False),
+            ('add_fingerprints()', [
+                ('00000000-0000-0000-0000-000000001001', 'new_file', 'md5', 'md5(folder/new_file)', now),
+                ('00000000-0000-0000-0000-000000001002', 'new_file_with_error', 'error', 'I/O error', now)], False),
+            ('commit()',),
             ('close()',),
             # FILE SYSTEM
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.id', '00000000-0000-0000-0000-000000001001'),
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.fingerprint.md5', 'md5(folder/new_file)'),
-            ('set_attribute()', 'folder/new_file', 'it.tidalwave.datamanager.fingerprint.md5.timestamp', '2020-11-01 00:00:00'),
-            ('set_attribute()', 'folder/new_file_with_error', 'it.tidalwave.datamanager.id', '00000000-0000-0000-0000-000000001002'),
+            ('set_attribute()', 'folder/new_file', XATTR_ID, '00000000-0000-0000-0000-000000001001'),
+            ('set_attribute()', 'folder/new_file', XATTR_FINGERPRINT, 'md5(folder/new_file)'),
+            ('set_attribute()', 'folder/new_file', XATTR_FINGERPRINT_TIMESTAMP, '2020-11-01 00:00:00'),
+            ('set_attribute()', 'folder/new_file_with_error', XATTR_ID, '00000000-0000-0000-0000-000000001002'),
             # PRESENTATION
             ('notify_counting()',),
             ('notify_message()', "Counting files in ['folder']..."),
@@ -609,12 +1048,12 @@ class TestFingerprintControl(unittest.TestCase):
         expected = [
             # STORAGE
             ('open()',),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5(/Volumes/{backup_label}/Folder1/File1)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5(/Volumes/{backup_label}/Folder1/File2)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5(/Volumes/{backup_label}/Folder2/File3)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5(/Volumes/{backup_label}/Folder2/File4)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5(/Volumes/{backup_label}/Folder3/File5)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5(/Volumes/{backup_label}/Folder3/File6)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5(/Volumes/{backup_label}/Folder1/File1)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5(/Volumes/{backup_label}/Folder1/File2)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5(/Volumes/{backup_label}/Folder2/File3)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5(/Volumes/{backup_label}/Folder2/File4)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5(/Volumes/{backup_label}/Folder3/File5)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5(/Volumes/{backup_label}/Folder3/File6)', now, False),
             ('set_backup_check_latest_timestamp', backup_id, now),
             ('commit()',),
             ('close()',),
@@ -654,12 +1093,12 @@ class TestFingerprintControl(unittest.TestCase):
         veracrypt_mount_point = Config.encrypted_volumes_mount_folder()
         expected = [
             ('open()',),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder1/File1)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder1/File2)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder2/File3)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder2/File4)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder3/File5)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder3/File6)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder1/File1)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder1/File2)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder2/File3)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder2/File4)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder3/File5)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5({veracrypt_mount_point}/{backup_label}/Folder3/File6)', now, False),
             ('set_backup_check_latest_timestamp', backup_id, now),
             ('commit()',),
             ('close()',),
@@ -773,12 +1212,12 @@ class TestFingerprintControl(unittest.TestCase):
             ('commit()',),
             ('close()',),
             ('open()',),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder1/File1)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder1/File2)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder2/File3)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder2/File4)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder3/File5)', now, False),
-            ('insert_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder3/File6)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File1', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder1/File1)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File2', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder1/File2)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File3', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder2/File3)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File4', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder2/File4)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File5', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder3/File5)', now, False),
+            ('add_backup_fingerprint()', 'id-of-backup-of-id-of-File6', 'md5', f'md5({ev_mount_folder}/{backup_label}/Folder3/File6)', now, False),
             ('set_backup_check_latest_timestamp', new_backup_id, now),
             ('commit()',),
             ('close()',),
@@ -856,8 +1295,7 @@ class TestFingerprintControl(unittest.TestCase):
             ('notify_progress()', 6, 6),
             ('notify_message()', f'Unmounting VeraCrypt image at "{ev_mount_folder}/{backup_label}" ...'),
             ('notify_message()', f'Detected a VeraCrypt backup, mounting image at "{ev_mount_folder}/{backup_label}" ...'),
-            ('notify_counting()',),
-            ('notify_message()', f"Counting files in ['{ev_mount_folder}/{backup_label}']..."),
+            # files enumerated during the registration are reused
             ('notify_file_count()', 6),
             ('notify_message()', 'Found 6 files (434.3 MB)'),
             ('notify_file()', 'Folder1/File1', False),
@@ -1837,7 +2275,8 @@ class TestFingerprintControl(unittest.TestCase):
     #
     # Set up the test fixture.
     #
-    def __setup_fixture(self, mock_file_system_clz=MockFileSystem, mock_storage_clz=MockStorage):
+    def __setup_fixture(self, mock_file_system_clz=MockFileSystem, mock_storage_clz=MockStorage, attribute_timestamps: str = None,
+                        packed_attributes: bool = None):
         self.next_id = 1000
         self.executor = Executor(log=self.__log, log_exception=self.__log_exception)
         self.presentation = MockPresentation()
@@ -1850,6 +2289,8 @@ class TestFingerprintControl(unittest.TestCase):
                                                 file_system=self.file_system,
                                                 id_generator=self.__mock_generate_id,
                                                 time_provider=self.__mock_time_provider,
+                                                attribute_timestamps=attribute_timestamps,
+                                                packed_attributes=packed_attributes,
                                                 debug_function=self.__debug)
 
     #
@@ -1863,6 +2304,16 @@ class TestFingerprintControl(unittest.TestCase):
     def __mock_time_provider():
         return datetime(2020, 11, 1, 0, 0, 0)
 
+    @staticmethod
+    def __raising(error: Exception):
+        def function(*args, **kwargs):
+            raise error
+
+        return function
+
+    #
+    #
+    #
     @staticmethod
     def __log(string):
         print(string, flush=True)
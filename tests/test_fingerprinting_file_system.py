@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+import xattr
+from mockito import when, unstub, ANY
+
+from filtering import FileFilter
+from fingerprinting import FingerprintingFileSystem, FileCatalog, XATTR_ID, XATTR_FINGERPRINT
+from ioprofiles import IOProfiles
+
+
+class TestFingerprintingFileSystem(unittest.TestCase):
+    folder = None
+
+    #
+    #
+    #
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.folder = self.temporary_directory.name
+
+    #
+    #
+    #
+    def tearDown(self):
+        unstub()
+        self.temporary_directory.cleanup()
+
+    #
+    #
+    #
+    def test_enumerate_files_in_catalog_order(self):
+        # GIVEN
+        for path in ['a/x', 'a.txt', 'a0', 'a-b/y', 'a/b/z', 'a/b.txt', 'B']:
+            self.__create_file(path, size=len(path))
+        # WHEN
+        actual = FingerprintingFileSystem.enumerate_files([self.folder])
+        # THEN
+        paths = [file.path for file in actual]
+        self.assertEqual(paths, sorted(paths, key=FileCatalog.sort_key))
+        self.assertEqual([path[len(self.folder) + 1:] for path in paths], ['B', 'a.txt', 'a0', 'a-b/y', 'a/b.txt', 'a/x', 'a/b/z'])
+        self.assertEqual(len(actual), 7)
+        self.assertEqual(actual.total_size(), 28)
+        self.assertEqual(actual[0], FingerprintingFileSystem.FileInfo('B', self.folder, f'{self.folder}/B', 1))
+
+    #
+    #
+    #
+    def test_list_folder(self):
+        # GIVEN
+        for path in ['Backup.veracrypt', '.fseventsd/0000001', 'Folder/File']:
+            self.__create_file(path, size=1)
+        # WHEN
+        actual = FingerprintingFileSystem.list_folder(self.folder, FileFilter(excludes=['/.fseventsd']))
+        # THEN
+        self.assertEqual(actual, (['Backup.veracrypt'], ['Folder']))
+
+    #
+    #
+    #
+    def test_compute_fingerprint_with_io_profiles(self):
+        # GIVEN
+        self.__create_file('File', size=1000)
+        expected = ('md5', hashlib.md5(b'x' * 1000).hexdigest())
+
+        for profile in [{'chunk_size': 0}, {'chunk_size': 7}, {'chunk_size': 4096, 'mmap_threshold': 1}]:
+            io_profiles = IOProfiles(profile_overrides={'test': profile}, mount_overrides={self.folder: 'test'},
+                                     mountinfo_file=f'{self.folder}/no-mountinfo')
+            under_test = FingerprintingFileSystem(io_profiles=io_profiles, debug_function=print)
+            # WHEN
+            actual = under_test.compute_fingerprint(f'{self.folder}/File')
+            # THEN
+            self.assertEqual(actual, expected)
+            self.assertEqual(under_test.io_profile(f'{self.folder}/File').name, 'test')
+
+    #
+    #
+    #
+    def test_get_attributes_batch(self):
+        # GIVEN
+        class TestFileSystem(FingerprintingFileSystem):
+            @staticmethod
+            def get_attributes(path: str) -> dict:
+                return {'it.tidalwave.datamanager.id': f'id({path})'}
+
+        io_profiles = IOProfiles(profile_overrides={'test': {'concurrency': 3}}, mount_overrides={self.folder: 'test'})
+        paths = [f'{self.folder}/File{i}' for i in range(100)]
+        under_test = TestFileSystem(io_profiles=io_profiles)
+        # WHEN
+        actual = list(under_test.get_attributes_batch(paths))
+        # THEN
+        self.assertEqual(actual, [(path, {'it.tidalwave.datamanager.id': f'id({path})'}) for path in paths])
+
+    #
+    #
+    #
+    def test_attributes_in_manifest(self):
+        # GIVEN
+        for path in ['Folder1/File1', 'Folder1/File2', 'Folder2/File3']:
+            self.__create_file(path, size=1)
+
+        under_test = FingerprintingFileSystem()
+        # WHEN
+        when(xattr).setxattr(ANY, ANY, ANY).thenRaise(OSError(errno.ENOTSUP, 'Operation not supported'))
+        under_test.set_attribute(f'{self.folder}/Folder1/File1', XATTR_ID, 'id1')
+        under_test.set_attribute(f'{self.folder}/Folder1/File1', XATTR_FINGERPRINT, 'md5')
+        under_test.set_attribute(f'{self.folder}/Folder1/File2', XATTR_ID, 'id2')
+        under_test.set_attribute(f'{self.folder}/Folder2/File3', XATTR_ID, 'id3')
+        under_test.remove_attributes(f'{self.folder}/Folder1/File2', [XATTR_ID])
+        under_test.flush_attributes()
+        self.__create_file('Folder2/.solidblue-manifest.tmp', size=1)  # left behind by a crash
+        # THEN
+        actual = FingerprintingFileSystem()
+        self.assertEqual(actual.get_attributes(f'{self.folder}/Folder1/File1'), {XATTR_ID: 'id1', XATTR_FINGERPRINT: 'md5'})
+        self.assertEqual(actual.get_attributes(f'{self.folder}/Folder1/File2'), {})
+        self.assertEqual(actual.get_attribute(f'{self.folder}/Folder2/File3', XATTR_ID), 'id3')
+        self.assertEqual([file.name for file in FingerprintingFileSystem.enumerate_files([self.folder])], ['File1', 'File2', 'File3'])
+
+    #
+    #
+    #
+    def test_catalog_sort(self):
+        # GIVEN
+        under_test = FileCatalog()
+        under_test.add('/b', 'File2', 2)
+        under_test.add('/a/b', 'File1', 1)
+        under_test.add('/a', 'File3', 3)
+        under_test.add('/a', 'Filè4', 4)
+        # WHEN
+        under_test.sort()
+        # THEN
+        self.assertEqual([(file.path, file.size) for file in under_test], [('/a/File3', 3), ('/a/Filè4', 4), ('/a/b/File1', 1), ('/b/File2', 2)])
+
+    #
+    #
+    #
+    def test_catalog_footprint(self):
+        # GIVEN
+        folders = [f'/Volumes/Archive/Photos/2020/2020-{month:02}' for month in range(1, 13)]
+        files = [FingerprintingFileSystem.FileInfo(f'IMG_{i:05}.NEF', folder, f'{folder}/IMG_{i:05}.NEF', i * 1000)
+                 for folder in folders for i in range(1000)]
+        # WHEN
+        under_test = FileCatalog.of(files)
+        # THEN
+        list_footprint = sys.getsizeof(files) + sum(sys.getsizeof(file) + sys.getsizeof(file.name) + sys.getsizeof(file.path) + sys.getsizeof(file.size)
+                                                    for file in files)
+        self.assertLess(under_test.footprint() * 7, list_footprint)  # ~33 bytes per file: folder index, name, offset, size
+        self.assertEqual(list(under_test), files)
+
+    #
+    #
+    #
+    def __create_file(self, path: str, size: int):
+        path = f'{self.folder}/{path}'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as file:
+            file.write(b'x' * size)
+
+
+if __name__ == '__main__':
+    unittest.main()
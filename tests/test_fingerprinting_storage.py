@@ -12,13 +12,17 @@
 #  __email__ = "fabrizio.giudici@tidalwave.it"
 #  __status__ = "Prototype"
 
+import os
+import sqlite3
 import subprocess
 import tempfile
+import threading
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
 from os import mkdir
 
-from fingerprinting import FingerprintingStorage
+import fingerprinting
+from fingerprinting import FingerprintingStorage, FileCatalog
 
 
 class TestFingerprintStorage(unittest.TestCase):
@@ -37,39 +41,84 @@ class TestFingerprintStorage(unittest.TestCase):
 
         expected = """PRAGMA foreign_keys=OFF;
 BEGIN TRANSACTION;
-CREATE TABLE files (
-                            id TEXT PRIMARY KEY,
-                            path TEXT NOT NULL
-                            );
 CREATE TABLE fingerprints (
-                            id TEXT PRIMARY KEY,
+                            id INTEGER PRIMARY KEY,
+                            file_id INTEGER NOT NULL,
                             name TEXT NOT NULL,
-                            file_id TEXT NOT NULL,
                             algorithm TEXT NOT NULL,
-                            fingerprint TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
                             timestamp INTEGER NOT NULL
-                            );
-CREATE TABLE backups(
-                            id TEXT PRIMARY KEY,
+                            , last_seen INTEGER);
+CREATE TABLE backups (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
                             base_path TEXT NOT NULL,
                             label TEXT NOT NULL UNIQUE,
                             volume_id TEXT NOT NULL UNIQUE,
                             encrypted INTEGER NOT NULL,
                             creation_date INTEGER NOT NULL,
                             registration_date INTEGER NOT NULL,
-                            latest_check_date
+                            latest_check_date INTEGER
+                            );
+CREATE TABLE backup_fingerprints (
+                            id INTEGER PRIMARY KEY,
+                            backup_file_id INTEGER NOT NULL,
+                            algorithm TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
+                            timestamp INTEGER NOT NULL
+                            );
+CREATE TABLE latest_fingerprints (
+                            file_id INTEGER NOT NULL,
+                            algorithm TEXT NOT NULL,
+                            fingerprint BLOB NOT NULL,
+                            timestamp INTEGER NOT NULL,
+                            PRIMARY KEY (file_id, algorithm)
+                            ) WITHOUT ROWID;
+CREATE TABLE folders (
+                            id INTEGER PRIMARY KEY,
+                            path TEXT NOT NULL UNIQUE
+                            );
+CREATE TABLE IF NOT EXISTS "files" (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            folder_id INTEGER,
+                            name TEXT
                             );
-CREATE TABLE backup_files(
-                            id TEXT PRIMARY KEY,
-                            backup_id TEXT NOT NULL,
-                            file_id TEXT NOT NULL,
-                            path TEXT NOT NULL
+CREATE TABLE IF NOT EXISTS "backup_files" (
+                            id INTEGER PRIMARY KEY,
+                            uuid TEXT NOT NULL UNIQUE,
+                            backup_id INTEGER NOT NULL,
+                            file_id INTEGER NOT NULL,
+                            folder_id INTEGER NOT NULL,
+                            name TEXT NOT NULL
                             );
-CREATE INDEX files__path ON files (path);
+CREATE TRIGGER fingerprints__insert AFTER INSERT ON fingerprints BEGIN
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                VALUES(new.file_id, new.algorithm, new.fingerprint, coalesce(new.last_seen, new.timestamp))
+                                ON CONFLICT(file_id, algorithm) DO UPDATE SET fingerprint = excluded.fingerprint, timestamp = excluded.timestamp
+                                WHERE excluded.timestamp >= latest_fingerprints.timestamp;
+                            END;
+CREATE TRIGGER fingerprints__update AFTER UPDATE OF last_seen ON fingerprints BEGIN
+                            UPDATE latest_fingerprints SET timestamp = new.last_seen
+                                WHERE file_id = new.file_id AND algorithm = new.algorithm AND fingerprint = new.fingerprint
+                                AND timestamp < new.last_seen;
+                            END;
+CREATE TRIGGER fingerprints__delete AFTER DELETE ON fingerprints
+                            WHEN EXISTS (SELECT 1 FROM latest_fingerprints WHERE file_id = old.file_id AND algorithm = old.algorithm
+                                         AND fingerprint = old.fingerprint AND timestamp <= coalesce(old.last_seen, old.timestamp)) BEGIN
+                            DELETE FROM latest_fingerprints WHERE file_id = old.file_id AND algorithm = old.algorithm;
+                            INSERT INTO latest_fingerprints(file_id, algorithm, fingerprint, timestamp)
+                                SELECT file_id, algorithm, fingerprint, max(coalesce(last_seen, timestamp)) FROM fingerprints
+                                WHERE file_id = old.file_id AND algorithm = old.algorithm GROUP BY file_id, algorithm;
+                            END;
 CREATE INDEX fingerprints__name ON fingerprints (name);
-CREATE INDEX fingerprints__file_id ON fingerprints (file_id);
 CREATE INDEX fingerprints__timestamp ON fingerprints (timestamp);
-CREATE INDEX backups__volume_id ON backups (volume_id);
+CREATE INDEX backup_fingerprints__backup_file_id ON backup_fingerprints (backup_file_id);
+CREATE INDEX fingerprints__file_id_timestamp ON fingerprints (file_id, timestamp);
+CREATE INDEX backups__base_path ON backups (base_path);
+CREATE INDEX files__name ON files (name);
+CREATE UNIQUE INDEX files__folder_id_name ON files (folder_id, name);
+CREATE INDEX backup_files__backup_id_file_id ON backup_files (backup_id, file_id);
 COMMIT;
 """
         actual = self.__database_dump('.dump')
@@ -85,7 +134,7 @@ COMMIT;
         self.under_test.add_path(self.__mock_generate_id(), '/the/path', commit=True)
         self.under_test.close()
 
-        expected = """INSERT INTO "table" VALUES('00000000-0000-0000-0000-000000001001','/the/path');
+        expected = """INSERT INTO "table" VALUES(1,'00000000-0000-0000-0000-000000001001',1,'path');
 """
         actual = self.__database_dump('select * from files;')
         self.assertEqual(expected, actual)
@@ -102,11 +151,37 @@ COMMIT;
         self.under_test.add_backup('/the/path', 'label', 'volume id', creation_date, registration_date, True, commit=True)
         self.under_test.close()
 
-        expected = """INSERT INTO "table" VALUES('00000000-0000-0000-0000-000000001001','/the/path','label','volume id',1,'2020-10-01 02:03:04','2021-11-05 06:07:08',NULL);
+        expected = """INSERT INTO "table" VALUES(1,'00000000-0000-0000-0000-000000001001','/the/path','label','volume id',1,1601517784,1636092428,NULL);
 """
         actual = self.__database_dump('select * from backups;')
         self.assertEqual(expected, actual)
 
+    #
+    #
+    #
+    def test_find_backups(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        creation_date = datetime(2020, 10, 1, 2, 3, 4)
+        registration_date = datetime(2021, 11, 5, 6, 7, 8)
+        backup_id = self.under_test.add_backup('/the/path', 'label', 'volume id', creation_date, registration_date, True)
+        self.under_test.add_backup('/the/other/path', 'another label', 'another volume id', creation_date, registration_date, False, commit=True)
+
+        backups = self.under_test.get_backups()
+        backup = self.under_test.find_backup_by_label('label')
+        self.assertEqual([b.label for b in backups], ['another label', 'label'])
+        self.assertEqual(backup, backups[1])
+        self.assertIs(type(backup), type(backups[0]))
+        self.assertEqual(backup._fields, ('id', 'base_path', 'label', 'volume_id', 'encrypted', 'creation_date', 'registration_date',
+                                          'latest_check_date'))
+        self.assertEqual(backup.id, backup_id)
+        self.assertEqual(backup.creation_date, creation_date)
+        self.assertEqual(backup.registration_date, registration_date)
+        self.assertEqual(backup.latest_check_date, None)
+        self.assertEqual(self.under_test.find_backup_by_volume_id('unknown'), None)
+        self.under_test.close()
+
     #
     #
     #
@@ -116,14 +191,460 @@ COMMIT;
         self.under_test.open()
         file_id = '00000000-0000-0000-0000-000000000001'
         timestamp = datetime(2020, 10, 1, 2, 3, 4)
+        self.under_test.add_path(file_id, '/the/path')
         self.under_test.add_fingerprint(file_id, 'file_name', 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp, commit=True)
         self.under_test.close()
 
-        expected = """INSERT INTO "table" VALUES('00000000-0000-0000-0000-000000001001','file_name','00000000-0000-0000-0000-000000000001','md5','114dfaaa497f81c463dcc690db527a0d','2020-10-01 02:03:04');
+        expected = """INSERT INTO "table" VALUES(1,1,'file_name','md5',X'114dfaaa497f81c463dcc690db527a0d',1601517784,NULL);
 """
         actual = self.__database_dump('select * from fingerprints;')
         self.assertEqual(expected, actual)
 
+    #
+    #
+    #
+    def test_bulk_add(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        timestamp = datetime(2020, 10, 1, 2, 3, 4)
+
+        for i in range(2):  # the second time everything is already present
+            self.under_test.bulk_add_files([('00000000-0000-0000-0000-000000000001', '/the/path1'), ('00000000-0000-0000-0000-000000000002', '/the/path2')])
+            self.under_test.bulk_add_fingerprints([('00000000-0000-0000-0000-000000000001', 'path1', 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp)],
+                                                  commit=True)
+
+        self.under_test.close()
+
+        expected = """INSERT INTO "table" VALUES(1,'00000000-0000-0000-0000-000000000001',1,'path1');
+INSERT INTO "table" VALUES(2,'00000000-0000-0000-0000-000000000002',1,'path2');
+"""
+        self.assertEqual(expected, self.__database_dump('select * from files;'))
+        expected = """INSERT INTO "table" VALUES(1,1,'path1','md5',X'114dfaaa497f81c463dcc690db527a0d',1601517784,NULL);
+"""
+        self.assertEqual(expected, self.__database_dump('select * from fingerprints;'))
+
+    #
+    #
+    #
+    def test_find_latest_md5_fingerprint_by_id(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        file_id = '00000000-0000-0000-0000-000000000001'
+        self.under_test.add_path(file_id, '/the/path')
+        self.under_test.add_fingerprint(file_id, 'file_name', 'md5', 'old md5', datetime(2020, 10, 1, 2, 3, 4))
+        self.under_test.add_fingerprint(file_id, 'file_name', 'md5', 'md5', datetime(2020, 11, 1, 2, 3, 4))
+        self.under_test.add_fingerprint(file_id, 'file_name', 'error', 'I/O error', datetime(2020, 12, 1, 2, 3, 4), commit=True)
+
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id(file_id), ('md5', '2020-11-01 02:03:04'))
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id('unknown'), (None, None))
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_latest_fingerprints(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        file_id = '00000000-0000-0000-0000-000000000001'
+        self.under_test.add_path(file_id, '/the/path')
+        self.under_test.add_fingerprint(file_id, 'file_name', 'md5', '114dfaaa497f81c463dcc690db527a0d', datetime(2020, 11, 1, 2, 3, 4))
+        self.under_test.add_fingerprint(file_id, 'file_name', 'md5', 'd41d8cd98f00b204e9800998ecf8427e', datetime(2020, 10, 1, 2, 3, 4))
+        self.under_test.add_fingerprint(file_id, 'file_name', 'error', 'I/O error', datetime(2020, 12, 1, 2, 3, 4), commit=True)
+
+        self.assertEqual(self.under_test.find_latest_fingerprint_by_id(file_id), ('I/O error', '2020-12-01 02:03:04'))
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id(file_id), ('114dfaaa497f81c463dcc690db527a0d', '2020-11-01 02:03:04'))
+
+        self.under_test.conn.execute('DELETE FROM fingerprints WHERE timestamp = 1604196184')
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id(file_id), ('d41d8cd98f00b204e9800998ecf8427e', '2020-10-01 02:03:04'))
+
+        self.under_test.conn.execute('DELETE FROM latest_fingerprints')
+        self.under_test.commit()
+        self.assertEqual(self.under_test.find_latest_fingerprint_by_id(file_id), (None, None))
+
+        self.under_test.backfill_latest_fingerprints()
+        self.assertEqual(self.under_test.find_latest_fingerprint_by_id(file_id), ('I/O error', '2020-12-01 02:03:04'))
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id(file_id), ('d41d8cd98f00b204e9800998ecf8427e', '2020-10-01 02:03:04'))
+
+        plan = self.under_test.conn.execute("EXPLAIN QUERY PLAN SELECT fingerprint FROM latest_fingerprints WHERE file_id = 1 AND algorithm = 'md5'").fetchall()
+        self.assertIn('USING PRIMARY KEY (file_id=? AND algorithm=?)', plan[0][3])
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_rename_folder(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        self.under_test.bulk_add_files([('1', '/a/b/c'), ('2', '/a/b/d/e'), ('3', '/a/bc'), ('4', '/a/b0'), ('5', '/x/d/f'), ('6', '/x/d/e')])
+        self.assertEqual(self.under_test.count_files('/a/b'), 2)
+        self.assertEqual(self.under_test.rename_folder('/a/b', '/x', commit=True), [('6', '/x/d/e')])  # /x/d/ already exists, with e
+        self.under_test.update_paths([('3', '/y/bc')], commit=True)
+        self.assertEqual(self.under_test.rename_folder('/x', '/x/x', commit=True), [])  # new paths of folders that are renamed too
+
+        self.assertEqual(self.under_test.find_mappings(), [('4', '/a/b0'), ('1', '/x/x/c'), ('2', '/x/x/d/e'), ('5', '/x/x/d/f'), ('3', '/y/bc')])
+        self.assertIsNone(self.under_test.find_path_by_id('6'))
+        self.assertRaises(sqlite3.IntegrityError, self.under_test.update_paths, [('4', '/x/x/c')])
+        self.assertEqual(self.under_test.count_files_by_folder('/x'), [('/x/x/', 1), ('/x/x/d/', 2)])
+        self.under_test.close()
+
+        expected = """INSERT INTO "table" VALUES(1,'/a/');
+INSERT INTO "table" VALUES(2,'/x/x/');
+INSERT INTO "table" VALUES(4,'/x/x/d/');
+INSERT INTO "table" VALUES(5,'/y/');
+"""
+        self.assertEqual(expected, self.__database_dump('select * from folders order by path;'))
+
+    #
+    #
+    #
+    def test_iterate_mappings(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        self.under_test.add_paths([('1', '/a/b/z'), ('2', '/a/b/c/d'), ('3', '/a/b/a'), ('4', '/a/b.c/e'), ('5', '/a/bc/f'), ('6', '/b/g')])
+        timestamp = datetime(2020, 10, 1, 2, 3, 4)
+        self.under_test.add_backup_item(self.under_test.add_backup('/Volumes/B', 'B', 'volume', timestamp, timestamp, False), '7', 'a/h')
+
+        expected = [('4', '/a/b.c/e'), ('3', '/a/b/a'), ('1', '/a/b/z'), ('2', '/a/b/c/d'), ('5', '/a/bc/f')]
+        catalog = FileCatalog()
+
+        for _, path in reversed(expected):
+            catalog.add(*os.path.split(path), 0)
+
+        catalog.sort()
+        self.assertEqual([file.path for file in catalog], [path for _, path in expected])  # the same order as FileCatalog
+        self.assertEqual(list(self.under_test.iterate_mappings('/a')), expected)
+        self.assertEqual(list(self.under_test.iterate_mappings('/a/b')), expected[1:4])
+        self.assertEqual(self.under_test.count_files('/a'), 5)
+        self.assertEqual(self.under_test.find_path_by_id('2'), '/a/b/c/d')
+        self.assertEqual(self.under_test.find_path_by_id('7'), None)
+        self.under_test.clear_paths(['3'], commit=True)
+        self.assertEqual(self.under_test.find_path_by_id('3'), None)
+        self.assertEqual(list(self.under_test.iterate_mappings('/a/b')), expected[2:4])
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_find_file_ids_by_name(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        self.under_test.add_paths([('1', '/a/IMG_0001.NEF'), ('2', '/b/IMG_0001.NEF'), ('3', '/a/IMG_0002.NEF')])
+        self.under_test.add_path('4', '/a/IMG_0003.NEF')
+        self.under_test.update_path('3', '/a/IMG_0004.NEF')
+        self.under_test.rename_folder('/a', '/c')
+
+        self.assertEqual(self.under_test.find_file_id_by_name('IMG_0003.NEF'), '4')
+        self.assertEqual(self.under_test.find_file_id_by_name('IMG_0001.NEF'), None)
+        self.assertEqual(self.under_test.find_file_ids_by_name(['IMG_0001.NEF', 'IMG_0002.NEF', 'IMG_0003.NEF', 'IMG_0004.NEF']),
+                         {'IMG_0003.NEF': '4', 'IMG_0004.NEF': '3'})
+        plan = self.under_test.conn.execute('EXPLAIN QUERY PLAN SELECT uuid FROM files WHERE name = ?', ('x',)).fetchall()
+        self.assertIn('USING INDEX files__name', plan[0][-1])
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_change_only_history(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        file_id = '00000000-0000-0000-0000-000000000001'
+        self.under_test.add_path(file_id, '/the/path')
+
+        for day, fingerprint in [(1, 'aa'), (2, 'aa'), (3, 'aa'), (4, 'bb'), (5, 'aa'), (6, 'aa')]:
+            self.under_test.add_fingerprints([(file_id, 'path', 'md5', fingerprint, datetime(2020, 10, day))], commit=True)
+
+        self.assertEqual(self.under_test.find_fingerprint_ranges_by_file_id(file_id), [('aa', '2020-10-01 00:00:00', '2020-10-03 00:00:00'),
+                                                                                     ('bb', '2020-10-04 00:00:00', '2020-10-04 00:00:00'),
+                                                                                     ('aa', '2020-10-05 00:00:00', '2020-10-06 00:00:00')])
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id(file_id), ('aa', '2020-10-06 00:00:00'))
+
+        self.under_test.bulk_add_fingerprints([(file_id, 'path', 'md5', 'aa', datetime(2020, 10, 2)),  # covered
+                                               (file_id, 'path', 'md5', 'aa', datetime(2020, 10, 7))], commit=True)
+        self.assertEqual(self.under_test.find_fingerprint_ranges_by_file_id(file_id)[-1], ('aa', '2020-10-05 00:00:00', '2020-10-07 00:00:00'))
+        self.assertEqual(self.under_test.conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0], 3)
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_compact_fingerprints(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        self.under_test.add_paths([('1', '/a/1'), ('2', '/a/2')])
+        history = [('1', 'aa', 1), ('1', 'aa', 2), ('1', 'bb', 3), ('1', 'aa', 4), ('1', 'aa', 5), ('2', 'cc', 1), ('2', 'cc', 2)]
+        self.under_test.conn.executemany("INSERT INTO fingerprints(file_id, name, algorithm, fingerprint, timestamp) "
+                                         "VALUES((SELECT id FROM files WHERE uuid = ?), 'name', 'md5', ?, ?)", history)  # as before version 6
+        self.under_test.conn.execute("INSERT INTO fingerprints(file_id, name, algorithm, fingerprint, timestamp) VALUES(2, 'name', 'error', 'error', 3)")
+        self.under_test.commit()
+        progress = []
+
+        self.assertEqual(self.under_test.compact_fingerprints(progress_function=lambda partial, total: progress.append((partial, total))), 3)
+        self.assertEqual(progress, [(2, 2)])
+        self.assertEqual(self.under_test.find_fingerprint_ranges_by_file_id('1'), [('aa', '1970-01-01 00:00:01', '1970-01-01 00:00:02'),
+                                                                                 ('bb', '1970-01-01 00:00:03', '1970-01-01 00:00:03'),
+                                                                                 ('aa', '1970-01-01 00:00:04', '1970-01-01 00:00:05')])
+        self.assertEqual(self.under_test.find_fingerprint_ranges_by_file_id('2'), [('cc', '1970-01-01 00:00:01', '1970-01-01 00:00:02'),
+                                                                                 ('error', '1970-01-01 00:00:03', '1970-01-01 00:00:03')])
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id('1'), ('aa', '1970-01-01 00:00:05'))
+        self.assertEqual(self.under_test.find_latest_md5_fingerprint_by_id('2'), ('cc', '1970-01-01 00:00:02'))
+        self.assertEqual(self.under_test.compact_fingerprints(), 0)
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_snapshot(self):
+        self.__setup_fixture(profile='safe')  # readers and the writer don't wait for each other only in WAL mode
+        timestamp = datetime(2020, 10, 1, 2, 3, 4)
+        self.under_test.open()
+        self.under_test.add_backup('/Volumes/A', 'A', 'volume A', timestamp, timestamp, False, commit=True)
+        written = threading.Event()
+        committing = threading.Event()
+
+        def write():
+            self.under_test.open()
+            self.under_test.add_backup('/Volumes/B', 'B', 'volume B', timestamp, timestamp, False)
+            written.set()
+            committing.wait()
+            self.under_test.commit()
+            self.under_test.close()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        written.wait()
+        self.assertEqual([backup.label for backup in self.under_test.get_backups()], ['A'])  # doesn't wait for the writer
+
+        with self.under_test.snapshot():
+            self.assertEqual(self.under_test.find_backup_by_label('B'), None)
+            committing.set()
+            thread.join()  # the writer commits without waiting for the snapshot
+            self.assertEqual([backup.label for backup in self.under_test.get_backups()], ['A'])
+
+            with self.assertRaises(sqlite3.OperationalError):
+                self.under_test.add_path('1', '/a/1')
+
+        self.assertEqual([backup.label for backup in self.under_test.get_backups()], ['A', 'B'])
+        self.under_test.close()
+
+    #
+    # Runs EXPLAIN QUERY PLAN on every statement executed by the storage and fails if one of them scans a whole table.
+    # Only get_backups and find_mappings, which return all the rows, are allowed to do that.
+    #
+    def test_query_plans(self):
+        self.__setup_fixture()
+
+        self.under_test.open()
+        statements = []
+        self.under_test.conn.set_trace_callback(statements.append)
+        timestamp = datetime(2020, 10, 1, 2, 3, 4)
+        self.under_test.add_path('1', '/a/IMG_0001.NEF')
+        self.under_test.add_paths([('2', '/a/IMG_0002.NEF')])
+        self.under_test.bulk_add_files([('3', '/a/IMG_0003.NEF'), ('4', '/c/IMG_0001.NEF')])
+        self.under_test.update_path('1', '/b/IMG_0001.NEF')
+        self.under_test.update_paths([('2', '/b/IMG_0002.NEF')])
+        self.under_test.rename_folder('/b', '/c')
+        self.under_test.count_files('/c')
+        self.under_test.count_files_by_folder('/c')
+        self.under_test.find_mappings()
+        list(self.under_test.iterate_mappings('/c'))
+        self.under_test.find_path_by_id('1')
+        self.under_test.find_file_id_by_name('IMG_0001.NEF')
+        self.under_test.find_file_ids_by_name(['IMG_0001.NEF', 'IMG_0002.NEF'])
+        self.under_test.add_fingerprint('1', 'IMG_0001.NEF', 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp)
+        self.under_test.bulk_add_fingerprints([('2', 'IMG_0002.NEF', 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp)])
+        self.under_test.add_fingerprints([('1', 'IMG_0001.NEF', 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp + timedelta(days=1))])
+        self.under_test.find_fingerprint_by_file_id('1')
+        self.under_test.find_fingerprint_ranges_by_file_id('1')
+        self.under_test.find_latest_fingerprint_by_id('1')
+        self.under_test.find_latest_md5_fingerprint_by_id('1')
+        self.under_test.delete_fingerprint(1)
+        self.under_test.backfill_latest_fingerprints()
+        self.under_test.compact_fingerprints()
+        backup_id = self.under_test.add_backup('/Volumes/Backup', 'label', 'volume id', timestamp, timestamp, False)
+
+        with self.under_test.snapshot():
+            self.under_test.conn.set_trace_callback(statements.append)
+            self.under_test.get_backups()
+            self.under_test.conn.set_trace_callback(None)
+
+        self.under_test.find_backup_by_mount_point('/Volumes/Backup')
+        self.under_test.find_backup_by_volume_id('volume id')
+        self.under_test.find_backup_by_label('label')
+        self.under_test.set_backup_check_latest_timestamp(backup_id, timestamp)
+        backup_item_id = self.under_test.add_backup_item(backup_id, '1', 'IMG_0001.NEF')
+        self.under_test.find_backup_item_id(backup_id, '1')
+        self.under_test.add_backup_fingerprint(backup_item_id, 'md5', '114dfaaa497f81c463dcc690db527a0d', timestamp)
+        self.under_test.commit()
+        self.under_test.conn.set_trace_callback(None)
+
+        # the bodies of the triggers aren't traced
+        statements += ["SELECT file_id, algorithm, fingerprint, max(coalesce(last_seen, timestamp)) FROM fingerprints WHERE file_id = 1 "
+                       "AND algorithm = 'md5' GROUP BY file_id, algorithm",
+                       "SELECT 1 FROM latest_fingerprints WHERE file_id = 1 AND algorithm = 'md5' AND fingerprint = x'00' AND timestamp <= 0",
+                       "UPDATE latest_fingerprints SET timestamp = 1 WHERE file_id = 1 AND algorithm = 'md5' AND fingerprint = x'00' AND timestamp < 1"]
+        full_scans_allowed = [f'SELECT {fingerprinting.BACKUP_COLUMNS} FROM backups ORDER BY label',
+                              'SELECT f.uuid, d.path || f.name FROM folders d JOIN files f ON f.folder_id = d.id ORDER BY d.path, f.name']
+        queries = list(dict.fromkeys(statement for statement in statements if statement.split(' ')[0] in ['SELECT', 'INSERT', 'UPDATE', 'DELETE']))
+        self.assertGreater(len(queries), 25)
+
+        for query in queries:
+            for row in self.under_test.conn.execute(f'EXPLAIN QUERY PLAN {query}'):
+                detail = row[3]
+
+                if (detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW' and query not in full_scans_allowed) or 'AUTOMATIC' in detail:
+                    self.fail(f'{detail} in: {query}')
+
+                if detail.startswith('USE TEMP B-TREE') and query.endswith('ORDER BY d.path, f.name'):  # mappings are streamed
+                    self.fail(f'{detail} in: {query}')
+
+        self.under_test.close()
+
+    #
+    #
+    #
+    def test_connections_are_reused_per_thread(self):
+        self.__setup_fixture()
+        messages = []
+        self.under_test.debug = messages.append
+
+        self.under_test.open()
+        conn = self.under_test.conn
+        self.under_test.close()
+        self.under_test.open()
+        self.assertIs(self.under_test.conn, conn)
+        thread_conns = []
+        thread = threading.Thread(target=lambda: (self.under_test.open(), thread_conns.append(self.under_test.conn)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_conns[0], conn)
+        thread = threading.Thread(target=lambda: (self.under_test.open(), thread_conns.append(self.under_test.conn)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_conns[1], thread_conns[0])
+        self.assertRaises(sqlite3.ProgrammingError, thread_conns[0].execute, 'SELECT 1')  # closed, as its thread terminated
+        other = FingerprintingStorage(database_folder=self.database_folder, debug_function=messages.append)
+        other.open()
+        other.close_all()
+        self.under_test.close_all()
+        self.assertIsNone(self.under_test.conn)
+
+        self.assertEqual(len([message for message in messages if message.startswith('Opening')]), 4)
+        self.assertEqual(len([message for message in messages if message.startswith('Closing db connection of a terminated thread')]), 1)
+        self.assertEqual(len([message for message in messages if message.startswith('Checking schema')]), 1)
+
+    #
+    #
+    #
+    def test_migration_from_version_1(self):
+        self.__setup_fixture()
+        conn = sqlite3.connect(f'{self.database_folder}/fingerprints.db')
+        conn.executescript("""
+            CREATE TABLE files (id TEXT PRIMARY KEY, path TEXT NOT NULL);
+            CREATE TABLE fingerprints (id TEXT PRIMARY KEY, name TEXT NOT NULL, file_id TEXT NOT NULL, algorithm TEXT NOT NULL,
+                                       fingerprint TEXT NOT NULL, timestamp INTEGER NOT NULL);
+            CREATE TABLE backups(id TEXT PRIMARY KEY, base_path TEXT NOT NULL, label TEXT NOT NULL UNIQUE, volume_id TEXT NOT NULL UNIQUE,
+                                 encrypted INTEGER NOT NULL, creation_date INTEGER NOT NULL, registration_date INTEGER NOT NULL, latest_check_date);
+            CREATE TABLE backup_files(id TEXT PRIMARY KEY, backup_id TEXT NOT NULL, file_id TEXT NOT NULL, path TEXT NOT NULL);
+            INSERT INTO files VALUES('file-1', '/a/1'), ('file-2', '/a/2'), ('file-3', '/a/3'), ('file-4', '/a/1');
+            INSERT INTO fingerprints VALUES('fp-1', '1', 'file-1', 'md5', '114dfaaa497f81c463dcc690db527a0d', '2020-10-01 02:03:04.123456');
+            INSERT INTO fingerprints VALUES('fp-2', '2', 'file-2', 'error', 'I/O error', '2020-10-01 02:03:05');
+            INSERT INTO fingerprints VALUES('fp-3', '4', 'orphan', 'md5', 'd41d8cd98f00b204e9800998ecf8427e', '2020-10-01 02:03:06');
+            INSERT INTO fingerprints VALUES('fp-4', '1', 'backup-file-1', 'md5', '114dfaaa497f81c463dcc690db527a0d', '2021-11-05 06:07:08');
+            INSERT INTO fingerprints VALUES('fp-5', '1', 'file-4', 'md5', 'd41d8cd98f00b204e9800998ecf8427e', '2020-11-01 02:03:04');
+            INSERT INTO backups VALUES('backup-1', '/Volumes/B', 'B', 'volume', 0, '2021-11-05 06:07:00', '2021-11-05 06:07:01', NULL);
+            INSERT INTO backup_files VALUES('backup-file-1', 'backup-1', 'file-1', '1');
+            """)
+        conn.close()
+        fingerprinting.MIGRATION_BATCH = 1
+
+        def crash_on_second_chunk(message: str):
+            if message == 'Migrated files up to row 2':
+                raise KeyboardInterrupt()
+
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                FingerprintingStorage(database_folder=self.database_folder, debug_function=crash_on_second_chunk).open()
+
+            messages = []
+            self.under_test.debug = messages.append
+            self.under_test.open()
+        finally:
+            fingerprinting.MIGRATION_BATCH = 50000
+
+        self.assertIn('Migrated files up to row 3', messages)
+        self.assertNotIn('Migrated files up to row 2', messages)
+        self.assertEqual(self.under_test.conn.execute('PRAGMA user_version').fetchone()[0], 7)
+        self.assertEqual(self.under_test.find_mappings(), [('file-4', '/a/1'), ('file-2', '/a/2'), ('file-3', '/a/3')])  # file-1 was replaced
+        self.assertEqual(self.under_test.find_fingerprint_by_file_id('file-1'), [('114dfaaa497f81c463dcc690db527a0d', '2020-10-01 02:03:04')])
+        self.assertEqual(self.under_test.find_fingerprint_by_file_id('file-2'), [('I/O error', '2020-10-01 02:03:05')])
+        self.assertEqual(self.under_test.find_fingerprint_by_file_id('orphan'), [('d41d8cd98f00b204e9800998ecf8427e', '2020-10-01 02:03:06')])
+        self.assertEqual(self.under_test.find_backup_item_id('backup-1', 'file-1'), 'backup-file-1')
+        self.assertEqual(self.under_test.find_file_ids_by_name(['1', '2', '4']), {'1': 'file-4', '2': 'file-2'})
+        backup = self.under_test.find_backup_by_label('B')
+        self.assertEqual((backup.id, backup.creation_date, backup.latest_check_date), ('backup-1', datetime(2021, 11, 5, 6, 7), None))
+        self.under_test.close()
+
+        expected = """INSERT INTO "table" VALUES(1,1,'md5',X'114dfaaa497f81c463dcc690db527a0d',1636092428);
+"""
+        self.assertEqual(expected, self.__database_dump('select * from backup_fingerprints;'))
+
+    #
+    #
+    #
+    def test_database_profiles(self):
+        self.__setup_fixture()
+        self.under_test = FingerprintingStorage(database_folder=self.database_folder,
+                                                profile_overrides={'small': {'base': 'balanced', 'cache_size': 1024}},
+                                                operation_profiles={'test': 'small', 'rebuild-database': 'bulk'},
+                                                debug_function=self.__debug)
+
+        def pragmas() -> tuple:
+            return tuple(self.under_test.conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+                         for pragma in ('journal_mode', 'synchronous', 'cache_size', 'temp_store'))
+
+        self.under_test.open()
+        self.assertEqual(pragmas(), ('delete', 2, -2000, 0))
+        self.under_test.close()
+        self.under_test.open('rebuild-database')
+        self.assertEqual(pragmas(), ('wal', 0, -256 * 1024, 2))
+        self.under_test.close()
+        self.under_test.open('test')
+        self.assertEqual(pragmas(), ('wal', 1, -1024, 2))
+        self.under_test.close()
+        self.under_test.open('scan')
+        self.assertEqual(pragmas(), ('delete', 2, -2000, 0))
+        self.under_test.close_all()
+        under_test = FingerprintingStorage(database_folder=self.database_folder, profile='balanced', profile_overrides={}, operation_profiles={},
+                                           debug_function=self.__debug)
+        self.assertEqual(under_test.profile_for('rebuild-database').name, 'balanced')  # bulk only if opted in
+
+        with self.assertRaises(ValueError):
+            FingerprintingStorage(database_folder=self.database_folder, profile='unknown', debug_function=self.__debug).open()
+
+    #
+    #
+    #
+    def test_invalid_database_profile_overrides(self):
+        self.__setup_fixture()
+
+        for overrides, message in [({'fast': 'bulk'}, 'Database profile fast must be a mapping of fields, found: bulk'),
+                                   ({'fast': {'base': 'turbo'}}, 'Base of database profile fast .* found: turbo'),
+                                   ({'fast': {'cache': 1024}}, 'Field of database profile fast .* found: cache'),
+                                   ({'default': {'synchronous': 'off; DROP TABLE files'}},
+                                    'Invalid value for synchronous of database profile default: off; DROP TABLE files'),
+                                   ({'fast': {'base': 'bulk', 'cache_size': '256M'}}, 'Invalid value for cache_size of database profile fast: 256M'),
+                                   ({'fast': {'mmap_size': -1}}, 'Invalid value for mmap_size of database profile fast: -1')]:
+            with self.assertRaisesRegex(ValueError, message):
+                FingerprintingStorage(database_folder=self.database_folder, profile_overrides=overrides, debug_function=self.__debug).open()
+
     #
     #
     #
@@ -143,13 +664,14 @@ COMMIT;
     #
     # Set up the test fixture.
     #
-    def __setup_fixture(self):
+    def __setup_fixture(self, profile: str = None):
         self.next_id = 1000
         self.database_folder = tempfile.TemporaryDirectory().name
         mkdir(self.database_folder)
         self.__debug(f'test database folder: {self.database_folder}')
         self.under_test = FingerprintingStorage(database_folder=self.database_folder,
                                                 id_generator=self.__mock_generate_id,
+                                                profile=profile,
                                                 debug_function=self.__debug)
 
     #
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from ioprofiles import IOProfiles, Mount, IO_PROFILES
+
+
+class TestIOProfiles(unittest.TestCase):
+    sys_folder = None
+
+    #
+    #
+    #
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.sys_folder = self.temporary_directory.name
+        self.__mock_block_device('259:2', 'nvme0n1', 'nvme0n1p2', rotational=False)
+        self.__mock_block_device('8:17', 'sdb', 'sdb1', rotational=True)
+        self.__mock_block_device('8:18', 'sdb', 'sdb2', rotational=True)
+        self.__mock_block_device('11:0', 'sr0', None, rotational=True)
+
+    #
+    #
+    #
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    #
+    #
+    #
+    def test_mounts(self):
+        under_test = self.__under_test()
+        self.assertEqual(under_test.mount_for('/home/fritz/Photos/IMG_0001.NEF'), Mount('/', '259:2', 'ext4'))
+        self.assertEqual(under_test.mount_for('/mnt/Archive/Photos/IMG_0001.NEF'), Mount('/mnt/Archive', '8:17', 'ext4'))
+        self.assertEqual(under_test.mount_for('/mnt/Archive/Backup/IMG_0001.NEF'), Mount('/mnt/Archive/Backup', '8:18', 'exfat'))
+        self.assertEqual(under_test.mount_for('/mnt/NAS Photos/IMG_0001.NEF'), Mount('/mnt/NAS Photos', '0:45', 'cifs'))
+
+    #
+    #
+    #
+    def test_classify(self):
+        under_test = self.__under_test()
+        self.assertEqual(self.__classify(under_test, '/home/fritz/Photos/IMG_0001.NEF'), 'ssd')
+        self.assertEqual(self.__classify(under_test, '/mnt/Archive/Photos/IMG_0001.NEF'), 'hdd')
+        self.assertEqual(self.__classify(under_test, '/mnt/Archive/Backup/IMG_0001.NEF'), 'hdd')
+        self.assertEqual(self.__classify(under_test, '/mnt/NAS Photos/IMG_0001.NEF'), 'network')
+        self.assertEqual(self.__classify(under_test, '/mnt/nfs/IMG_0001.NEF'), 'network')
+        self.assertEqual(self.__classify(under_test, '/media/fritz/phone/DCIM/IMG_0001.JPG'), 'fuse')
+        self.assertEqual(self.__classify(under_test, '/media/fritz/FG-2020-0003/IMG_0001.NEF'), 'optical')
+        self.assertEqual(under_test.classify(Mount('/', None, 'apfs')), 'default')
+
+    #
+    #
+    #
+    def test_overrides(self):
+        under_test = self.__under_test(profile_overrides={'network': {'concurrency': 16},
+                                                          'slow-nas': {'base': 'network', 'chunk_size': 65536}},
+                                       mount_overrides={'/mnt/nfs': 'slow-nas'})
+        self.assertEqual(under_test.profiles['network'], IO_PROFILES['network']._replace(concurrency=16))
+        self.assertEqual(under_test.profiles['slow-nas'], IO_PROFILES['network']._replace(name='slow-nas', concurrency=16, chunk_size=65536))
+        self.assertEqual(under_test.profile_for('/mnt/nfs/IMG_0001.NEF', device=1).name, 'slow-nas')
+        self.assertEqual(under_test.profile_for('/mnt/NAS Photos/IMG_0001.NEF', device=2).name, 'network')
+
+    #
+    #
+    #
+    def test_invalid_overrides(self):
+        with self.assertRaisesRegex(ValueError, 'Base of I/O profile slow-nas .* found: nas'):
+            self.__under_test(profile_overrides={'slow-nas': {'base': 'nas'}})
+
+        with self.assertRaisesRegex(ValueError, 'Field of I/O profile network .* found: chunksize'):
+            self.__under_test(profile_overrides={'network': {'chunksize': 65536}})
+
+        with self.assertRaisesRegex(ValueError, 'Invalid value for concurrency of I/O profile network: 0'):
+            self.__under_test(profile_overrides={'network': {'concurrency': 0}})
+
+        with self.assertRaisesRegex(ValueError, 'Invalid value for chunk_size of I/O profile ssd: 8M'):
+            self.__under_test(profile_overrides={'ssd': {'chunk_size': '8M'}})
+
+        with self.assertRaisesRegex(ValueError, 'I/O profile for /mnt/nfs .* found: slow-nas'):
+            self.__under_test(mount_overrides={'/mnt/nfs': 'slow-nas'})
+
+    #
+    #
+    #
+    def test_no_mount_table(self):
+        under_test = IOProfiles(mountinfo_file=f'{self.sys_folder}/missing', sys_folder=self.sys_folder)
+        self.assertEqual(under_test.profile_for(self.sys_folder).name, 'default')
+
+    #
+    #
+    #
+    @staticmethod
+    def __classify(under_test: IOProfiles, path: str) -> str:
+        return under_test.classify(under_test.mount_for(path))
+
+    #
+    #
+    #
+    def __under_test(self, profile_overrides: dict = None, mount_overrides: dict = None) -> IOProfiles:
+        return IOProfiles(profile_overrides=profile_overrides, mount_overrides=mount_overrides,
+                          mountinfo_file=self.__test_resource('proc/mountinfo'), sys_folder=self.sys_folder)
+
+    #
+    # Creates a sysfs-like structure with a block device, its optional partition and the /sys/dev/block link.
+    #
+    def __mock_block_device(self, device: str, disk: str, partition: str, rotational: bool):
+        disk_folder = f'{self.sys_folder}/devices/{disk}'
+        os.makedirs(f'{disk_folder}/queue', exist_ok=True)
+
+        with open(f'{disk_folder}/queue/rotational', 'wt') as file:
+            file.write('1\n' if rotational else '0\n')
+
+        target = disk_folder
+
+        if partition:
+            target = f'{disk_folder}/{partition}'
+            os.makedirs(target, exist_ok=True)
+            Path(f'{target}/partition').touch()
+
+        os.makedirs(f'{self.sys_folder}/dev/block', exist_ok=True)
+        os.symlink(target, f'{self.sys_folder}/dev/block/{device}')
+
+    #
+    #
+    #
+    @staticmethod
+    def __test_resource(name: str) -> str:
+        script_path = Path(os.path.realpath(__file__)).parent.parent
+        return f'{script_path}/test-resources/{name}'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import unittest
+
+from fingerprinting import PackedAttributes, FileAttributes, XATTR_ID, XATTR_FINGERPRINT, XATTR_FINGERPRINT_TIMESTAMP, XATTR_RECORD
+
+
+class TestPackedAttributes(unittest.TestCase):
+    def test_pack_and_unpack(self):
+        record = PackedAttributes.pack('2f5d1b6e-5b1c-4a0e-9d3c-2b8e0b5a7c11', 'd41d8cd98f00b204e9800998ecf8427e', '2020-11-01 12:34:56')
+        self.assertEqual(record, '1;2f5d1b6e-5b1c-4a0e-9d3c-2b8e0b5a7c11;d41d8cd98f00b204e9800998ecf8427e;20201101T123456')
+        self.assertEqual(PackedAttributes.unpack(record), ('2f5d1b6e-5b1c-4a0e-9d3c-2b8e0b5a7c11', 'd41d8cd98f00b204e9800998ecf8427e', '2020-11-01 12:34:56'))
+        self.assertEqual(PackedAttributes.unpack(PackedAttributes.pack('id', None, None)), ('id', None, None))
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            PackedAttributes.unpack('2;id;fingerprint;20201101T123456;extra')
+
+    def test_legacy_layout(self):
+        attributes = {XATTR_ID: 'id', XATTR_FINGERPRINT: 'fingerprint', XATTR_FINGERPRINT_TIMESTAMP: '2020-11-01 12:34:56'}
+        self.assertEqual(PackedAttributes.of(attributes), FileAttributes('id', 'fingerprint', '2020-11-01 12:34:56', [XATTR_ID, XATTR_FINGERPRINT, XATTR_FINGERPRINT_TIMESTAMP]))
+
+    def test_packed_record_wins(self):
+        attributes = {XATTR_ID: 'old-id', XATTR_RECORD: '1;id;fingerprint;20201101T123456'}
+        self.assertEqual(PackedAttributes.of(attributes), FileAttributes('id', 'fingerprint', '2020-11-01 12:34:56', [XATTR_ID], True))
+        self.assertEqual(PackedAttributes.of({}), FileAttributes(None, None, None, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  SolidBlue III - Open source data manager.
+#
+#  __author__ = "Fabrizio Giudici"
+#  __copyright__ = "Copyright © 2020 by Fabrizio Giudici"
+#  __credits__ = ["Fabrizio Giudici"]
+#  __license__ = "Apache v2"
+#  __version__ = "1.0-ALPHA-4-SNAPSHOT"
+#  __maintainer__ = "Fabrizio Giudici"
+#  __email__ = "fabrizio.giudici@tidalwave.it"
+#  __status__ = "Prototype"
+
+import unittest
+
+from fingerprinting import FileCatalog, Reconciler
+
+
+class TestReconciler(unittest.TestCase):
+    #
+    #
+    #
+    def test_reconcile(self):
+        # GIVEN
+        files = FileCatalog()
+
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            files.add('/folder', name, 1)
+
+        mappings = [('id0', '/folder/0'), ('idb', '/folder/b'), ('idd', '/folder/d'), ('idz', '/folder/z')]
+        attributes = {'/folder/a': ('ida', None, None), '/folder/c': ('id0', 'fingerprint', None), '/folder/e': (None, None, None)}
+        paths_by_id = {'ida': None, 'id0': '/folder/0'}
+        read_paths = []
+
+        def attributes_reader(path: str):
+            read_paths.append(path)
+            return attributes[path]
+
+        # WHEN
+        actual = [(item.status, item.file.path if item.file else None, item.file_id, item.previous_path)
+                  for item in Reconciler(files, mappings, attributes_reader, paths_by_id.get)]
+        # THEN
+        self.assertEqual(actual, [(Reconciler.UNKNOWN, '/folder/a', 'ida', None),
+                                  (Reconciler.UNCHANGED, '/folder/b', 'idb', None),
+                                  (Reconciler.MOVED, '/folder/c', 'id0', '/folder/0'),
+                                  (Reconciler.UNCHANGED, '/folder/d', 'idd', None),
+                                  (Reconciler.NEW, '/folder/e', None, None),
+                                  (Reconciler.MISSING, None, 'idz', '/folder/z')])
+        self.assertEqual(read_paths, ['/folder/a', '/folder/c', '/folder/e'])
+
+    #
+    #
+    #
+    def test_rows_behind_the_cursor_are_ignored(self):
+        # GIVEN
+        files = FileCatalog()
+        files.add('/folder', 'b', 1)
+        mappings = [('ida', '/folder/a'), ('idb', '/folder/b'), ('idb2', '/folder/b'), ('idc', '/folder/a1')]
+        # WHEN
+        actual = [(item.status, item.file_id) for item in Reconciler(files, mappings, lambda path: (None, None, None), lambda file_id: None)]
+        # THEN
+        self.assertEqual(actual, [(Reconciler.UNCHANGED, 'idb'), (Reconciler.MISSING, 'ida')])
+
+
+if __name__ == '__main__':
+    unittest.main()